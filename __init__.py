@@ -26,16 +26,38 @@ __contributors__ = {}
 # This is a url where the most recent plugin package can be downloaded.
 __url__ = ''
 
+import sys
+
+from . import metrics
+from . import userconf
+from . import fmiapi
+from . import geo
+from . import cache
+from . import alarmstore
+from . import scheduler
+from . import output
 from . import config
 from . import plugin
-from . import fmiapi
-from . import userconf
-from imp import reload
-# In case we're being reloaded.
+try:
+    from importlib import reload
+except ImportError:
+    from imp import reload
+# In case we're being reloaded. Modules are reloaded after the modules they
+# import and the plugin last, so that it binds the reloaded classes.
+reload(metrics)
+reload(userconf)
+reload(fmiapi)
+reload(geo)
+reload(cache)
+reload(alarmstore)
+reload(scheduler)
+reload(output)
+# the optional subsystems are imported by the plugin when they are enabled
+for name in ('mailer', 'archive', 'cells', 'tiles', 'feed'):
+    if __name__ + '.' + name in sys.modules:
+        reload(sys.modules[__name__ + '.' + name])
 reload(config)
 reload(plugin)
-reload(fmiapi)
-reload(userconf)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
 
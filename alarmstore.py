@@ -0,0 +1,73 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import json
+import threading
+from collections import OrderedDict
+
+class AlarmStore(object):
+    """
+    Alarms indexed by nick, loaded from and persisted to a registry value
+    holding the JSON list of alarms. Changes are written behind: they only
+    mark the store dirty and flush() serializes the whole list once.
+    """
+    def __init__(self, value):
+        self.value = value
+        self.lock = threading.Lock()
+        self.alarms = OrderedDict((alarm['user'], alarm) for alarm in json.loads(value()))
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.alarms)
+
+    def __contains__(self, user):
+        return user in self.alarms
+
+    def get(self, user):
+        with self.lock:
+            alarm = self.alarms.get(user)
+            return dict(alarm) if alarm is not None else None
+
+    def all(self):
+        with self.lock:
+            return [dict(alarm) for alarm in self.alarms.values()]
+
+    def add(self, alarm):
+        with self.lock:
+            self.alarms[alarm['user']] = dict(alarm)
+            self.dirty = True
+
+    def remove(self, user):
+        with self.lock:
+            if self.alarms.pop(user, None) is None:
+                return False
+            self.dirty = True
+            return True
+
+    def update(self, user, **fields):
+        with self.lock:
+            alarm = self.alarms.get(user)
+            if alarm is None:
+                return False
+            alarm.update(fields)
+            self.dirty = True
+            return True
+
+    def discard(self, user, field):
+        with self.lock:
+            alarm = self.alarms.get(user)
+            if alarm is None or alarm.pop(field, None) is None:
+                return False
+            self.dirty = True
+            return True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(list(self.alarms.values()))
+            self.dirty = False
+        self.value.setValue(data)
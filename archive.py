@@ -0,0 +1,219 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .fmiapi import StrikeRecords
+
+# time, lat, lon, multiplicity, current, cloud, ellipse
+RECORD = struct.Struct('<IffBfBf')
+# min and max time of a block of BLOCK records
+INDEX = struct.Struct('<II')
+BLOCK = 1024
+# appended strikes within DEDUP seconds of the newest archived one are
+# checked against the archived ones, older ones are late observations
+DEDUP = 3600
+
+def day_of(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+class DayFile(object):
+    """
+    One day of the archive: fixed width strike records in arrival order and
+    a sidecar holding the time span of every full block of records. Strikes
+    arrive mostly but not strictly in time order, so a lookup reads the
+    blocks whose span overlaps the requested time range. Strikes already
+    in the file, such as the ones a restarted feed fetches again, are not
+    appended twice.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.indexPath = path[:-len('.strikes')] + '.index'
+        self.spans = []
+        self.lastMin = self.lastMax = None
+        self.count = 0
+        self.newest = None
+        # time, lat, lon of the records within DEDUP of the newest, read on
+        # the first append
+        self.keys = None
+        if os.path.exists(path):
+            self._recover()
+
+    def _recover(self):
+        # a partial record or block span left behind by a crash is dropped
+        size = os.path.getsize(self.path)
+        self.count = size // RECORD.size
+        if size % RECORD.size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.count * RECORD.size)
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, 'rb') as f:
+                data = f.read()
+            self.spans = [INDEX.unpack_from(data, offset)
+                          for offset in range(0, len(data) - len(data) % INDEX.size, INDEX.size)]
+        full = self.count // BLOCK
+        if len(self.spans) != full:
+            self.spans = self.spans[:full]
+            for block in range(len(self.spans), full):
+                times = [row[0] for row in self._rows(block * BLOCK, (block + 1) * BLOCK)]
+                self.spans.append((min(times), max(times)))
+            with open(self.indexPath, 'wb') as f:
+                for span in self.spans:
+                    f.write(INDEX.pack(*span))
+        times = [row[0] for row in self._rows(full * BLOCK, self.count)]
+        if times:
+            self.lastMin, self.lastMax = min(times), max(times)
+        highs = [high for low, high in self.spans]
+        if self.lastMax is not None:
+            highs.append(self.lastMax)
+        if highs:
+            self.newest = max(highs)
+
+    def _rows(self, start, stop):
+        if start >= stop:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(start * RECORD.size)
+            return list(RECORD.iter_unpack(f.read((stop - start) * RECORD.size)))
+
+    def _recentKeys(self):
+        if self.keys is None:
+            self.keys = set()
+            if self.newest is not None:
+                since = self.newest - DEDUP
+                for start, stop in self.blocks(since, self.newest):
+                    self.keys.update(row[:3] for row in self._rows(start, stop) if row[0] >= since)
+        return self.keys
+
+    def append(self, rows):
+        """Appends the rows not in the file yet and returns their number."""
+        keys = self._recentKeys()
+        data = bytearray()
+        spans = []
+        appended = 0
+        for row in rows:
+            record = RECORD.pack(*row)
+            # compared as stored, in single precision
+            key = RECORD.unpack(record)[:3]
+            t = row[0]
+            if key in keys:
+                continue
+            if self.newest is None or t >= self.newest - DEDUP:
+                keys.add(key)
+            data += record
+            appended += 1
+            self.newest = t if self.newest is None else max(self.newest, t)
+            self.lastMin = t if self.lastMin is None else min(self.lastMin, t)
+            self.lastMax = t if self.lastMax is None else max(self.lastMax, t)
+            self.count += 1
+            if self.count % BLOCK == 0:
+                spans.append((self.lastMin, self.lastMax))
+                self.lastMin = self.lastMax = None
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        if spans:
+            with open(self.indexPath, 'ab') as f:
+                for span in spans:
+                    f.write(INDEX.pack(*span))
+            self.spans.extend(spans)
+        if keys and min(keys)[0] < self.newest - DEDUP:
+            self.keys = set(key for key in keys if key[0] >= self.newest - DEDUP)
+        return appended
+
+    def blocks(self, start, end):
+        """Record ranges which may hold strikes between start and end."""
+        ranges = [(i * BLOCK, (i + 1) * BLOCK) for i, (low, high) in enumerate(self.spans)
+                  if low <= end and high >= start]
+        if self.lastMin is not None and self.lastMin <= end and self.lastMax >= start:
+            ranges.append((len(self.spans) * BLOCK, self.count))
+        return ranges
+
+class StrikeArchive(object):
+    """
+    Append-only strike archive in directory, one file per UTC day. Records
+    are read back through a memory map, block by block, so a lookup only
+    touches the pages of the blocks overlapping its time range.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.days = {}
+        self.lock = threading.Lock()
+
+    def _day(self, day):
+        if day not in self.days:
+            self.days[day] = DayFile(os.path.join(self.directory, day + '.strikes'))
+        return self.days[day]
+
+    def append(self, strikes):
+        """
+        Appends the StrikeRecords not archived yet to the files of their days
+        and returns their number.
+        """
+        byDay = {}
+        for i in range(len(strikes)):
+            byDay.setdefault(day_of(strikes.time[i]), []).append(
+                (int(strikes.time[i]), strikes.lat[i], strikes.lon[i], int(strikes.multiplicity[i]),
+                 strikes.current[i], int(strikes.cloud[i]), strikes.ellipse[i]))
+        with self.lock:
+            return sum(self._day(day).append(byDay[day]) for day in sorted(byDay))
+
+    def __len__(self):
+        with self.lock:
+            return sum(self._day(name[:-len('.strikes')]).count for name in os.listdir(self.directory)
+                       if name.endswith('.strikes'))
+
+    def query(self, starttime, endtime=None, bbox=None):
+        """
+        StrikeRecords between starttime and endtime (unix seconds, inclusive,
+        endtime defaults to now) inside bbox if given, in time order.
+        """
+        endtime = time.time() if endtime is None else endtime
+        strikes = StrikeRecords()
+        columns = [getattr(strikes, name) for name in ('time', 'lat', 'lon') + StrikeRecords.fields]
+        rows = []
+        day = datetime.utcfromtimestamp(starttime).replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= datetime.utcfromtimestamp(endtime):
+            name = day.strftime('%Y-%m-%d')
+            day += timedelta(days=1)
+            if not os.path.exists(os.path.join(self.directory, name + '.strikes')):
+                continue
+            with self.lock:
+                dayFile = self._day(name)
+                ranges = dayFile.blocks(starttime, endtime)
+                count = dayFile.count
+            if ranges:
+                rows.extend(self._read(dayFile.path, ranges, count, starttime, endtime, bbox))
+        rows.sort(key=lambda row: row[0])
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        return strikes
+
+    def _read(self, path, ranges, count, starttime, endtime, bbox):
+        rows = []
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(data) as view:
+                for start, stop in ranges:
+                    with view[start * RECORD.size:stop * RECORD.size] as block:
+                        for row in RECORD.iter_unpack(block):
+                            if not starttime <= row[0] <= endtime:
+                                continue
+                            if bbox is not None and not (bbox.bottom <= row[1] <= bbox.top and
+                                                         bbox.left <= row[2] <= bbox.right):
+                                continue
+                            rows.append(row)
+        finally:
+            data.close()
+        return rows
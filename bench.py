@@ -0,0 +1,330 @@
+#!/usr/bin/python
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+"""
+Benchmarks for the fetch-parse-evaluate pipeline. Everything runs offline
+against synthetic FMI responses served by a local stand-in WFS server. Run
+it from the directory holding the plugin:
+
+    python -m LightningDetector.bench [--quick] [--json results.json]
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import timeit
+import xml.etree.ElementTree as ET
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+
+from .fmiapi import FMIOpenData, BoundingBox, decode_block
+from .geo import strike_statistics
+
+FINLAND = BoundingBox.fromEdges(20.0, 60.0, 31.0, 69.5)
+NS = {'gml':    'http://www.opengis.net/gml/3.2',
+      'gmlcov': 'http://www.opengis.net/gmlcov/1.0'}
+
+def coverage_xml(rows, stations=()):
+    """
+    Builds a multipointcoverage response of (lat, lon, time, values) rows the
+    way FMI lays it out: all positions first, then all data tuples. stations
+    are (name, region, lat, lon) tuples described like FMI describes the
+    observation stations.
+    """
+    locations = ''.join(
+        '<target:Location gml:id="obsloc-%i"><gml:name codeSpace="http://xml.fmi.fi/namespace/locationcode/name">%s'
+        '</gml:name><gml:name codeSpace="http://xml.fmi.fi/namespace/locationcode/wmo">%i</gml:name>'
+        '<target:representativePoint xlink:href="#point-%i"/>'
+        '<target:region codeSpace="http://xml.fmi.fi/namespace/location/region">%s</target:region>'
+        '</target:Location>\n' % (i, name, 2900 + i, i, region)
+        for i, (name, region, lat, lon) in enumerate(stations))
+    points = ''.join(
+        '<gml:pointMember><gml:Point gml:id="point-%i" srsDimension="2"><gml:name>%s</gml:name>'
+        '<gml:pos>%.5f %.5f </gml:pos></gml:Point></gml:pointMember>\n' % (i, name, lat, lon)
+        for i, (name, region, lat, lon) in enumerate(stations))
+    positions = ''.join('                %.5f %.5f  %d \n' % (lat, lon, t) for lat, lon, t, _ in rows)
+    datas = ''.join('                %s \n' % ' '.join('%.1f' % value for value in values) for _, _, _, values in rows)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+        'xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:gmlcov="http://www.opengis.net/gmlcov/1.0" '
+        'xmlns:target="http://xml.fmi.fi/namespace/om/2.0" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+        '<wfs:member><gmlcov:MultiPointCoverage><target:LocationCollection>\n' + locations +
+        '</target:LocationCollection><gml:MultiPoint>\n' + points + '</gml:MultiPoint><gml:domainSet><gmlcov:SimpleMultiPoint>'
+        '<gmlcov:positions>\n' + positions + '</gmlcov:positions></gmlcov:SimpleMultiPoint></gml:domainSet>\n'
+        '<gml:rangeSet><gml:DataBlock><gml:doubleOrNilReasonTupleList>\n' + datas +
+        '</gml:doubleOrNilReasonTupleList></gml:DataBlock></gml:rangeSet>\n'
+        '</gmlcov:MultiPointCoverage></wfs:member></wfs:FeatureCollection>\n').encode('utf8')
+
+def strike_rows(n, seed=1, region=FINLAND, start=None):
+    """n strikes spread over region during the 30 minutes before start."""
+    rnd = random.Random(seed)
+    start = int(time.time()) if start is None else start
+    rows = [(rnd.uniform(region.bottom, region.top), rnd.uniform(region.left, region.right),
+             start - rnd.randint(0, 29 * 60),
+             (rnd.randint(1, 5), rnd.uniform(-80.0, 80.0), rnd.randint(0, 1), rnd.uniform(0.1, 10.0)))
+            for i in range(n)]
+    rows.sort(key=lambda row: row[2])
+    return rows
+
+def weather_stations(count, seed=1, region=FINLAND):
+    """(name, region, lat, lon) of count stations, each in its own place."""
+    rnd = random.Random(seed)
+    return [('Station %i' % i, 'Place%i' % i, round(rnd.uniform(region.bottom, region.top), 5),
+             round(rnd.uniform(region.left, region.right), 5)) for i in range(count)]
+
+def weather_rows(stations, observations=3, seed=1, start=None):
+    """observations ten minutes apart for each station, some values nil."""
+    rnd = random.Random(seed)
+    start = int(time.time()) if start is None else start
+    rows = []
+    for name, place, lat, lon in stations:
+        for i in range(observations):
+            values = [rnd.uniform(-20.0, 30.0) if rnd.random() > 0.1 else float('nan') for field in range(13)]
+            rows.append((lat, lon, start - 600 * (observations - i), values))
+    return rows
+
+def query_params(body):
+    """The parameters of a query, repeated ones as lists."""
+    params = {}
+    for key, value in parse_qsl(body.decode('utf8')):
+        if key not in params:
+            params[key] = value
+        elif isinstance(params[key], list):
+            params[key].append(value)
+        else:
+            params[key] = [params[key], value]
+    return params
+
+def in_bbox(rows, edges):
+    bbox = BoundingBox.fromString(edges)
+    return [row for row in rows if bbox.bottom <= row[0] <= bbox.top and bbox.left <= row[1] <= bbox.right]
+
+class StandInWFS(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the FMI WFS which counts the connections it accepts.
+    It answers every query with body, or with respond(params) if given. If
+    cut is set, the answer breaks off after cut bytes of its body.
+    """
+    daemon_threads = True
+
+    def __init__(self, body=b'', respond=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.body = body
+        self.respond = respond
+        self.status = 200
+        self.cut = None
+        self.connections = 0
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i/wfs' % self.server_address[1]
+
+    def get_request(self):
+        request = HTTPServer.get_request(self)
+        self.connections += 1
+        return request
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body leave in separate writes, which would otherwise wait
+    # for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(request)
+        if self.server.respond is not None:
+            body = self.server.respond(query_params(request))
+        else:
+            body = self.server.body
+        self.send_response(self.server.status)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.cut is not None:
+            self.wfile.write(body[:self.server.cut])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def report(results, name, func, repeat=3):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    results[name] = best
+    print('%-50s %10.1f ms' % (name, best * 1000))
+    return best
+
+def tree_query(fmi, query, params):
+    """
+    Position and data rows of an answer the way FMIOpenData got them before
+    CoverageParser: the whole answer parsed into an ElementTree and its
+    blocks split line by line.
+    """
+    f = fmi._open(query, params)
+    try:
+        root = ET.fromstring(f.read())
+    finally:
+        f.close()
+    positions = root.find('*//gmlcov:positions', NS)
+    datas = root.find('*//gml:doubleOrNilReasonTupleList', NS)
+    if positions is None or datas is None:
+        return []
+    positions = [line.split() for line in positions.text.split('\n')]
+    datas = [line.split() for line in datas.text.split('\n')]
+    return list(zip(filter(bool, positions), filter(bool, datas)))
+
+def split_and_float(positions, datas):
+    # the way tree_query and getStrikes used to decode the blocks line by line
+    positions = [line.split() for line in positions.split('\n')]
+    datas = [line.split() for line in datas.split('\n')]
+    rows = []
+    for pos, data in zip(filter(bool, positions), filter(bool, datas)):
+        rows.append((float(pos[0]), float(pos[1]), float(pos[2]),
+                     int(float(data[0])), float(data[1]), bool(float(data[2])), float(data[3])))
+    return rows
+
+def bench_decode(results, n):
+    rows = strike_rows(n)
+    positions = ''.join('%.5f %.5f  %d \n' % (lat, lon, t) for lat, lon, t, _ in rows)
+    datas = ''.join('%d %.1f %d %.1f \n' % values for _, _, _, values in rows)
+    print('\nDecoding %i strikes (%i kB of text)' % (n, (len(positions) + len(datas)) // 1024))
+    old = report(results, 'decode %i: split and float' % n, lambda: split_and_float(positions, datas))
+    new = report(results, 'decode %i: decode_block' % n, lambda: (decode_block(positions, 3), decode_block(datas, 4)))
+    print('speedup %.1fx' % (old / new))
+
+def bench_parse(results, sizes):
+    print('\nParsing strike responses through the stand-in server')
+    for n in sizes:
+        server = StandInWFS(coverage_xml(strike_rows(n)))
+        fmi = FMIOpenData('key', url=server.url)
+        query = 'fmi::observations::lightning::multipointcoverage'
+        try:
+            report(results, '%i strikes: ElementTree' % n, lambda: tree_query(fmi, query, {}))
+            report(results, '%i strikes: getStrikesInBox (dicts)' % n, lambda: fmi.getStrikesInBox(FINLAND))
+            report(results, '%i strikes: getStrikeRecords (columns)' % n, lambda: fmi.getStrikeRecords(FINLAND))
+        finally:
+            fmi.close()
+            server.stop()
+
+def bench_weather(results, stations):
+    print('\nParsing a weather response of %i stations' % stations)
+    server = StandInWFS(coverage_xml(weather_rows(weather_stations(stations))))
+    fmi = FMIOpenData('key', url=server.url)
+    try:
+        report(results, '%i stations: getWeather (dicts)' % stations, lambda: fmi.getWeather('finland'))
+        report(results, '%i stations: getWeatherRecords (columns)' % stations, lambda: fmi.getWeatherRecords('finland'))
+    finally:
+        fmi.close()
+        server.stop()
+
+def bench_weather_batch(results, count):
+    print('\nWeather of %i places' % count)
+    stations = weather_stations(count)
+    def respond(params):
+        places = params['place'] if isinstance(params['place'], list) else [params['place']]
+        found = [station for station in stations if station[1] in places]
+        return coverage_xml(weather_rows(found), found)
+    server = StandInWFS(respond=respond)
+    fmi = FMIOpenData('key', url=server.url)
+    places = [station[1] for station in stations]
+    try:
+        report(results, '%i places: getWeather one by one' % count,
+               lambda: [fmi.getWeather(place)[-1] for place in places])
+        report(results, '%i places: getLatestWeather' % count, lambda: fmi.getLatestWeather(places))
+    finally:
+        fmi.close()
+        server.stop()
+
+def bench_statistics(results, sizes):
+    print('\nStrike statistics for one alarm')
+    for n in sizes:
+        strikes = list(zip(*[(lat, lon, values[1], values[2]) for lat, lon, t, values in strike_rows(n)]))
+        report(results, 'statistics over %i strikes' % n, lambda: strike_statistics(64.0, 25.5, *strikes))
+
+def bench_cycle(results, strikes, alarm_counts):
+    """End-to-end evaluation of due alarms with AlarmThread.evaluateAlarms."""
+    from .plugin import LightningDetector, format_alert
+    from .cache import StrikeCache
+
+    rows = strike_rows(strikes)
+    server = StandInWFS(respond=lambda params: coverage_xml(in_bbox(rows, params['bbox'])))
+    fmi = FMIOpenData('key', url=server.url)
+    print('\nAlarm cycle over %i strikes' % strikes)
+    try:
+        for count in alarm_counts:
+            rnd = random.Random(count)
+            alarms = [{'user': 'user%i' % i, 'channel': '#bench',
+                       'lat': rnd.uniform(FINLAND.bottom, FINLAND.top), 'lon': rnd.uniform(FINLAND.left, FINLAND.right),
+                       'radius': rnd.choice([10, 30, 50, 100]), 'next_alarm': 0} for i in range(count)]
+
+            def cycle():
+                # a fresh cache so that every round pays for its queries
+                thread = LightningDetector.AlarmThread(None, StrikeCache(fmi, max_age=0), None, None, None)
+                try:
+                    for stats in thread.evaluateAlarms(alarms):
+                        if stats and stats['count']:
+                            format_alert(stats)
+                finally:
+                    thread.stop()
+
+            before = len(server.requests)
+            report(results, '%i alarms: cycle' % count, cycle)
+            print('%50s %10i' % ('requests per cycle', (len(server.requests) - before) // 3))
+    finally:
+        fmi.close()
+        server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the LightningDetector pipeline')
+    parser.add_argument('--quick', action='store_true', help='skip the largest fixtures')
+    parser.add_argument('--json', metavar='FILE', help='write the timings to FILE as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    if args.quick:
+        bench_decode(results, 10000)
+        bench_parse(results, [0, 100, 10000])
+        bench_weather(results, 50)
+        bench_weather_batch(results, 5)
+        bench_statistics(results, [100, 10000])
+        bench_cycle(results, 10000, [10, 1000])
+    else:
+        bench_decode(results, 50000)
+        bench_parse(results, [0, 100, 10000, 100000])
+        bench_weather(results, 500)
+        bench_weather_batch(results, 5)
+        bench_weather_batch(results, 50)
+        bench_statistics(results, [100, 10000, 100000])
+        bench_cycle(results, 10000, [10, 1000, 10000])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from .fmiapi import StrikeRecords, normalize_place
+
+def isoformat(t):
+    return datetime.utcfromtimestamp(int(t)).isoformat()
+
+class Region(object):
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.strikes = StrikeRecords()
+        self.keys = set()
+        self.fetched = 0
+        # start of the time span fetched, None before the first fetch
+        self.since = None
+
+    def covers(self, bbox):
+        return (self.bbox.left <= bbox.left and self.bbox.right >= bbox.right and
+                self.bbox.bottom <= bbox.bottom and self.bbox.top >= bbox.top)
+
+    def add(self, strikes):
+        fresh = []
+        for i in range(len(strikes)):
+            key = (strikes.time[i], strikes.lat[i], strikes.lon[i])
+            if key not in self.keys:
+                self.keys.add(key)
+                fresh.append(i)
+        self.strikes.merge(strikes, fresh)
+
+    def evict(self, cutoff):
+        strikes = self.strikes
+        keep = [i for i in range(len(strikes)) if strikes.time[i] >= cutoff]
+        if len(keep) < len(strikes):
+            self.strikes = strikes.take(keep)
+            self.keys = set((strikes.time[i], strikes.lat[i], strikes.lon[i]) for i in keep)
+
+    def select(self, bbox, since):
+        strikes = self.strikes
+        return strikes.take([i for i in range(len(strikes)) if strikes.time[i] >= since and
+                             bbox.bottom <= strikes.lat[i] <= bbox.top and
+                             bbox.left <= strikes.lon[i] <= bbox.right])
+
+class StrikeCache(object):
+    """
+    Remembers the strikes fetched per region. A region inside one fetched
+    less than max_age seconds ago is served from memory, otherwise only the
+    strikes since the previous fetch of the covering region are requested.
+    A window reaching further back than the region was fetched for also
+    fetches the strikes between the two. The delta overlaps the previous fetch by overlap seconds to pick up
+    late observations, which are deduplicated by time and position.
+    Observations older than the largest window asked for are evicted.
+    Fetched strikes are also added to tiles if one is given. If a fetch
+    fails, FMIError is raised and the region is left as it was, so the
+    next fetch still asks for everything since the last successful one.
+    """
+    def __init__(self, fmi, max_age=60, overlap=300, tiles=None):
+        self.fmi = fmi
+        self.tiles = tiles
+        self.max_age = max_age
+        self.overlap = overlap
+        self.window = 0
+        self.regions = {}
+        self.lock = threading.Lock()
+
+    def _find(self, bbox):
+        region = self.regions.get(str(bbox))
+        if region is None:
+            covering = [r for r in self.regions.values() if r.covers(bbox)]
+            if covering:
+                region = min(covering, key=lambda r: r.bbox.area())
+        return region
+
+    def getStrikes(self, bbox, minutes=30):
+        now = time.time()
+        with self.lock:
+            self.window = max(self.window, minutes * 60)
+            for key, region in list(self.regions.items()):
+                if now - region.fetched > self.window:
+                    del self.regions[key]
+
+            since = now - minutes * 60
+            region = self._find(bbox)
+            if region is None:
+                region = Region(bbox)
+            stale = now - region.fetched > self.max_age
+            wider = region.since is not None and since < region.since
+            if not stale and not wider:
+                return region.select(bbox, since)
+            start = max(region.fetched - self.overlap, now - self.window)
+            end = region.since
+
+        fetched = []
+        if stale:
+            fetched.append(self.fmi.getStrikeRecords(region.bbox, isoformat(start)))
+        if wider:
+            # the older part of the window, overlapping what the region has
+            fetched.append(self.fmi.getStrikeRecords(region.bbox, isoformat(since),
+                                                     isoformat(end + self.overlap)))
+        if self.tiles is not None:
+            for strikes in fetched:
+                self.tiles.add(strikes)
+
+        with self.lock:
+            for strikes in fetched:
+                region.add(strikes)
+            region.evict(now - self.window)
+            if stale:
+                region.fetched = now
+                region.since = start if region.since is None else min(region.since, start)
+            if wider:
+                region.since = since
+            self.regions[str(region.bbox)] = region
+            return region.select(bbox, since)
+
+    def warmFrom(self, other):
+        """Takes over the regions fetched by other, a cache being discarded."""
+        with other.lock:
+            regions = list(other.regions.values())
+            window = other.window
+        with self.lock:
+            self.window = max(self.window, window)
+            for old in regions:
+                # copied into the classes of this instance in case they were reloaded
+                region = Region(old.bbox)
+                region.add(old.strikes)
+                region.fetched = old.fetched
+                # regions of an instance from before since was kept
+                region.since = getattr(old, 'since', old.fetched - window)
+                self.regions[str(region.bbox)] = region
+
+class WeatherCache(object):
+    """
+    LRU cache with expiry in front of FMIOpenData.getWeather, keyed by the
+    normalized place name. Places without observations are remembered for
+    negative_ttl seconds so that typos do not hit FMI on every request.
+    """
+    def __init__(self, fmi, size=64, ttl=600, negative_ttl=60):
+        self.fmi = fmi
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def getWeather(self, place):
+        key = normalize_place(place)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now < entry[0]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        weathers = self.fmi.getWeather(place)
+
+        with self.lock:
+            self._store(key, weathers, now)
+        return weathers
+
+    def getLatest(self, places):
+        """
+        Latest observation of each place like FMIOpenData.getLatestWeather.
+        The places missing from the cache are fetched in one request. If
+        it fails, FMIError is raised and nothing is cached.
+        """
+        now = time.time()
+        latest = {}
+        missing = []
+        with self.lock:
+            for place in places:
+                entry = self.entries.get(normalize_place(place))
+                if entry is not None and now < entry[0]:
+                    self.entries.move_to_end(normalize_place(place))
+                    self.hits += 1
+                    latest[place] = entry[1][-1] if len(entry[1]) else None
+                else:
+                    self.misses += 1
+                    missing.append(place)
+
+        if missing:
+            fetched = self.fmi.getLatestWeather(missing)
+            with self.lock:
+                for place in missing:
+                    latest[place] = fetched.get(place)
+                    self._store(normalize_place(place), [latest[place]] if latest[place] else [], now)
+        return latest
+
+    def warmFrom(self, other):
+        """Takes over the unexpired entries of other, a cache being discarded."""
+        now = time.time()
+        with other.lock:
+            entries = [(key, entry) for key, entry in other.entries.items() if now < entry[0]]
+        with self.lock:
+            for key, entry in entries:
+                self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _store(self, key, weathers, now):
+        expires = now + (self.ttl if len(weathers) else self.negative_ttl)
+        self.entries[key] = (expires, weathers)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,329 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import itertools
+import math
+import threading
+from collections import deque
+
+KM_PER_DEG = 110.5
+# grid cell offsets within two cells, the ones which can hold points closer
+# than eps to a point of the centre cell
+NEIGHBOURS = [(dy, dx) for dy in range(-2, 3) for dx in range(-2, 3) if abs(dy) + abs(dx) < 4]
+
+def project(lat, lon, lon0):
+    # sinusoidal projection about the meridian lon0, true to scale at every
+    # latitude; the shear between rows grows with the distance from lon0 but
+    # stays under a kilometre per 10 km of latitude within 5 degrees of it
+    return KM_PER_DEG * (lon - lon0) * math.cos(math.radians(lat)), KM_PER_DEG * lat
+
+def offset(lat, lon, lat0, lon0):
+    """km east and north from (lat0, lon0) to (lat, lon) nearby."""
+    return (KM_PER_DEG * (lon - lon0) * math.cos(math.radians((lat + lat0) / 2)),
+            KM_PER_DEG * (lat - lat0))
+
+class GridCell(object):
+    __slots__ = ('key', 'points', 'cores', 'parent')
+
+    def __init__(self, key):
+        self.key = key
+        self.points = deque()
+        self.cores = 0
+        self.parent = self
+
+class Track(object):
+    """Storm cell followed from one clustering to the next."""
+    def __init__(self, id):
+        self.id = id
+        self.history = deque()
+        self.count = 0
+        self.lat = self.lon = None
+        self.extent = 0.0
+        self.velocity = None
+
+    def speed(self):
+        """km/h, None while the track is too short."""
+        if self.velocity is None:
+            return None
+        return math.hypot(*self.velocity)
+
+    def heading(self):
+        """Radians counter-clockwise from east like gpsbearing."""
+        if self.velocity is None:
+            return None
+        return math.atan2(self.velocity[1], self.velocity[0])
+
+class CellTracker(object):
+    """
+    Incremental grid DBSCAN over the strike stream. Strikes go into a grid
+    of eps/sqrt(2) km cells, so that all strikes of a grid cell are
+    neighbours, and a strike is a core strike once min_strikes strikes lie
+    within eps km of it. Grid cells holding core strikes are joined in a
+    union-find when two of their core strikes are neighbours; a storm cell
+    is a component of at least min_cell strikes. Unions only grow as strikes
+    arrive, strikes older than window seconds are dropped and the union-find
+    is rebuilt every rebuild seconds so that dissipated cells can split.
+    Strikes are projected about a meridian through them, which the rebuild
+    moves to their mean longitude.
+
+    After every batch the storm cells are matched to the tracks of the
+    previous clustering by their shared strikes. The centroid of the strikes
+    of the last recent seconds is appended to the history of a track, and
+    the velocity of the track is the least squares fit of its history over
+    the last history seconds.
+    """
+    def __init__(self, eps_km=10.0, min_strikes=4, min_cell=10, window=900, recent=300,
+                 history=1800, rebuild=300):
+        self.eps = eps_km
+        self.eps2 = eps_km * eps_km
+        self.side = eps_km / math.sqrt(2)
+        self.min_strikes = min_strikes
+        self.min_cell = min_cell
+        self.window = window
+        self.recent = recent
+        self.history = history
+        self.rebuild = rebuild
+        self.grid = {}
+        self.lon0 = None
+        self.now = None
+        self.rebuilt = None
+        self.tracks = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(cell.points) for cell in self.grid.values())
+
+    def _find(self, cell):
+        while cell.parent is not cell:
+            cell.parent = cell.parent.parent
+            cell = cell.parent
+        return cell
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a is not b:
+            b.parent = a
+
+    def _neighbourCells(self, key):
+        grid = self.grid
+        row, col = key
+        return [cell for cell in (grid.get((row + dy, col + dx)) for dy, dx in NEIGHBOURS)
+                if cell is not None]
+
+    def add(self, strikes):
+        """Clusters StrikeRecords into the storm cells and updates the tracks."""
+        with self.lock:
+            for i in sorted(range(len(strikes)), key=strikes.time.__getitem__):
+                t = strikes.time[i]
+                if self.now is None or t > self.now:
+                    self.now = t
+                self._insert(t, strikes.lat[i], strikes.lon[i], strikes.current[i])
+            if self.now is None:
+                return
+            if self.rebuilt is None:
+                self.rebuilt = self.now
+            elif self.now - self.rebuilt >= self.rebuild:
+                self._rebuild()
+            self._track()
+
+    def _key(self, x, y):
+        return (int(math.floor(y / self.side)), int(math.floor(x / self.side)))
+
+    def _insert(self, t, lat, lon, current):
+        if self.lon0 is None:
+            self.lon0 = lon
+        x, y = project(lat, lon, self.lon0)
+        key = self._key(x, y)
+        cell = self.grid.get(key)
+        if cell is None:
+            cell = self.grid[key] = GridCell(key)
+        # time, x, y, lat, lon, current, neighbours, core, track
+        point = [t, x, y, lat, lon, current, 1, False, None]
+        cell.points.append(point)
+        self._connect(cell, point)
+
+    def _reach(self, cell, x, y):
+        """
+        None if no point of cell can be within eps of (x, y), True if all
+        of them are and False otherwise.
+        """
+        side = self.side
+        bottom, left = cell.key[0] * side, cell.key[1] * side
+        near_y = bottom - y if y < bottom else max(0.0, y - bottom - side)
+        near_x = left - x if x < left else max(0.0, x - left - side)
+        if near_y * near_y + near_x * near_x > self.eps2:
+            return None
+        far_y = max(y - bottom, bottom + side - y)
+        far_x = max(x - left, left + side - x)
+        return far_y * far_y + far_x * far_x <= self.eps2
+
+    def _connect(self, cell, point):
+        x, y = point[1], point[2]
+        eps2, min_strikes = self.eps2, self.min_strikes
+        neighbours = self._neighbourCells(cell.key)
+        # the whole grid cell is within eps of the new strike, so in a dense
+        # grid cell it is a core strike without counting its neighbours
+        dense = len(cell.points) >= min_strikes
+        for other_cell in neighbours:
+            if dense and len(other_cell.points) >= min_strikes:
+                # core strikes already
+                continue
+            inside = self._reach(other_cell, x, y)
+            if inside is None:
+                continue
+            if len(other_cell.points) >= min_strikes:
+                if inside:
+                    point[6] += len(other_cell.points)
+                    continue
+                for other in other_cell.points:
+                    if (other[1] - x) ** 2 + (other[2] - y) ** 2 <= eps2:
+                        point[6] += 1
+                        if point[6] >= min_strikes:
+                            break
+                continue
+            for other in other_cell.points:
+                if other is not point and (inside or (other[1] - x) ** 2 + (other[2] - y) ** 2 <= eps2):
+                    point[6] += 1
+                    other[6] += 1
+                    if not other[7] and other[6] >= min_strikes:
+                        self._promote(other_cell, other)
+        if dense and cell.cores == len(cell.points) - 1:
+            self._promote(cell, point, neighbours)
+        elif dense:
+            for other in cell.points:
+                if not other[7]:
+                    self._promote(cell, other, neighbours)
+        elif point[6] >= min_strikes:
+            self._promote(cell, point, neighbours)
+
+    def _promote(self, cell, point, neighbours=None):
+        point[7] = True
+        cell.cores += 1
+        root = self._find(cell)
+        x, y = point[1], point[2]
+        for other_cell in neighbours or self._neighbourCells(cell.key):
+            if other_cell is cell or not other_cell.cores or self._find(other_cell) is root:
+                continue
+            inside = self._reach(other_cell, x, y)
+            if inside is None:
+                continue
+            for other in other_cell.points:
+                if other[7] and (inside or (other[1] - x) ** 2 + (other[2] - y) ** 2 <= self.eps2):
+                    self._union(cell, other_cell)
+                    root = self._find(cell)
+                    break
+
+    def _rebuild(self):
+        since = self.now - self.window
+        points = []
+        for cell in self.grid.values():
+            points.extend(point for point in cell.points if point[0] >= since)
+        self.grid = {}
+        if points:
+            self.lon0 = sum(point[4] for point in points) / len(points)
+        points.sort(key=lambda point: point[0])
+        for point in points:
+            point[1], point[2] = project(point[3], point[4], self.lon0)
+            key = self._key(point[1], point[2])
+            cell = self.grid.get(key)
+            if cell is None:
+                cell = self.grid[key] = GridCell(key)
+            point[6], point[7] = 1, False
+            cell.points.append(point)
+            self._connect(cell, point)
+        self.rebuilt = self.now
+
+    def clusters(self):
+        """Lists of the unexpired strikes of every storm cell."""
+        since = self.now - self.window
+        components = {}
+        for key, cell in list(self.grid.items()):
+            # strikes arrive in about time order, the expired ones first
+            while cell.points and cell.points[0][0] < since:
+                cell.points.popleft()
+            if not cell.points:
+                del self.grid[key]
+            elif cell.cores:
+                components.setdefault(id(self._find(cell)), []).extend(cell.points)
+        return [points for points in components.values() if len(points) >= self.min_cell]
+
+    def _track(self):
+        clusters = sorted(self.clusters(), key=len, reverse=True)
+        tracks = {}
+        for points in clusters:
+            # the biggest storm cell inherits a track when cells merge
+            votes = {}
+            for point in points:
+                if point[8] is not None and point[8] in self.tracks and point[8] not in tracks:
+                    votes[point[8]] = votes.get(point[8], 0) + 1
+            if votes:
+                track = self.tracks[max(votes, key=votes.get)]
+            else:
+                track = Track(next(self.ids))
+            tracks[track.id] = track
+            for point in points:
+                point[8] = track.id
+            self._follow(track, points)
+        self.tracks = tracks
+
+    def _follow(self, track, points):
+        recent = [point for point in points if point[0] >= self.now - self.recent]
+        if len(recent) < self.min_strikes:
+            recent = points
+        track.count = len(points)
+        track.lat = sum(point[3] for point in recent) / len(recent)
+        track.lon = sum(point[4] for point in recent) / len(recent)
+        x, y = project(track.lat, track.lon, self.lon0)
+        track.extent = math.sqrt(sum((point[1] - x) ** 2 + (point[2] - y) ** 2 for point in recent) / len(recent))
+
+        track.history.append((self.now, track.lat, track.lon))
+        while track.history and track.history[0][0] < self.now - self.history:
+            track.history.popleft()
+        track.velocity = None
+        if len(track.history) >= 3 and track.history[-1][0] - track.history[0][0] >= self.recent:
+            # km offsets from the latest centroid against hours
+            samples = [((t - self.now) / 3600.0,) + offset(lat, lon, track.lat, track.lon)
+                       for t, lat, lon in track.history]
+            mean_t = sum(s[0] for s in samples) / len(samples)
+            var_t = sum((s[0] - mean_t) ** 2 for s in samples)
+            if var_t > 0:
+                track.velocity = tuple(sum((s[0] - mean_t) * s[k] for s in samples) / var_t for k in (1, 2))
+
+    def cells(self):
+        with self.lock:
+            return sorted(self.tracks.values(), key=lambda track: track.id)
+
+    def approaching(self, lat, lon, radius_km, horizon=3600, min_speed=5.0):
+        """
+        (track, distance_km, bearing, eta_seconds) of the storm cells outside
+        radius_km of (lat, lon) which move so that they reach it within
+        horizon seconds, the soonest first. The bearing from (lat, lon) to
+        the cell is in radians counter-clockwise from east.
+        """
+        found = []
+        for track in self.cells():
+            speed = track.speed()
+            if speed is None or speed < min_speed:
+                continue
+            # the point relative to the centroid, in km
+            dx, dy = offset(lat, lon, track.lat, track.lon)
+            distance = math.hypot(dx, dy)
+            reach = radius_km + track.extent
+            if distance <= reach:
+                continue
+            vx, vy = track.velocity
+            hours = (dx * vx + dy * vy) / (speed * speed)
+            if hours <= 0:
+                continue
+            if math.hypot(dx - vx * hours, dy - vy * hours) > reach:
+                continue
+            # when the edge of the cell reaches the circle
+            eta = hours - math.sqrt(max(0.0, reach ** 2 - math.hypot(dx - vx * hours, dy - vy * hours) ** 2)) / speed
+            if eta * 3600 <= horizon:
+                found.append((track, distance, math.atan2(-dy, -dx), max(0.0, eta * 3600)))
+        found.sort(key=lambda item: item[3])
+        return found
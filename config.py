@@ -35,4 +35,118 @@ conf.registerGlobalValue(LightningDetector, 'alarms',
     registry.String('[]', _("""JSON-formatted alarms. Do not edit this
     configuration variable unless you know what you are doing.""")))
 
+conf.registerGlobalValue(LightningDetector, 'checkInterval',
+    registry.PositiveInteger(20, _("""Default number of minutes between the
+    checks of an alarm. Users can override it with the alarmtiming
+    command.""")))
+
+conf.registerGlobalValue(LightningDetector, 'blockingPeriod',
+    registry.PositiveInteger(180, _("""Default number of minutes an alarm stays
+    quiet after alerting its user. Users can override it with the
+    alarmtiming command.""")))
+
+conf.registerGlobalValue(LightningDetector, 'outputRate',
+    registry.PositiveFloat(0.5, _("""Number of alert lines per second the
+    plugin sends to channels in the long run.""")))
+
+conf.registerGlobalValue(LightningDetector, 'outputBurst',
+    registry.PositiveInteger(3, _("""Number of alert lines the plugin may send
+    at once before outputRate applies.""")))
+
+conf.registerGlobalValue(LightningDetector, 'alertMaxAge',
+    registry.PositiveInteger(600, _("""Number of seconds an alert may wait in
+    the output queue before it is dropped as stale.""")))
+
+conf.registerGlobalValue(LightningDetector, 'batchQueries',
+    registry.Boolean(True, _("""Determines whether the strikes for all due
+    alarms are fetched with a few coalesced queries instead of one query per
+    alarm.""")))
+
+conf.registerGlobalValue(LightningDetector, 'coalesceSlack',
+    registry.PositiveFloat(2.0, _("""How much larger than the summed area of
+    its alarms a coalesced query area may grow before alarms are split into
+    separate queries.""")))
+
+conf.registerGlobalValue(LightningDetector, 'poolSize',
+    registry.PositiveInteger(4, _("""Maximum number of simultaneous keep-alive
+    connections to the FMI open data service.""")))
+
+conf.registerGlobalValue(LightningDetector, 'timeout',
+    registry.PositiveFloat(30.0, _("""Timeout in seconds for connecting to and
+    reading from the FMI open data service.""")))
+
+conf.registerGlobalValue(LightningDetector, 'feed',
+    registry.Boolean(False, _("""Determines whether one feed polls the strikes
+    of feedRegion and alarms inside it are evaluated from memory instead of
+    querying FMI per alarm area.""")))
+
+conf.registerGlobalValue(LightningDetector, 'feedRegion',
+    registry.String('19.0,59.0,32.0,70.5', _("""Region polled by the strike
+    feed as left,bottom,right,top in degrees.""")))
+
+conf.registerGlobalValue(LightningDetector, 'feedInterval',
+    registry.PositiveInteger(60, _("""Number of seconds between the polls of the
+    strike feed.""")))
+
+conf.registerGlobalValue(LightningDetector, 'feedCapacity',
+    registry.PositiveInteger(100000, _("""Maximum number of strikes the strike
+    feed keeps in memory.""")))
+
+conf.registerGlobalValue(LightningDetector, 'archiveDirectory',
+    registry.String('', _("""Directory where the strikes polled by the strike
+    feed are archived, one file per day, for the strikehistory command.
+    Nothing is archived while the strike feed is off. Empty disables the
+    archive.""")))
+
+conf.registerGlobalValue(LightningDetector, 'strikeTiles',
+    registry.Boolean(True, _("""Determines whether the fetched strikes are
+    aggregated into strike counts per tile for the strikesnear command.""")))
+
+conf.registerGlobalValue(LightningDetector, 'tileHours',
+    registry.PositiveInteger(6, _("""Number of hours the strike counts
+    aggregated from the fetched strikes are kept for the strikesnear
+    command.""")))
+
+conf.registerGlobalValue(LightningDetector, 'cellTracking',
+    registry.Boolean(False, _("""Determines whether the strikes polled by the
+    strike feed are clustered into storm cells whose movement is tracked,
+    so that alarms are also alerted of cells approaching them.""")))
+
+conf.registerGlobalValue(LightningDetector, 'cellDistance',
+    registry.PositiveFloat(10.0, _("""Distance in kilometres within which
+    strikes are neighbours in the same storm cell.""")))
+
+conf.registerGlobalValue(LightningDetector, 'approachHorizon',
+    registry.PositiveInteger(60, _("""Number of minutes ahead an alarm is
+    alerted of a storm cell approaching it.""")))
+
+conf.registerGlobalValue(LightningDetector, 'startupSpread',
+    registry.NonNegativeInteger(60, _("""Number of seconds over which the
+    checks of the alarms due when the plugin starts are spread, so that a
+    restart does not query the strikes of every alarm at once.""")))
+
+conf.registerGlobalValue(LightningDetector, 'workers',
+    registry.PositiveInteger(4, _("""Number of alarm areas whose strikes are
+    fetched and evaluated concurrently. 1 evaluates them one after
+    another.""")))
+
+conf.registerGlobalValue(LightningDetector, 'strikeCacheAge',
+    registry.NonNegativeInteger(60, _("""Number of seconds fetched strikes of a
+    region are served from memory before only the newer strikes are
+    requested again.""")))
+
+conf.registerGlobalValue(LightningDetector, 'weatherCacheSize',
+    registry.PositiveInteger(64, _("""Number of places whose weather is kept
+    in memory.""")))
+
+conf.registerGlobalValue(LightningDetector, 'weatherCacheTTL',
+    registry.NonNegativeInteger(600, _("""Number of seconds the weather of a
+    place is served from memory. FMI updates the observations every ten
+    minutes.""")))
+
+conf.registerGlobalValue(LightningDetector, 'metricsFile',
+    registry.String('', _("""File the plugin metrics are written to in the
+    Prometheus text format after every alarm round, for the textfile
+    collector of node_exporter. Empty disables it.""")))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,142 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from .fmiapi import FMIError, StrikeRecords
+
+import supybot.log as log
+
+class StrikeFeed(threading.Thread):
+    """
+    Single producer of strikes for a region. Every interval seconds it asks
+    FMI for the strikes since the newest one it has seen, minus overlap
+    seconds for late observations, drops the ones it already has by time and
+    position and appends the rest to a ring buffer of capacity strikes.
+    getStrikes() answers alarm queries inside the region from the buffer and
+    passes the others to fallback. New strikes are also appended to archive
+    and clustered by tracker and aggregated into tiles if they are given.
+    """
+    def __init__(self, fmi, region, fallback, interval=60, capacity=100000, window=30, overlap=300,
+                 archive=None, tracker=None, tiles=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fmi = fmi
+        self.region = region
+        self.fallback = fallback
+        self.interval = interval
+        self.window = window
+        self.overlap = overlap
+        self.archive = archive
+        self.tracker = tracker
+        self.tiles = tiles
+        self.buffer = deque()
+        self.capacity = capacity
+        self.keys = set()
+        self.last = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopEvent = threading.Event()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        log.info('StrikeFeed: starting for %s' % self.region)
+        while not self.stopEvent.is_set():
+            try:
+                self.poll()
+            except FMIError:
+                # logged where the query failed, the next poll catches up
+                pass
+            except Exception:
+                log.exception('StrikeFeed: polling failed')
+            self.stopEvent.wait(self.interval)
+        log.info('StrikeFeed: stopping')
+
+    def warmFrom(self, other):
+        """
+        Takes over the strikes buffered by other, a feed being discarded, if
+        it polled the same region, so that they are not added again.
+        """
+        if str(other.region) != str(self.region):
+            return
+        with other.lock:
+            buffer = list(other.buffer)
+            last = other.last
+        with self.lock:
+            for row in buffer[-self.capacity:]:
+                self.buffer.append(row)
+                self.keys.add(row[:3])
+            self.last = last
+
+    def poll(self):
+        now = time.time()
+        since = now - self.window * 60
+        if self.last is not None:
+            since = max(since, self.last - self.overlap)
+        strikes = self.fmi.getStrikeRecords(self.region, datetime.utcfromtimestamp(int(since)).isoformat())
+        added = self.add(strikes)
+        if self.archive is not None and len(added):
+            self.archive.append(added)
+        if self.tracker is not None and len(added):
+            self.tracker.add(added)
+        if self.tiles is not None and len(added):
+            self.tiles.add(added)
+        self.ready.set()
+        return added
+
+    def add(self, strikes):
+        """Appends the unseen strikes to the buffer and returns them."""
+        added = StrikeRecords()
+        columns = [getattr(strikes, name) for name in ('time', 'lat', 'lon') + StrikeRecords.fields]
+        with self.lock:
+            fresh = []
+            # keep the buffer in time order, late observations excepted
+            for i in sorted(range(len(strikes)), key=strikes.time.__getitem__):
+                key = (strikes.time[i], strikes.lat[i], strikes.lon[i])
+                if key in self.keys:
+                    continue
+                if len(self.buffer) >= self.capacity:
+                    old = self.buffer.popleft()
+                    self.keys.discard(old[:3])
+                self.keys.add(key)
+                self.buffer.append(tuple(column[i] for column in columns))
+                fresh.append(i)
+                if self.last is None or strikes.time[i] > self.last:
+                    self.last = strikes.time[i]
+        added.merge(strikes, fresh)
+        return added
+
+    def covers(self, bbox):
+        return (self.ready.is_set() and
+                self.region.left <= bbox.left and self.region.right >= bbox.right and
+                self.region.bottom <= bbox.bottom and self.region.top >= bbox.top)
+
+    def getStrikes(self, bbox, minutes=30):
+        if not self.covers(bbox):
+            return self.fallback.getStrikes(bbox, minutes)
+
+        since = time.time() - minutes * 60
+        rows = []
+        with self.lock:
+            # late observations are at most overlap seconds out of order
+            for row in reversed(self.buffer):
+                if row[0] < since - self.overlap:
+                    break
+                if (row[0] >= since and bbox.bottom <= row[1] <= bbox.top and
+                        bbox.left <= row[2] <= bbox.right):
+                    rows.append(row)
+
+        strikes = StrikeRecords()
+        columns = [getattr(strikes, name) for name in ('time', 'lat', 'lon') + StrikeRecords.fields]
+        for row in reversed(rows):
+            for column, value in zip(columns, row):
+                column.append(value)
+        return strikes
@@ -3,17 +3,73 @@
 from __future__ import print_function
 from builtins import bytes
 try:
-    from urllib.request import urlopen
-    from urrlib.parse import urlencode
-    from urllib.error import HTTPError
+    from urllib.parse import urlencode, urlsplit
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    import queue
 except ImportError:
     from urllib import urlencode
-    from urllib2 import urlopen
-    from urllib2 import HTTPError
+    from urlparse import urlsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    import Queue as queue
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import xml.etree.ElementTree as ET
+import calendar
+import logging
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+import xml.parsers.expat
+try:
+    from .metrics import registry
+except ImportError:
+    # run as a script
+    from metrics import registry
+
+REQUESTS = registry.counter('fmi_requests_total', 'Queries sent to FMI')
+REQUEST_ERRORS = registry.counter('fmi_request_errors_total', 'Queries which failed or got an HTTP error')
+REQUEST_SECONDS = registry.histogram('fmi_request_seconds', 'Time until FMI answered a query')
+RESPONSE_BYTES = registry.counter('fmi_response_bytes_total', 'Bytes of XML received from FMI')
+PARSE_SECONDS = registry.histogram('fmi_parse_seconds', 'Time spent parsing the XML of one answer')
+
+# a child of the supybot logger, also usable when run without the bot
+log = logging.getLogger('supybot.plugins.LightningDetector')
+
+# survives reloads of the plugin, so that code holding the class catches it
+try:
+    FMIError
+except NameError:
+    class FMIError(Exception):
+        """
+        A query to FMI failed: it could not be sent, FMI answered with an HTTP
+        error, whose code is in status, or the answer broke off or did not
+        parse.
+        """
+        def __init__(self, message, status=None):
+            Exception.__init__(self, message)
+            self.status = status
+
+try:
+    IncompleteRange
+except NameError:
+    class IncompleteRange(FMIError):
+        """
+        Some chunks of a range query failed. strikes holds the strikes of the
+        chunks which did not and missing the (start, end) UTC datetimes of
+        the ones which did.
+        """
+        def __init__(self, message, strikes, missing):
+            FMIError.__init__(self, message)
+            self.strikes = strikes
+            self.missing = missing
 
 class GPS(object):
+    __slots__ = ('lat', 'lon')
+
     def __init__(self, lat, lon):
         self.lat, self.lon = float(lat), float(lon)
         
@@ -25,95 +81,686 @@ class BoundingBox(object):
         self.lat = lat
         self.lon = lon
         self.radius = radius_km
-    
-    def __str__(self):
         # crude approximation which does not factor polar flattening. 1 deg = 110.5 km
         deg = self.radius / 110.5
-        left   = self.lon - deg
-        right  = self.lon + deg
-        bottom = self.lat - deg
-        top    = self.lat + deg
-        return '%2.4f,%2.4f,%2.4f,%2.4f' % (left,bottom,right,top)
+        self.left   = self.lon - deg
+        self.right  = self.lon + deg
+        self.bottom = self.lat - deg
+        self.top    = self.lat + deg
+
+    @classmethod
+    def fromEdges(cls, left, bottom, right, top):
+        box = cls((bottom + top) / 2.0, (left + right) / 2.0, 0)
+        box.left, box.bottom, box.right, box.top = left, bottom, right, top
+        return box
+
+    @classmethod
+    def fromString(cls, edges):
+        left, bottom, right, top = [float(edge) for edge in edges.split(',')]
+        return cls.fromEdges(left, bottom, right, top)
+
+    def contains(self, gps):
+        return self.bottom <= gps.lat <= self.top and self.left <= gps.lon <= self.right
+
+    def union(self, other):
+        return BoundingBox.fromEdges(min(self.left, other.left), min(self.bottom, other.bottom),
+                                     max(self.right, other.right), max(self.top, other.top))
+
+    def area(self):
+        return (self.right - self.left) * (self.top - self.bottom)
+
+    def __str__(self):
+        return '%2.4f,%2.4f,%2.4f,%2.4f' % (self.left, self.bottom, self.right, self.top)
+
+def coalesce_boxes(boxes, slack=2.0):
+    """
+    Group boxes into envelopes so that a single query covers each group. A box
+    joins an envelope only if the grown envelope stays within slack times the
+    summed area of its members, so distant boxes do not drag in empty space.
+    Returns a list of (envelope, [indices into boxes]).
+    """
+    groups = []
+    for i in sorted(range(len(boxes)), key=lambda i: (boxes[i].left, boxes[i].bottom)):
+        box = boxes[i]
+        for group in groups:
+            envelope = group[0].union(box)
+            if envelope.area() <= slack * (group[1] + box.area()):
+                group[0] = envelope
+                group[1] += box.area()
+                group[2].append(i)
+                break
+        else:
+            groups.append([box, box.area(), [i]])
+    return [(envelope, members) for envelope, _, members in groups]
+
+def _float_or_nan(field):
+    try:
+        return float(field)
+    except ValueError:
+        return float('nan')
+
+def decode_values(text):
+    """
+    Decodes a whitespace separated block of numbers into a flat array of
+    doubles in one pass. Nil values which are not numbers become NaN.
+    """
+    fields = text.split()
+    try:
+        return array('d', map(float, fields))
+    except ValueError:
+        return array('d', map(_float_or_nan, fields))
+
+def decode_block(text, ncols):
+    values = decode_values(text)
+    return [values[i::ncols] for i in range(ncols)]
+
+def normalize_place(place):
+    # 'Jyvskyl', 'JYVSKYL ' and the decomposed form share one key
+    return ' '.join(unicodedata.normalize('NFKC', place).casefold().split())
+
+# longest span FMI accepts for one lightning stored query
+MAX_QUERY_HOURS = 168
+
+def parse_utc(value):
+    """A naive UTC datetime from a datetime or an ISO 8601 string."""
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0)
+    value = value.rstrip('Z')
+    for format_ in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format_)
+        except ValueError:
+            pass
+    raise ValueError('invalid time %r, expected YYYY-MM-DDTHH:MM:SS' % value)
+
+def time_chunks(starttime, endtime, hours):
+    """Splits starttime..endtime into consecutive spans of at most hours."""
+    if not 0 < hours <= MAX_QUERY_HOURS:
+        raise ValueError('chunks must be 1 to %i hours long' % MAX_QUERY_HOURS)
+    chunks = []
+    while starttime < endtime:
+        end = min(starttime + timedelta(hours=hours), endtime)
+        chunks.append((starttime, end))
+        starttime = end
+    return chunks
+
+# starts every block of saved records, the last byte is the format version
+RECORDS_MAGIC = b'FMIR\x01'
+
+class Records(object):
+    """
+    Column-oriented observations. Every column is an array of doubles of equal
+    length: time (unix seconds), lat, lon and the query specific fields in the
+    order the data tuples list them.
+    """
+    fields = ()
+
+    def __init__(self):
+        for name in ('time', 'lat', 'lon') + self.fields:
+            setattr(self, name, array('d'))
+
+    def __len__(self):
+        return len(self.time)
+
+    def extendFlat(self, positions, values, ncols):
+        # positions holds lat, lon, time triplets and values ncols wide rows
+        self.lat.extend(positions[0::3])
+        self.lon.extend(positions[1::3])
+        self.time.extend(positions[2::3])
+        for i, name in enumerate(self.fields):
+            if i < ncols:
+                getattr(self, name).extend(values[i::ncols])
+            else:
+                getattr(self, name).extend([float('nan')] * (len(positions) // 3))
+
+    def take(self, indices):
+        records = self.__class__()
+        records.merge(self, indices)
+        return records
+
+    def merge(self, other, indices=None):
+        if indices is None:
+            indices = range(len(other))
+        for name in ('time', 'lat', 'lon') + self.fields:
+            column = getattr(other, name)
+            getattr(self, name).extend(column[i] for i in indices)
+
+    def gps(self, i):
+        return GPS(self.lat[i], self.lon[i])
+
+    def record(self, i):
+        record = {'time': datetime.utcfromtimestamp(self.time[i]), 'gps': self.gps(i)}
+        for name in self.fields:
+            record[name] = getattr(self, name)[i]
+        return record
+
+    def asDicts(self):
+        return [self.record(i) for i in range(len(self))]
+
+    def save(self, f):
+        """
+        Writes the records to the binary file f as one block: a header
+        naming the columns and the row count, then each column as little
+        endian doubles. Blocks can be appended one after another.
+        """
+        names = ('time', 'lat', 'lon') + self.fields
+        header = ','.join(names).encode('ascii')
+        f.write(RECORDS_MAGIC + struct.pack('<IQ', len(header), len(self)) + header)
+        for name in names:
+            column = getattr(self, name)
+            if sys.byteorder != 'little':
+                column = array('d', column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+    @classmethod
+    def load(cls, f):
+        """Reads every block saved to the binary file f into one Records."""
+        records = cls()
+        names = ('time', 'lat', 'lon') + cls.fields
+        while True:
+            head = f.read(len(RECORDS_MAGIC) + 12)
+            if not head:
+                return records
+            if len(head) < len(RECORDS_MAGIC) + 12 or not head.startswith(RECORDS_MAGIC):
+                raise ValueError('not a records file')
+            length, count = struct.unpack('<IQ', head[len(RECORDS_MAGIC):])
+            if tuple(f.read(length).decode('ascii').split(',')) != names:
+                raise ValueError('records file holds other columns than %s' % cls.__name__)
+            for name in names:
+                column = array('d')
+                column.frombytes(f.read(count * column.itemsize))
+                if len(column) != count:
+                    raise ValueError('truncated records file')
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                getattr(records, name).extend(column)
+
+class StrikeRecords(Records):
+    fields = ('multiplicity', 'current', 'cloud', 'ellipse')
+
+    def record(self, i):
+        record = Records.record(self, i)
+        record['multiplicity'] = int(record['multiplicity'])
+        record['cloud'] = bool(record['cloud'])
+        return record
+
+class WeatherRecords(Records):
+    fields = ('t2m', 'ws_10min', 'wg_10min', 'wd_10min', 'rh', 'td', 'r_1h',
+              'ri_10min', 'snow_aws', 'p_sea', 'vis', 'n_man', 'wawa')
+
+class CoverageParser(object):
+    """
+    Incremental parser for multipointcoverage responses. Feed it the body in
+    chunks and it returns the (position, data) rows completed so far, or
+    appends them straight to the columns of records if one is given. Text is
+    decoded in bulk per chunk. The positions block precedes the data block,
+    so positions are kept as a compact float array until their data rows
+    stream in and are dropped once handed out. The stations of the answer
+    are collected from its target:Location and gml:Point elements.
+    """
+    POSITIONS = 'http://www.opengis.net/gmlcov/1.0 positions'
+    TUPLES = 'http://www.opengis.net/gml/3.2 doubleOrNilReasonTupleList'
+    POINT = 'http://www.opengis.net/gml/3.2 Point'
+    POS = 'http://www.opengis.net/gml/3.2 pos'
+    NAME = 'http://www.opengis.net/gml/3.2 name'
+    GML_ID = 'http://www.opengis.net/gml/3.2 id'
+    LOCATION = 'http://xml.fmi.fi/namespace/om/2.0 Location'
+    REGION = 'http://xml.fmi.fi/namespace/om/2.0 region'
+    REPRESENTATIVE = 'http://xml.fmi.fi/namespace/om/2.0 representativePoint'
+    HREF = 'http://www.w3.org/1999/xlink href'
+
+    def __init__(self, records=None):
+        self.parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+        self.parser.buffer_text = True
+        self.records = records
+        self.block = None
+        self.partial = ''
+        self.positions = array('d')
+        self.values = array('d')
+        self.ncols = None
+        self.rows = []
+        self.points = {}
+        self.locations = []
+        self.element = None
+        self.capture = None
+        self.captured = ''
+
+    def feed(self, chunk):
+        self.parser.Parse(chunk, False)
+        return self._take()
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        return self._take()
+
+    def _take(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def stations(self):
+        """(name, region, lat, lon) of every station in the answer."""
+        stations = []
+        for location in self.locations:
+            point = self.points.get(location.get('point'))
+            if point is not None and 'pos' in point:
+                stations.append((location.get('name', point.get('name')), location.get('region'),
+                                 point['pos'][0], point['pos'][1]))
+        if not self.locations:
+            stations = [(point.get('name'), None, point['pos'][0], point['pos'][1])
+                        for point in self.points.values() if 'pos' in point]
+        return stations
+
+    def _start(self, name, attrs):
+        if name in (self.POSITIONS, self.TUPLES):
+            self.block = name
+            self.partial = ''
+        elif name == self.POINT:
+            self.element = {'id': attrs.get(self.GML_ID)}
+            self.points[self.element['id']] = self.element
+        elif name == self.LOCATION:
+            self.element = {}
+            self.locations.append(self.element)
+        elif self.element is not None:
+            if name == self.REPRESENTATIVE:
+                self.element['point'] = attrs.get(self.HREF, '').lstrip('#')
+            elif name in (self.POS, self.REGION) or (name == self.NAME and
+                    attrs.get('codeSpace', 'locationcode/name').endswith('locationcode/name')):
+                self.capture = name
+                self.captured = ''
+
+    def _end(self, name):
+        if name == self.block:
+            self._decode(self.partial)
+            self.block = None
+            self.partial = ''
+        elif name == self.capture:
+            if name == self.POS:
+                self.element['pos'] = tuple(float(x) for x in self.captured.split()[:2])
+            elif name == self.REGION:
+                self.element['region'] = self.captured.strip()
+            else:
+                self.element['name'] = self.captured.strip()
+            self.capture = None
+        elif name in (self.POINT, self.LOCATION):
+            self.element = None
+
+    def _text(self, text):
+        if self.capture is not None:
+            self.captured += text
+        elif self.block is not None:
+            text = self.partial + text
+            cut = text.rfind('\n')
+            if cut < 0:
+                self.partial = text
+            else:
+                self.partial = text[cut + 1:]
+                self._decode(text[:cut])
+
+    def _decode(self, text):
+        if self.block == self.POSITIONS:
+            self.positions.extend(decode_values(text))
+            return
+
+        if self.ncols is None:
+            first = text.strip().split('\n', 1)[0].split()
+            if not first:
+                return
+            self.ncols = len(first)
+        self.values.extend(decode_values(text))
+
+        count = min(len(self.positions) // 3, len(self.values) // self.ncols)
+        if count:
+            positions = self.positions[:count * 3]
+            values = self.values[:count * self.ncols]
+            del self.positions[:count * 3]
+            del self.values[:count * self.ncols]
+
+            if self.records is not None:
+                self.records.extendFlat(positions, values, self.ncols)
+            else:
+                for i in range(count):
+                    self.rows.append((positions[i * 3:i * 3 + 3], values[i * self.ncols:(i + 1) * self.ncols]))
+
+class PooledResponse(object):
+    """
+    File-like HTTP response which inflates gzip bodies and hands its
+    connection back to the pool on close if the body was read to the end.
+    """
+    def __init__(self, pool, conn, response):
+        self.pool, self.conn, self.response = pool, conn, response
+        self.status = response.status
+        self.decoder = None
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        while True:
+            data = self.response.read() if size < 0 else self.response.read(size)
+            if self.decoder is None:
+                return data
+            if not data:
+                return self.decoder.flush()
+            data = self.decoder.decompress(data)
+            if data or size < 0:
+                return data
+
+    def close(self):
+        if self.conn is not None:
+            reusable = self.response.isclosed() and not self.response.will_close
+            self.response.close()
+            self.pool.release(self.conn, reusable)
+            self.conn = None
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive connections to the host of url. At most
+    size connections are open at once; requests wait for a free one.
+    """
+    def __init__(self, url, size=4, timeout=30.0):
+        parts = urlsplit(url)
+        self.connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path
+        self.timeout = timeout
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def _connect(self):
+        with self.lock:
+            self.connections += 1
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def _send(self, conn, body, headers):
+        conn.request('POST', self.path, body, headers)
+        return conn.getresponse()
+
+    def post(self, body, headers):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise HTTPException('no free connection to %s' % self.host)
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        try:
+            if conn is not None:
+                try:
+                    return PooledResponse(self, conn, self._send(conn, body, headers))
+                except (HTTPException, ConnectionError):
+                    # the server has dropped the idle keep-alive connection
+                    conn.close()
+            conn = self._connect()
+            return PooledResponse(self, conn, self._send(conn, body, headers))
+        except:
+            conn.close()
+            self.slots.release()
+            raise
+
+    def release(self, conn, reusable):
+        if reusable:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
 
 class FMIOpenData(object):
-    def __init__(self, apikey):
-        self.ns = {'gml':    'http://www.opengis.net/gml/3.2',
-                   'gmlcov': 'http://www.opengis.net/gmlcov/1.0'}
-        self.url = 'http://data.fmi.fi/fmi-apikey/' + apikey + '/wfs'
+    def __init__(self, apikey, pool_size=4, timeout=30.0, url=None):
+        self.url = url or 'http://data.fmi.fi/fmi-apikey/' + apikey + '/wfs'
+        self.headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                        'Accept-Encoding': 'gzip'}
+        self.pool = ConnectionPool(self.url, pool_size, timeout)
+
+    def close(self):
+        self.pool.close()
         
-    def _request(self, query, params):
+    def _failed(self, query, reason, status=None):
+        REQUEST_ERRORS.inc()
+        log.warning('FMI query %s failed: %s', query, reason)
+        return FMIError('FMI query %s failed: %s' % (query, reason), status)
+
+    def _open(self, query, params):
         params['request'] = 'getFeature'
         params['storedquery_id'] = query
-        data = bytes(urlencode(params), 'utf8')
+        data = bytes(urlencode(params, doseq=True), 'utf8')
+        REQUESTS.inc()
+        started = time.time()
         try:
-            f = urlopen(self.url, data)
-            data = f.read()
-            #print(data)
-            return ET.fromstring(data)
-        except HTTPError:
-            return None
-    
+            f = self.pool.post(data, self.headers)
+        except (HTTPException, OSError) as e:
+            raise self._failed(query, e)
+        REQUEST_SECONDS.observe(time.time() - started)
+        if f.status >= 400:
+            try:
+                f.read()
+            except (HTTPException, OSError):
+                pass
+            f.close()
+            raise self._failed(query, 'HTTP %i' % f.status, f.status)
+        return f
+
     def _getUTCString(self, minutes_to_past):
         utc_now = datetime.utcnow()
         utc_now = utc_now.replace(second=0, microsecond=0)
         utc_now = utc_now - timedelta(minutes=minutes_to_past)
         return utc_now.isoformat()
         
-    def _getQuery(self, query, params):
-        print('Performing query:', query, ':', params)
-        root = self._request(query, params)
-        
-        if root is not None:
-            positions = root.find('*//gmlcov:positions', self.ns)
-            datas = root.find('*//gml:doubleOrNilReasonTupleList', self.ns)
-            
-            if positions is not None and datas is not None:
-                # split lines first, then whitespaces
-                positions = [line.split() for line in positions.text.split('\n')]
-                datas = [line.split() for line in datas.text.split('\n')]
-                
-                if len(positions) == len(datas):
-                    # first filter for empty strings from the list and then join
-                    return zip(filter(bool, positions), filter(bool, datas))
-            
-        return None
+    def _iterQuery(self, query, params, records=None, chunk_size=16384, parser=None):
+        """
+        Yields the rows of the answer as they are parsed. Raises FMIError if
+        the query fails, also when the answer breaks off or does not parse
+        half way through, so a failure never looks like an empty answer.
+        """
+        f = self._open(query, params)
+        parser = parser or CoverageParser(records)
+        received = 0
+        parsing = 0.0
+        try:
+            while True:
+                try:
+                    chunk = f.read(chunk_size)
+                    if chunk:
+                        received += len(chunk)
+                        started = time.time()
+                        rows = parser.feed(chunk)
+                    else:
+                        started = time.time()
+                        rows = parser.close()
+                    parsing += time.time() - started
+                except (HTTPException, OSError, zlib.error, xml.parsers.expat.ExpatError) as e:
+                    raise self._failed(query, e)
+                for row in rows:
+                    yield row
+                if not chunk:
+                    break
+        finally:
+            f.close()
+            RESPONSE_BYTES.inc(received)
+            PARSE_SECONDS.observe(parsing)
+
+    def _fillRecords(self, query, params, records):
+        # rows go straight into the columns, nothing is yielded
+        for row in self._iterQuery(query, params, records):
+            pass
+        return records
 
     def getWeather(self, place):
+        return self.getWeatherRecords(place).asDicts()
+
+    def getWeatherRecords(self, place):
         query = 'fmi::observations::weather::multipointcoverage'
         params = {'place':place, 'starttime':self._getUTCString(20)}
-        weathers = []
-        measurements = self._getQuery(query, params)
-        
-        if measurements is not None:
-            for pos, data in measurements:
-                weather = {'time': datetime.utcfromtimestamp(float(pos[2])), 
-                    'gps':   GPS(pos[0],pos[1]), 't2m':      float(data[0]), 
-                    'ws_10min': float(data[1]),  'wg_10min': float(data[2]), 
-                    'wd_10min': float(data[3]),  'rh':       float(data[4]), 
-                    'td':       float(data[5]),  'r_1h':     float(data[6]), 
-                    'ri_10min': float(data[7]),  'snow_aws': float(data[8]), 
-                    'p_sea':    float(data[9]),  'vis':      float(data[10]), 
-                    'n_man':    float(data[11]), 'wawa':     float(data[12])}
-                weathers.append(weather)
-                
-        return weathers
+        try:
+            return self._fillRecords(query, params, WeatherRecords())
+        except FMIError as e:
+            # FMI rejects a place it does not know with a bad request
+            if e.status != 400:
+                raise
+            return WeatherRecords()
         
+    def getLatestWeather(self, places):
+        """
+        Latest observation of each place with one request. Returns a dict
+        keyed by the given places holding a weather record extended with
+        the name of its station, or None if the place has no observations.
+        FMI rejects the whole request if it does not know one of the places,
+        the places are then asked for one by one.
+        """
+        places = list(places)
+        query = 'fmi::observations::weather::multipointcoverage'
+        params = {'place': places, 'starttime': self._getUTCString(20)}
+        records = WeatherRecords()
+        parser = CoverageParser(records)
+        try:
+            for row in self._iterQuery(query, params, parser=parser):
+                pass
+        except FMIError as e:
+            if e.status != 400:
+                raise
+            if len(places) == 1:
+                return {places[0]: None}
+            latest = {}
+            for place in places:
+                latest.update(self.getLatestWeather([place]))
+            return latest
+        return self._latestPerPlace(places, records, parser.stations())
+
+    def getLatestWeatherInBox(self, bbox):
+        """Latest observation of every station in bbox, keyed by station name."""
+        query = 'fmi::observations::weather::multipointcoverage'
+        params = {'bbox': str(bbox), 'starttime': self._getUTCString(20)}
+        records = WeatherRecords()
+        parser = CoverageParser(records)
+        for row in self._iterQuery(query, params, parser=parser):
+            pass
+        order, newest = self._newestPerStation(records)
+        names = dict(((round(lat, 4), round(lon, 4)), name) for name, region, lat, lon in parser.stations())
+        latest = {}
+        for key in order:
+            record = records.record(newest[key])
+            record['station'] = names.get(key, '%.4f %.4f' % key)
+            latest[record['station']] = record
+        return latest
+
+    def _newestPerStation(self, records):
+        # rows are split per station by position, positions are rounded to
+        # the precision of gml:pos
+        newest = {}
+        order = []
+        for i in range(len(records)):
+            key = (round(records.lat[i], 4), round(records.lon[i], 4))
+            if key not in newest:
+                order.append(key)
+                newest[key] = i
+            elif records.time[i] >= records.time[newest[key]]:
+                newest[key] = i
+        return order, newest
+
+    def _latestPerPlace(self, places, records, stations):
+        order, newest = self._newestPerStation(records)
+        names = dict(((round(lat, 4), round(lon, 4)), (name, region)) for name, region, lat, lon in stations)
+
+        latest = {}
+        for n, place in enumerate(places):
+            wanted = normalize_place(place)
+            match = None
+            for key in order:
+                name, region = names.get(key, (None, None))
+                if ((region and normalize_place(region) == wanted) or
+                        (name and normalize_place(name).startswith(wanted))):
+                    match = key
+                    break
+            if match is None and not stations and n < len(order):
+                # without station metadata stations come in the order of the places
+                match = order[n]
+            if match is None:
+                latest[place] = None
+                continue
+            record = records.record(newest[match])
+            record['station'] = names.get(match, (place, None))[0] or place
+            latest[place] = record
+        return latest
+
     def getStrikes(self, gps, radius_km):
+        return self.getStrikesInBox(BoundingBox(gps.lat, gps.lon, radius_km))
+
+    def getStrikesInBox(self, bbox):
+        return self.getStrikeRecords(bbox).asDicts()
+
+    def getStrikeRecords(self, bbox, starttime=None, endtime=None):
         query = 'fmi::observations::lightning::multipointcoverage'
-        params = {'bbox': str(BoundingBox(gps.lat, gps.lon, radius_km)), 'starttime': self._getUTCString(30)}
-        #params = {'bbox': str(BoundingBox(gps.lat, gps.lon, radius_km)), 'starttime': '2015-08-07T00:00:00', 'endtime': '2015-08-10T00:00:00'} # returns thousands
-        #params = {'bbox': str(BoundingBox(gps.lat, gps.lon, radius_km)), 'starttime': '2015-08-08T12:00:00', 'endtime': '2015-08-08T14:00:00'} # returns ~100
-        strikes = []
-        
-        measurements = self._getQuery(query, params)
-        
-        if measurements is not None:
-            for pos, data in measurements:
-                strike = {'time': datetime.utcfromtimestamp(float(pos[2])), 
-                    'gps': GPS(pos[0],pos[1]), 'multiplicity': int(float(data[0])),
-                    'current': float(data[1]), 'cloud': bool(float(data[2])), 'ellipse': float(data[3])}
-                strikes.append(strike)
-                
+        params = {'bbox': str(bbox), 'starttime': starttime or self._getUTCString(30)}
+        if endtime is not None:
+            params['endtime'] = endtime
+        #params = {'bbox': str(bbox), 'starttime': '2015-08-07T00:00:00', 'endtime': '2015-08-10T00:00:00'} # returns thousands
+        #params = {'bbox': str(bbox), 'starttime': '2015-08-08T12:00:00', 'endtime': '2015-08-08T14:00:00'} # returns ~100
+        return self._fillRecords(query, params, StrikeRecords())
+
+    def _getStrikeChunk(self, bbox, starttime, endtime, last):
+        strikes = self.getStrikeRecords(bbox, starttime.isoformat(), endtime.isoformat())
+        # both ends are inclusive, a strike on a boundary belongs to the later chunk
+        end = calendar.timegm(endtime.utctimetuple())
+        times = strikes.time
+        return strikes.take(sorted((i for i in range(len(strikes)) if last or times[i] < end),
+                                   key=times.__getitem__))
+
+    def iterStrikeRange(self, bbox, starttime, endtime, chunk_hours=24, workers=None, missing=None):
+        """
+        Yields the strikes of bbox between starttime and endtime (UTC
+        datetimes or ISO strings) as StrikeRecords, one per chunk of at most
+        chunk_hours and in time order. Up to workers chunks, by default as
+        many as the pool has connections, are downloaded concurrently ahead
+        of the one being consumed. A chunk which fails raises FMIError, or
+        if missing is a list, its (start, end) is appended to it and the
+        chunk is skipped.
+        """
+        chunks = deque(time_chunks(parse_utc(starttime), parse_utc(endtime), chunk_hours))
+        workers = min(workers or self.pool.size, len(chunks)) or 1
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            while chunks or pending:
+                while chunks and len(pending) < workers:
+                    start, end = chunks.popleft()
+                    pending.append((start, end, executor.submit(self._getStrikeChunk, bbox, start, end, not chunks)))
+                start, end, future = pending.popleft()
+                try:
+                    chunk = future.result()
+                except FMIError:
+                    if missing is None:
+                        raise
+                    missing.append((start, end))
+                    continue
+                yield chunk
+        finally:
+            for start, end, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def getStrikeRange(self, bbox, starttime, endtime, chunk_hours=24, workers=None):
+        """
+        The strikes of bbox between starttime and endtime as one
+        StrikeRecords. Raises IncompleteRange, which carries the strikes
+        fetched, if some chunks failed.
+        """
+        missing = []
+        strikes = StrikeRecords()
+        for chunk in self.iterStrikeRange(bbox, starttime, endtime, chunk_hours, workers, missing):
+            strikes.merge(chunk)
+        if missing:
+            raise IncompleteRange('%i of the chunks of %s failed' % (len(missing), bbox), strikes, missing)
         return strikes
         
         
@@ -0,0 +1,128 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import math
+
+def gpsbearing(lat1, lon1, lat2, lon2):
+    # expects radians, angle is counter-clockwise from east
+    return math.atan2(math.cos(lat1)*math.sin(lat2)-math.sin(lat1)*math.cos(lat2)*math.cos(lon2-lon1), math.sin(lon2-lon1)*math.cos(lat2)) 
+    
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points 
+    on the earth (specified in decimal degrees)
+    """
+    # convert decimal degrees to radians 
+    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+
+    # haversine formula 
+    dlon = lon2 - lon1 
+    dlat = lat2 - lat1 
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a)) 
+    r = 6371 # Radius of earth in kilometers. Use 3956 for miles
+    return c * r
+
+EARTH_RADIUS_KM = 6371
+
+class StrikeIndex(object):
+    """
+    Uniform lat/lon grid over strike positions. A radius query only visits the
+    cells overlapping the circle's bounding box instead of every strike, and
+    returns indices into the given coordinate sequences.
+    """
+    def __init__(self, lats, lons, cell_deg=0.25):
+        self.cell = cell_deg
+        self.lats, self.lons = lats, lons
+        self.cells = {}
+        for i in range(len(lats)):
+            self.cells.setdefault(self._key(lats[i], lons[i]), []).append(i)
+
+    def _key(self, lat, lon):
+        return int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell))
+
+    def __len__(self):
+        return len(self.lats)
+
+    def near(self, lat, lon, radius_km):
+        if not self.cells:
+            return []
+
+        # same 1 deg = 110.5 km approximation as BoundingBox, widened in
+        # longitude by latitude so that the whole circle is covered
+        dlat = radius_km / 110.5
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        bottom, left = self._key(lat - dlat, lon - dlon)
+        top, right = self._key(lat + dlat, lon + dlon)
+
+        found = []
+        for row in range(bottom, top + 1):
+            for col in range(left, right + 1):
+                for i in self.cells.get((row, col), ()):
+                    if haversine(lat, lon, self.lats[i], self.lons[i]) <= radius_km:
+                        found.append(i)
+        return found
+
+def strike_statistics_many(centres, lats, lons, currents, clouds, members=None):
+    """
+    Summarize strikes as seen from each (lat, lon) centre. The strike columns
+    are converted to radians once and shared by all centres; members[n] limits
+    centre n to the given strike indices. Bearings are counter-clockwise from
+    east like gpsbearing. Returns one dict per centre, {'count': 0} if empty.
+    """
+    rlats = [math.radians(x) for x in lats]
+    rlons = [math.radians(x) for x in lons]
+    coslats = [math.cos(x) for x in rlats]
+    sinlats = [math.sin(x) for x in rlats]
+    sin, cos, asin, sqrt, atan2, hypot = math.sin, math.cos, math.asin, math.sqrt, math.atan2, math.hypot
+
+    results = []
+    for n, (lat, lon) in enumerate(centres):
+        indices = range(len(rlats)) if members is None else members[n]
+        if not len(indices):
+            results.append({'count': 0})
+            continue
+
+        lat1, lon1 = math.radians(lat), math.radians(lon)
+        cos1, sin1 = cos(lat1), sin(lat1)
+        distance_sum = distance_closest = current_sum = current_peak = 0.0
+        closest = None
+        east_sum = north_sum = 0.0
+        ground = 0
+
+        for i in indices:
+            dlon = rlons[i] - lon1
+            a = sin((rlats[i] - lat1) / 2)**2 + cos1 * coslats[i] * sin(dlon / 2)**2
+            distance = 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+            east = sin(dlon) * coslats[i]
+            north = cos1 * sinlats[i] - sin1 * coslats[i] * cos(dlon)
+
+            if closest is None or distance < distance_closest:
+                distance_closest, closest = distance, (east, north)
+            norm = hypot(east, north)
+            if norm:
+                east_sum += east / norm
+                north_sum += north / norm
+            else:
+                east_sum += 1.0
+
+            current = currents[i]
+            if abs(current_peak) < abs(current):
+                current_peak = current
+            current_sum += abs(current)
+            distance_sum += distance
+            if not clouds[i]:
+                ground += 1
+
+        count = len(indices)
+        results.append({'count': count, 'ground': ground,
+            'distance_closest': distance_closest, 'bearing_closest': atan2(closest[1], closest[0]),
+            'distance_mean': distance_sum / count, 'bearing_mean': atan2(north_sum / count, east_sum / count),
+            'current_peak': current_peak, 'current_mean': current_sum / count})
+    return results
+
+def strike_statistics(lat, lon, lats, lons, currents, clouds):
+    return strike_statistics_many([(lat, lon)], lats, lons, currents, clouds)[0]
@@ -0,0 +1,140 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .metrics import registry
+
+import supybot.log as log
+
+SENT = registry.counter('email_sent_total', 'Alert emails sent')
+FAILED = registry.counter('email_failed_total', 'Alert emails dropped after their retries')
+SEND_SECONDS = registry.histogram('email_send_seconds', 'Time to deliver one email, retries included')
+
+class EmailQueue(threading.Thread):
+    """
+    Background sender for alert emails. The messages queued at the same time
+    are sent over one SMTP session, which is kept open until the queue has
+    been idle for idle_timeout seconds, and messages with the same subject
+    and body are merged into one message to all of their recipients. Failed
+    sends are retried with exponential backoff before they are dropped.
+    """
+    def __init__(self, host, port, user=None, password=None, starttls=True,
+                 retries=3, backoff=5.0, idle_timeout=60.0, timeout=30.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.starttls = starttls
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.stopEvent = threading.Event()
+        self.server = None
+        self.sent = 0
+        self.failed = 0
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def send(self, recipients, subject, body):
+        recipients = recipients if type(recipients) is list else [recipients]
+        self.queue.put((subject, body, recipients))
+
+    def stop(self):
+        self.stopEvent.set()
+        self.queue.put(None)
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                continue
+
+            batch = []
+            while item is not None:
+                batch.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            for subject, body, recipients in self._merge(batch):
+                self._deliver(subject, body, recipients)
+        self._disconnect()
+
+    def _merge(self, batch):
+        merged = {}
+        for subject, body, recipients in batch:
+            merged.setdefault((subject, body), [])
+            for recipient in recipients:
+                if recipient not in merged[(subject, body)]:
+                    merged[(subject, body)].append(recipient)
+        return [(subject, body, recipients) for (subject, body), recipients in merged.items()]
+
+    def _message(self, subject, body, recipients):
+        # several recipients only see each other in the envelope
+        to = recipients[0] if len(recipients) == 1 else 'undisclosed-recipients:;'
+        return 'From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n%s' % (self.user, to, subject, body)
+
+    def _connect(self):
+        # imported on the first email, most bots never send one
+        import smtplib
+        if self.server is None:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                server.ehlo()
+                if self.starttls:
+                    server.starttls()
+                    server.ehlo()
+                if self.password is not None:
+                    server.login(self.user, self.password)
+            except:
+                server.close()
+                raise
+            self.server = server
+        return self.server
+
+    def _disconnect(self):
+        import smtplib
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+            self.server = None
+
+    def _deliver(self, subject, body, recipients):
+        import smtplib
+        message = self._message(subject, body, recipients)
+        started = time.time()
+        for attempt in range(self.retries + 1):
+            try:
+                self._connect().sendmail(self.user, recipients, message)
+                self.sent += 1
+                SENT.inc()
+                SEND_SECONDS.observe(time.time() - started)
+                log.info('sent mail to ' + ','.join(recipients))
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                log.warning('failed to send mail to %s: %s' % (','.join(recipients), e))
+                if self.server is not None:
+                    self.server.close()
+                    self.server = None
+            if attempt < self.retries and self.stopEvent.wait(self.backoff * 2 ** attempt):
+                break
+        self.failed += 1
+        FAILED.inc()
+        log.error('failed to send mail to ' + ','.join(recipients))
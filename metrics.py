@@ -0,0 +1,154 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import bisect
+import os
+import threading
+import time
+
+# seconds, from a parsed small query to a slow FMI answer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def summary(self):
+        return '%s %s' % (self.name, self.value)
+
+    def prometheus(self):
+        return ['%s %s' % (self.name, self.value)]
+
+class Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start)
+
+class Histogram(object):
+    """
+    Fixed bucket histogram. observe() only increments the count of the
+    first bucket whose upper bound holds the value, quantiles are estimated
+    from the bucket bounds.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, None if empty."""
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.bounds + [float('inf')], counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        if not self.count:
+            return '%s 0' % self.name
+        return '%s %i, mean %.1f ms, p95 <= %.0f ms' % (self.name, self.count,
+            1000.0 * self.sum / self.count, 1000.0 * self.quantile(0.95))
+
+    def prometheus(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.bounds, counts):
+            cumulative += n
+            lines.append('%s_bucket{le="%s"} %i' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %i' % (self.name, count))
+        lines.append('%s_sum %r' % (self.name, total))
+        lines.append('%s_count %i' % (self.name, count))
+        return lines
+
+class Registry(object):
+    """
+    In-process metrics by name. counter() and histogram() return the metric
+    registered under the name, creating it on first use, so that modules
+    can look their metrics up at import time and again after a reload.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def all(self):
+        with self.lock:
+            return [self.metrics[name] for name in sorted(self.metrics)]
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.all():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # replaced in one go so that a collector never reads half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+# survives reloads of the plugin, metrics keep counting across them
+try:
+    registry
+except NameError:
+    registry = Registry()
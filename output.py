@@ -0,0 +1,138 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import threading
+import time
+
+from .metrics import registry
+
+import supybot.ircmsgs as ircmsgs
+import supybot.log as log
+
+LINES = registry.counter('irc_lines_total', 'Alert lines sent to IRC')
+ALERTS = registry.counter('irc_alerts_total', 'Alerts sent to IRC')
+ALERT_DELAY = registry.histogram('irc_alert_delay_seconds', 'Time from staging an alert to sending its line')
+
+class AlertOutput(threading.Thread):
+    """
+    Rate shaped channel output for alerts. Alerts are staged during an alarm
+    cycle and queued by flush(). When a channel's turn comes, all of its
+    queued alerts are packed into as few lines as possible, nicks sharing
+    the same text in one "nick1, nick2: text" part. Lines leave through a
+    token bucket of rate lines per second with the given burst. A newer
+    alert for a nick replaces its queued one and alerts older than max_age
+    seconds are dropped.
+    """
+    def __init__(self, irc, rate=0.5, burst=3, max_age=600, max_length=400):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.irc = irc
+        self.rate = rate
+        self.burst = burst
+        self.max_age = max_age
+        self.max_length = max_length
+        self.staged = []
+        self.queued = []
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopEvent = threading.Event()
+
+    def depth(self):
+        with self.lock:
+            return len(self.queued)
+
+    def add(self, channel, nick, text):
+        with self.lock:
+            self.staged.append([channel, nick, text, time.time()])
+
+    def flush(self):
+        with self.lock:
+            for alert in self.staged:
+                for queued in self.queued:
+                    if queued[:2] == alert[:2]:
+                        queued[2:] = alert[2:]
+                        break
+                else:
+                    self.queued.append(alert)
+            self.staged = []
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.wakeup.set()
+
+    def _take(self):
+        # every alert of the oldest alert's channel, stale ones are dropped
+        now = time.time()
+        with self.lock:
+            fresh = [alert for alert in self.queued if now - alert[3] <= self.max_age]
+            if len(fresh) < len(self.queued):
+                log.info('AlertOutput: dropped %i stale alerts' % (len(self.queued) - len(fresh)))
+                self.dropped += len(self.queued) - len(fresh)
+            if not fresh:
+                self.queued = []
+                return None, []
+            channel = fresh[0][0]
+            self.queued = [alert for alert in fresh if alert[0] != channel]
+            return channel, [alert for alert in fresh if alert[0] == channel]
+
+    def _lines(self, alerts):
+        texts = []
+        nicks = {}
+        for channel, nick, text, created in alerts:
+            if text not in nicks:
+                texts.append(text)
+                nicks[text] = []
+            nicks[text].append(nick)
+
+        parts = []
+        for text in texts:
+            if len(nicks[text]) == 1:
+                parts.append('%s, %s' % (nicks[text][0], text))
+            else:
+                parts.append('%s: %s' % (', '.join(nicks[text]), text))
+
+        lines = []
+        for part in parts:
+            if lines and len(lines[-1]) + len(part) + 3 <= self.max_length:
+                lines[-1] += ' | ' + part
+            else:
+                lines.append(part)
+        return lines
+
+    def _waitForToken(self):
+        while not self.stopEvent.is_set():
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.stopEvent.wait((1 - self.tokens) / self.rate)
+        return False
+
+    def run(self):
+        pending = []
+        while not self.stopEvent.is_set():
+            if not pending:
+                channel, alerts = self._take()
+                if not alerts:
+                    self.wakeup.wait()
+                    self.wakeup.clear()
+                    continue
+                ALERTS.inc(len(alerts))
+                created = min(alert[3] for alert in alerts)
+                pending = [(channel, line) for line in self._lines(alerts)]
+
+            if not self._waitForToken():
+                break
+            channel, line = pending.pop(0)
+            self.irc.queueMsg(ircmsgs.privmsg(channel, line))
+            LINES.inc()
+            ALERT_DELAY.observe(time.time() - created)
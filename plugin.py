@@ -4,16 +4,20 @@
 #
 #
 ###
-import json
 import threading
 import time
 import calendar
 import math
-import pytz
-import tzlocal
-import smtplib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-from .fmiapi import FMIOpenData, GPS 
+from .fmiapi import FMIOpenData, FMIError, BoundingBox, coalesce_boxes
+from .geo import StrikeIndex, strike_statistics_many
+from .cache import StrikeCache, WeatherCache
+from .alarmstore import AlarmStore
+from .scheduler import AlarmScheduler
+from .output import AlertOutput
+from .metrics import registry
 from .userconf import APIKEY # put your apikey into apikey.py with variable name APIKEY
 
 from supybot.commands import *
@@ -21,9 +25,9 @@ import supybot.utils as utils
 import supybot.conf as conf
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
-import supybot.ircmsgs as ircmsgs
 import supybot.callbacks as callbacks
 import supybot.log as log
+import supybot.world as world
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('LightningDetector')
@@ -41,49 +45,42 @@ except ImportError:
     gmail_credentials_found = False
     log.warning('Gmail credentials not found')
 
-def send_email(user, pwd, recipient, subject, body):
-    FROM = user
-    TO = recipient if type(recipient) is list else [recipient]
-    SUBJECT = subject
-    TEXT = body
+CYCLE_SECONDS = registry.histogram('alarm_cycle_seconds', 'Time to evaluate and dispatch the due alarms of one round')
+GROUP_SECONDS = registry.histogram('alarm_group_seconds', 'Time to fetch and evaluate the strikes of one alarm envelope')
+EVALUATION_SECONDS = registry.histogram('alarm_evaluation_seconds', 'Time to compute the strike statistics of one alarm')
+ALARMS_EVALUATED = registry.counter('alarms_evaluated_total', 'Alarm evaluations')
+ALARMS_ALERTED = registry.counter('alarms_alerted_total', 'Alarm evaluations which found strikes')
+ALARMS_TIMED_OUT = registry.counter('alarms_timed_out_total', 'Alarm evaluations which did not finish in time')
+QUERY_ERRORS = registry.counter('alarm_query_errors_total', 'Alarm evaluations whose strike query to FMI failed')
+GROUPS_FAILED = registry.counter('alarm_groups_failed_total', 'Alarm envelopes whose strikes could not be fetched or evaluated')
+ROUNDS_FAILED = registry.counter('alarm_rounds_failed_total', 'Alarm rounds which ended in an error')
 
-    message = '\From: %s\nTo: %s\nSubject: %s\n\n%s' % (FROM, ", ".join(TO), SUBJECT, TEXT)
-    
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.ehlo()
-        server.starttls()
-        server.login(user, pwd)
-        server.sendmail(FROM, TO, message)
-        server.close()
-        log.info('sent mail to ' + ','.join(TO))
-    except:
-        log.error('failed to send mail to ' + ','.join(TO))
+# warm state handed from a plugin instance to the next one, survives reloads
+try:
+    warm_state
+except NameError:
+    warm_state = {}
+
+_local_tz = None
+
+def local_timezone():
+    # tzlocal and pytz take tens of milliseconds to import, so they are
+    # imported and the zone resolved on the first use only
+    global _local_tz
+    if _local_tz is None:
+        import tzlocal
+        _local_tz = tzlocal.get_localzone()
+    return _local_tz
 
 def utc_to_local(utc_dt):
-    local_tz = tzlocal.get_localzone()
+    import pytz
+    local_tz = local_timezone()
     local_dt = utc_dt.replace(tzinfo=pytz.utc).astimezone(local_tz)
-    return local_tz.normalize(local_dt)
-    
-def gpsbearing(lat1, lon1, lat2, lon2):
-    return math.atan2(math.cos(lat1)*math.sin(lat2)-math.sin(lat1)*math.cos(lat2)*math.cos(lon2-lon1), math.sin(lon2-lon1)*math.cos(lat2)) 
+    # tzlocal 3 returns zoneinfo zones, which need no normalizing
+    if hasattr(local_tz, 'normalize'):
+        local_dt = local_tz.normalize(local_dt)
+    return local_dt
     
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a)) 
-    r = 6371 # Radius of earth in kilometers. Use 3956 for miles
-    return c * r
-
 def is_between_angle(deg, ref_angle):      
     ref_high = ref_angle + 22.5
     ref_low = ref_angle - 22.5
@@ -116,6 +113,50 @@ def bearing_to_str(bearing):
     if is_between_angle(deg, 45):
         return 'north-east'
     
+def format_alert(stats):
+    return '%i strikes during last 30 minutes. %i ground strikes, closest %i km to %s, \
+        mean %i km to %s, peak current %.1f kA, |mean| %.1f kA' % \
+        (stats['count'], stats['ground'], stats['distance_closest'],
+        bearing_to_str(stats['bearing_closest']), stats['distance_mean'], bearing_to_str(stats['bearing_mean']),
+        stats['current_peak'], stats['current_mean'])
+
+def format_weather(place, latest):
+    local_time_str = utc_to_local(latest['time']).strftime('%H:%M')
+    reply = "Weather for %s at %s: " % (place.title(), ircutils.bold(local_time_str))
+
+    try:
+        if not math.isnan(latest['t2m']):
+            reply += 'temperature %s C' % (ircutils.bold('%.1f' % (latest['t2m'])))
+        if not math.isnan(latest['rh']):
+            reply += ', humidity %s %%' % (ircutils.bold('%.0f' % (latest['rh'])))
+        if not math.isnan(latest['ws_10min']):
+            reply += ', wind %s m/s' % (ircutils.bold('%.1f' % (latest['ws_10min'])))
+        if not math.isnan(latest['wg_10min']):
+            reply += ', gusts %s m/s' % (ircutils.bold('%.1f' % (latest['wg_10min'])))
+        if not math.isnan(latest['wd_10min']):
+            reply += ', direction %s deg' % (ircutils.bold('%.0f' % (latest['wd_10min'])))
+        if not math.isnan(latest['p_sea']):
+            reply += ', pressure %s hPa' % (ircutils.bold('%.1f' % (latest['p_sea'])))
+        if not math.isnan(latest['r_1h']):
+            reply += ', rain %s mm/h' % (ircutils.bold('%.1f' % (latest['r_1h'])))
+        if not math.isnan(latest['vis']):
+            reply += ', visibility %s km' % (ircutils.bold('%.1f' % (latest['vis'] / 1000)))
+    except KeyError:
+        pass
+
+    return reply
+
+def format_approach(track, distance, bearing, eta):
+    return 'storm cell of %i strikes %i km to %s is approaching at %i km/h, arriving in about %i minutes' % \
+        (track.count, distance, bearing_to_str(bearing), track.speed(), eta / 60)
+
+def alarm_periods(alarm):
+    """Returns the check interval and blocking period of an alarm in seconds."""
+    plugin_conf = conf.supybot.plugins.LightningDetector
+    interval = alarm.get('interval', plugin_conf.checkInterval())
+    block = alarm.get('block', plugin_conf.blockingPeriod())
+    return interval * 60, block * 60
+
 def serialize_alarm(alarm):
     format_ = ''
     if 'email' in alarm:
@@ -131,114 +172,308 @@ class LightningDetector(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(LightningDetector, self)
         self.__parent.__init__(irc)
-        self.fmi = FMIOpenData(APIKEY)
+        self.fmi = FMIOpenData(APIKEY, pool_size=self.registryValue('poolSize'),
+                               timeout=self.registryValue('timeout'))
+        # the optional subsystems are imported when they are enabled
+        self.tiles = None
+        if self.registryValue('strikeTiles'):
+            from .tiles import TilePyramid
+            self.tiles = TilePyramid(hours=self.registryValue('tileHours'))
+        self.strikeCache = StrikeCache(self.fmi, max_age=self.registryValue('strikeCacheAge'),
+                                       tiles=self.tiles)
+        self.weatherCache = WeatherCache(self.fmi, size=self.registryValue('weatherCacheSize'),
+                                         ttl=self.registryValue('weatherCacheTTL'))
+        self.alarms = AlarmStore(conf.supybot.plugins.LightningDetector.alarms)
+        world.flushers.append(self.alarms.flush)
         self.irc = irc
-        self.thread = self.AlarmThread(self.irc, self.fmi)
+        self.scheduler = AlarmScheduler()
+        self.mailer = None
+        if gmail_credentials_found:
+            from .mailer import EmailQueue
+            self.mailer = EmailQueue('smtp.gmail.com', 587, GMAIL_USER, GMAIL_PASS)
+            self.mailer.start()
+        self.output = AlertOutput(self.irc, rate=self.registryValue('outputRate'),
+                                  burst=self.registryValue('outputBurst'),
+                                  max_age=self.registryValue('alertMaxAge'))
+        self.output.start()
+        strikes = self.strikeCache
+        self.archive = None
+        self.feed = None
+        self.tracker = None
+        if self.registryValue('feed') and self.registryValue('cellTracking'):
+            from .cells import CellTracker
+            self.tracker = CellTracker(eps_km=self.registryValue('cellDistance'))
+        if self.registryValue('feed'):
+            # only the strike feed archives strikes
+            if self.registryValue('archiveDirectory'):
+                from .archive import StrikeArchive
+                self.archive = StrikeArchive(self.registryValue('archiveDirectory'))
+            from .feed import StrikeFeed
+            self.feed = StrikeFeed(self.fmi, BoundingBox.fromString(self.registryValue('feedRegion')),
+                                   self.strikeCache, interval=self.registryValue('feedInterval'),
+                                   capacity=self.registryValue('feedCapacity'), archive=self.archive,
+                                   tracker=self.tracker, tiles=self.tiles)
+            strikes = self.feed
+        self.restoreWarmState()
+        if self.feed is not None:
+            self.feed.start()
+        self.thread = self.AlarmThread(self.output, strikes, self.alarms, self.scheduler, self.mailer,
+                                       self.tracker)
         self.thread.start()
-
-    def _getAlarms(self):
-        return json.loads(self.registryValue('alarms'))
-        
-    def _storeAlarms(self, alarms):
-        self.setRegistryValue('alarms', value=json.dumps(alarms))
+    
+    def restoreWarmState(self):
+        """
+        Takes over the caches, the strike feed buffer and alarm deadlines of
+        the previous instance when the plugin is reloaded, so that it does
+        not start cold and the feed does not archive its strikes again.
+        """
+        if 'strikeCache' in warm_state:
+            self.strikeCache.warmFrom(warm_state.pop('strikeCache'))
+        if 'weatherCache' in warm_state:
+            self.weatherCache.warmFrom(warm_state.pop('weatherCache'))
+        feed = warm_state.pop('feed', None)
+        if feed is not None and self.feed is not None:
+            self.feed.warmFrom(feed)
+        for user, deadline in warm_state.pop('deadlines', {}).items():
+            self.scheduler.schedule(user, deadline)
     
     class AlarmThread(threading.Thread):
-        def __init__(self, irc, fmi):
+        def __init__(self, output, cache, alarms, scheduler, mailer, tracker=None):
             threading.Thread.__init__(self)
             self.stopEvent = threading.Event()
             self.stopEvent.clear()
             self.notifyEvent = threading.Event()
             self.notifyEvent.clear()
-            self.fmi = fmi
-            self.irc = irc
+            self.cache = cache
+            self.alarms = alarms
+            self.scheduler = scheduler
+            self.mailer = mailer
+            self.output = output
+            self.tracker = tracker
+            self.executor = None
+            self.executorWorkers = 0
 
         def run(self):
             log.info('AlarmThread: starting')
+            self.scheduleStartup(calendar.timegm(time.gmtime()))
+
             while not self.stopped():
-                alarms = json.loads(conf.supybot.plugins.LightningDetector.get('alarms')())
+                started = time.time()
                 now = calendar.timegm(time.gmtime())
-                
-                for alarm in alarms:
-                    # check alarms every 20 minutes and have an 3 hour blocking period after an alarm per user
-                    if now > int(alarm['next_alarm']) or int(alarm['next_alarm']) == 0:
-                        gps_loc = GPS(alarm['lat'], alarm['lon'])
-                        strikes = self.fmi.getStrikes(gps_loc, alarm['radius'])
-                        
-                        if len(strikes):
-                            log.info('AlarmThread: alerting user %s at %s. Found %i strikes' % (alarm['user'], alarm['channel'], len(strikes)))
-                        
-                            distance_mean = 0
-                            distance_closest = 10000000 # some random big value
-                            bearing_mean = 0
-                            bearing_closest = 0
-                            
-                            ground_strikes = 0
-                            current_strongest = 0
-                            current_mean = 0
-                            
-                            unit_vectors = []
-
-                            for strike in strikes:
-                                distance = haversine(alarm['lat'], alarm['lon'], strike['gps'].lat, strike['gps'].lon)
-                                bearing = gpsbearing(alarm['lat'], alarm['lon'], strike['gps'].lat, strike['gps'].lon)
-                                
-                                if distance_closest > distance:
-                                    distance_closest = distance
-                                    bearing_closest = bearing
-                                if math.fabs(current_strongest) < math.fabs(strike['current']):
-                                    current_strongest = strike['current']
-                                if not strike['cloud']:
-                                    ground_strikes += 1
-                                
-                                current_mean += math.fabs(strike['current'])
-                                distance_mean += distance
-
-                                unit_vectors.append((math.cos(bearing), math.sin(bearing)))
-                                
-                            current_mean /= float(len(strikes))
-                            distance_mean /= float(len(strikes))
-                            
-                            vector_mean = [sum(i) for i in zip(*unit_vectors)]
-                            vector_mean = [x / len(unit_vectors) for x in vector_mean]
-                            bearing_mean = math.atan2(vector_mean[1], vector_mean[0])
-                            
-                            alert = '%i strikes during last 30 minutes. %i ground strikes, closest %i km to %s, \
-                                mean %i km to %s, peak current %.1f kA, |mean| %.1f kA' % \
-                                (len(strikes), ground_strikes, distance_closest,
-                                bearing_to_str(bearing_closest), distance_mean, bearing_to_str(bearing_mean),
-                                current_strongest, current_mean)
-                            self.irc.queueMsg(ircmsgs.privmsg(alarm['channel'], alarm['user'] + ', ' + alert))
-                            
-                            if 'email' in alarm and gmail_credentials_found:
-                                send_email(GMAIL_USER, GMAIL_PASS, alarm['email'], alert, 'no body yet')
-
-                            # store the next alarm time, todo add configurable
-                            alarm['next_alarm'] = now + 3*3600
-                            conf.supybot.plugins.LightningDetector.alarms.setValue(json.dumps(alarms))
-                            
-                        elif int(alarm['next_alarm']) == 0:
-                            # user expects output here even if no strikes are found
-                            self.irc.queueMsg(ircmsgs.privmsg(alarm['channel'], '%s, no strikes are currently found in the vicinity' % (alarm['user']) ))
-                            
-                            # this denotes that next_alarm value is not in its initial state
-                            alarm['next_alarm'] = 1
-                            conf.supybot.plugins.LightningDetector.alarms.setValue(json.dumps(alarms))
-                    else:
-                        log.info('AlarmThread: alarm blocking period not passed for user %s, next check in %i s' % (alarm['user'], int(alarm['next_alarm']) - now))
-                        
-                self.notifyEvent.wait(20*60.0) # todo add configurable
+                try:
+                    if self.runRound(now):
+                        CYCLE_SECONDS.observe(time.time() - started)
+                except Exception:
+                    # one bad round must not end the thread
+                    ROUNDS_FAILED.inc()
+                    log.exception('AlarmThread: alarm round failed')
+                    self.rescheduleLost(now)
+                self.dumpMetrics()
+
+                # sleep until the earliest deadline or until notified of a new one
+                deadline = self.scheduler.nextDeadline()
+                timeout = None if deadline is None else max(0, deadline - calendar.timegm(time.gmtime()))
+                self.notifyEvent.wait(timeout)
                 self.notifyEvent.clear()
 
             log.info('AlarmThread: stopping')
-            
+
+        def scheduleStartup(self, now):
+            """
+            Schedules the stored alarms, keeping the deadlines already known
+            to the scheduler. Alarms in their initial or checked state are due
+            right away; the alarms due at now are spread over startupSpread
+            seconds so that a restart does not query them all at once.
+            """
+            spread = conf.supybot.plugins.LightningDetector.startupSpread()
+            due = []
+            for alarm in self.alarms.all():
+                deadline = self.scheduler.deadline(alarm['user'])
+                if deadline is None:
+                    deadline = int(alarm['next_alarm'])
+                if deadline <= now:
+                    due.append(alarm['user'])
+                else:
+                    self.scheduler.schedule(alarm['user'], deadline)
+            for i, user in enumerate(due):
+                self.scheduler.schedule(user, now + spread * i // len(due))
+
+        def rescheduleLost(self, now):
+            # alarms popped by a failed round are checked again after their interval
+            for alarm in self.alarms.all():
+                if self.scheduler.deadline(alarm['user']) is None:
+                    self.scheduler.schedule(alarm['user'], now + alarm_periods(alarm)[0])
+
+        def runRound(self, now):
+            """
+            Evaluates the alarms due at now (unix seconds), dispatches their
+            alerts and schedules their next checks. Returns the number of
+            alarms evaluated.
+            """
+            due = []
+
+            for user in self.scheduler.popDue(now):
+                alarm = self.alarms.get(user)
+                if alarm is None:
+                    continue
+                if int(alarm['next_alarm']) > now:
+                    # still in the blocking period after the previous alert
+                    self.scheduler.schedule(user, int(alarm['next_alarm']))
+                else:
+                    due.append(alarm)
+
+            for alarm, stats in zip(due, self.evaluateAlarms(due)):
+                interval, block = alarm_periods(alarm)
+
+                if stats is None:
+                    # the query failed or took too long, try again after the interval
+                    self.scheduler.schedule(alarm['user'], now + interval)
+                    continue
+                ALARMS_EVALUATED.inc()
+                alert = None
+                if stats['count']:
+                    log.info('AlarmThread: alerting user %s at %s. Found %i strikes' % (alarm['user'], alarm['channel'], stats['count']))
+                    alert = format_alert(stats)
+                elif self.tracker is not None:
+                    approaching = self.tracker.approaching(alarm['lat'], alarm['lon'], alarm['radius'],
+                        conf.supybot.plugins.LightningDetector.approachHorizon() * 60)
+                    if approaching:
+                        log.info('AlarmThread: alerting user %s at %s. Storm cell %i approaching' % (alarm['user'], alarm['channel'], approaching[0][0].id))
+                        alert = format_approach(*approaching[0])
+
+                if alert is not None:
+                    ALARMS_ALERTED.inc()
+                    self.output.add(alarm['channel'], alarm['user'], alert)
+
+                    if 'email' in alarm and self.mailer is not None:
+                        self.mailer.send(alarm['email'], alert, 'no body yet')
+
+                    # store the next alarm time
+                    self.alarms.update(alarm['user'], next_alarm=now + block)
+                    self.scheduler.schedule(alarm['user'], now + block)
+                    continue
+
+                if int(alarm['next_alarm']) == 0:
+                    # user expects output here even if no strikes are found
+                    self.output.add(alarm['channel'], alarm['user'], 'no strikes are currently found in the vicinity')
+
+                    # this denotes that next_alarm value is not in its initial state
+                    self.alarms.update(alarm['user'], next_alarm=1)
+                self.scheduler.schedule(alarm['user'], now + interval)
+
+            self.output.flush()
+            self.alarms.flush()
+            return len(due)
+
+        def evaluateAlarms(self, alarms):
+            """
+            Returns strike statistics within radius for each alarm, or None if
+            its query failed or did not finish in time. In batched mode the alarm areas
+            are coalesced into a few envelopes, each envelope is queried once
+            and its strikes are handed out to the alarms it covers through a
+            spatial index. Envelopes are evaluated concurrently by at most
+            workers threads.
+            """
+            plugin_conf = conf.supybot.plugins.LightningDetector
+            boxes = [BoundingBox(alarm['lat'], alarm['lon'], alarm['radius']) for alarm in alarms]
+            results = [None for box in boxes]
+
+            if plugin_conf.batchQueries():
+                groups = coalesce_boxes(boxes, plugin_conf.coalesceSlack())
+            else:
+                groups = [(box, [i]) for i, box in enumerate(boxes)]
+
+            workers = plugin_conf.workers()
+            if workers == 1 or len(groups) < 2:
+                for envelope, members in groups:
+                    try:
+                        stats = self.evaluateGroup(alarms, envelope, members)
+                    except FMIError:
+                        # logged where the query failed
+                        QUERY_ERRORS.inc(len(members))
+                        GROUPS_FAILED.inc()
+                        continue
+                    except Exception:
+                        GROUPS_FAILED.inc()
+                        log.exception('AlarmThread: evaluating %i alarms in %s failed' % (len(members), envelope))
+                        continue
+                    for i, alarm_stats in zip(members, stats):
+                        results[i] = alarm_stats
+                return results
+
+            if self.executor is None or self.executorWorkers != workers:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(max_workers=workers)
+                self.executorWorkers = workers
+
+            # every round of workers may take up to one request timeout
+            rounds = (len(groups) + workers - 1) // workers
+            deadline = time.time() + rounds * plugin_conf.timeout() + 1.0
+            futures = [self.executor.submit(self.evaluateGroup, alarms, envelope, members)
+                       for envelope, members in groups]
+
+            for (envelope, members), future in zip(groups, futures):
+                try:
+                    stats = future.result(timeout=max(0.0, deadline - time.time()))
+                except TimeoutError:
+                    future.cancel()
+                    ALARMS_TIMED_OUT.inc(len(members))
+                    GROUPS_FAILED.inc()
+                    log.warning('AlarmThread: query for %i alarms in %s timed out' % (len(members), envelope))
+                    continue
+                except FMIError:
+                    QUERY_ERRORS.inc(len(members))
+                    GROUPS_FAILED.inc()
+                    continue
+                except Exception:
+                    GROUPS_FAILED.inc()
+                    log.exception('AlarmThread: evaluating %i alarms in %s failed' % (len(members), envelope))
+                    continue
+                for i, alarm_stats in zip(members, stats):
+                    results[i] = alarm_stats
+
+            return results
+
+        def evaluateGroup(self, alarms, envelope, members):
+            with GROUP_SECONDS.time():
+                strikes = self.cache.getStrikes(envelope)
+                log.info('AlarmThread: fetched %i strikes for %i alarms in %s' % (len(strikes), len(members), envelope))
+                if not len(strikes):
+                    return [{'count': 0} for i in members]
+
+                started = time.time()
+                index = StrikeIndex(strikes.lat, strikes.lon)
+                centres = [(alarms[i]['lat'], alarms[i]['lon']) for i in members]
+                near = [index.near(alarms[i]['lat'], alarms[i]['lon'], alarms[i]['radius']) for i in members]
+                stats = strike_statistics_many(centres, strikes.lat, strikes.lon,
+                    strikes.current, strikes.cloud, near)
+                # the alarms of an envelope share one pass, each gets its share
+                elapsed = (time.time() - started) / len(members)
+                for i in members:
+                    EVALUATION_SECONDS.observe(elapsed)
+                return stats
+
+        def dumpMetrics(self):
+            path = conf.supybot.plugins.LightningDetector.metricsFile()
+            if path:
+                try:
+                    registry.dump(path)
+                except EnvironmentError as e:
+                    log.warning('AlarmThread: could not write metrics to %s: %s' % (path, e))
+
         def stop(self):
             self.stopEvent.set()
             self.notifyEvent.set()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
         
         def stopped(self):
             return self.stopEvent.is_set()
             
-        def notify(self):
+        def notify(self, user=None):
+            if user is not None:
+                self.scheduler.schedule(user, 0)
             return self.notifyEvent.set()
             
     def weather(self, irc, msg, args, place):
@@ -246,54 +481,62 @@ class LightningDetector(callbacks.Plugin):
         
         Get the weather for a place in a nordic country.
         """
-        weathers = self.fmi.getWeather(place)
+        try:
+            weathers = self.weatherCache.getWeather(place)
+        except FMIError:
+            irc.error(_('FMI did not answer, try again later'), Raise=True)
         
         if weathers is not None and len(weathers):
-            latest = weathers[-1]
-            
-            local_time_str = utc_to_local(latest['time']).strftime('%H:%M')
-            reply = "Weather for %s at %s: " % (place.title(), ircutils.bold(local_time_str))
-            
-            try:
-                if not math.isnan(latest['t2m']):
-                    reply += 'temperature %s C' % (ircutils.bold('%.1f' % (latest['t2m'])))
-                if not math.isnan(latest['rh']):
-                    reply += ', humidity %s %%' % (ircutils.bold('%.0f' % (latest['rh'])))
-                if not math.isnan(latest['ws_10min']):
-                    reply += ', wind %s m/s' % (ircutils.bold('%.1f' % (latest['ws_10min'])))
-                if not math.isnan(latest['wg_10min']):
-                    reply += ', gusts %s m/s' % (ircutils.bold('%.1f' % (latest['wg_10min'])))
-                if not math.isnan(latest['wd_10min']):
-                    reply += ', direction %s deg' % (ircutils.bold('%.0f' % (latest['wd_10min'])))
-                if not math.isnan(latest['p_sea']):
-                    reply += ', pressure %s hPa' % (ircutils.bold('%.1f' % (latest['p_sea'])))
-                if not math.isnan(latest['r_1h']):
-                    reply += ', rain %s mm/h' % (ircutils.bold('%.1f' % (latest['r_1h'])))
-                if not math.isnan(latest['vis']):
-                    reply += ', visibility %s km' % (ircutils.bold('%.1f' % (latest['vis'] / 1000)))
-            except KeyError:
-                pass
-
-            irc.reply(reply)
+            irc.reply(format_weather(place, weathers[-1]))
         else:
             irc.error('Temperature not found for ' + place)
     weather = wrap(weather, ['text'])
     
+    def weathers(self, irc, msg, args, places):
+        """<place>[, <place> ...]
+        
+        Get the weather for several places in a nordic country with one query."""
+        places = [place.strip() for place in places.split(',') if place.strip()]
+        if not places:
+            irc.error(_('No places given'), Raise=True)
+        
+        try:
+            latest = self.weatherCache.getLatest(places)
+        except FMIError:
+            irc.error(_('FMI did not answer, try again later'), Raise=True)
+        replies = []
+        for place in places:
+            if latest[place] is not None:
+                replies.append(format_weather(place, latest[place]))
+            else:
+                replies.append('Temperature not found for ' + place)
+        irc.replies(replies)
+    weathers = wrap(weathers, ['text'])
+    
+    def weathercache(self, irc, msg, args):
+        """takes no arguments
+        
+        Returns the hit and miss counts of the weather cache."""
+        cache = self.weatherCache
+        lookups = cache.hits + cache.misses
+        ratio = 100.0 * cache.hits / lookups if lookups else 0.0
+        irc.reply('Weather cache: %i hits, %i misses (%.0f %% hit rate), %i/%i places' %
+                  (cache.hits, cache.misses, ratio, len(cache.entries), cache.size))
+    weathercache = wrap(weathercache)
+    
     def alarmadd(self, irc, msg, args, lat, lon, radius):
         """<lat> <lon> <km>
         
         Add an alarm for your nick."""
-        alarms = self._getAlarms()
+        alarm = self.alarms.get(msg.nick)
         
-        for alarm in alarms:
-            if alarm['user'] == msg.nick:
-                irc.error(_('Alarm already exists for you: lat %s, lon %s' % (alarm['lat'], alarm['lon'])), Raise=True)
+        if alarm is not None:
+            irc.error(_('Alarm already exists for you: lat %s, lon %s' % (alarm['lat'], alarm['lon'])), Raise=True)
         
         alarm = {'user': msg.nick, 'channel': msg.args[0], 'lat': lat, 'lon': lon, 'radius': radius, 'next_alarm': 0}
-        alarms.append(alarm)
+        self.alarms.add(alarm)
         
-        self._storeAlarms(alarms)
-        self.thread.notify()
+        self.thread.notify(msg.nick)
         irc.replySuccess()
     alarmadd = wrap(alarmadd, ['float', 'float', 'int'])
 
@@ -301,17 +544,11 @@ class LightningDetector(callbacks.Plugin):
         """takes no arguments
         
         Removes alarm for your nick."""
-        alarms = self._getAlarms()
-        
-        if True not in (alarm['user'] == msg.nick for alarm in alarms):
+        if not self.alarms.remove(msg.nick):
             irc.error(_('No alarms are found for you'), Raise=True)
         
-        for alarm in alarms:
-            if alarm['user'] == msg.nick:
-                log.info('Remove: alarm found for %s' % msg.nick)
-                alarms.remove(alarm)
-        
-        self._storeAlarms(alarms)
+        self.scheduler.cancel(msg.nick)
+        log.info('Remove: alarm found for %s' % msg.nick)
         irc.replySuccess()
     alarmremove = wrap(alarmremove)
     
@@ -319,24 +556,113 @@ class LightningDetector(callbacks.Plugin):
         """takes no arguments
         
         Bypass blocking delay for alarm. Returns immediate alarm if strikes are found."""
-        alarms = self._getAlarms()
+        if not self.alarms.update(msg.nick, next_alarm=0):
+            irc.error(_('No alarms are found for you'), Raise=True)
+        
+        self.thread.notify(msg.nick)
+    alarmstatus = wrap(alarmstatus)
+    
+    def alarmtiming(self, irc, msg, args, interval, block):
+        """<check minutes> <blocking minutes>
         
-        if True not in (alarm['user'] == msg.nick for alarm in alarms):
+        Sets how often your alarm is checked and how long it stays quiet after alerting you."""
+        if not self.alarms.update(msg.nick, interval=interval, block=block):
             irc.error(_('No alarms are found for you'), Raise=True)
         
-        for alarm in alarms:
-            if alarm['user'] == msg.nick:
-                alarm['next_alarm'] = 0
+        self.thread.notify(msg.nick)
+        irc.replySuccess()
+    alarmtiming = wrap(alarmtiming, ['positiveInt', 'positiveInt'])
+    
+    def metrics(self, irc, msg, args, prefix):
+        """[<prefix>]
         
-        self._storeAlarms(alarms)
-        self.thread.notify()
-    alarmstatus = wrap(alarmstatus)
+        Returns the counters and timings of the plugin, optionally only the ones whose name starts with <prefix>."""
+        found = [metric.summary() for metric in registry.all() if metric.name.startswith(prefix or '')]
+        if not found:
+            irc.error(_('No metrics found'), Raise=True)
+        irc.reply('; '.join(found))
+    metrics = wrap(metrics, [additional('something')])
+    
+    def emailqueue(self, irc, msg, args):
+        """takes no arguments
+        
+        Returns the number of queued, sent and failed alert emails."""
+        if self.mailer is None:
+            irc.error(_('Email alerts are not configured'), Raise=True)
+        
+        irc.reply('Email queue: %i queued, %i sent, %i failed' %
+                  (self.mailer.depth(), self.mailer.sent, self.mailer.failed))
+    emailqueue = wrap(emailqueue)
+    
+    def cells(self, irc, msg, args):
+        """takes no arguments
+        
+        Lists the storm cells tracked in the strikes of the strike feed."""
+        if self.tracker is None:
+            irc.error(_('Storm cell tracking is not enabled'), Raise=True)
+        
+        tracks = self.tracker.cells()
+        if not tracks:
+            irc.reply('No storm cells are currently tracked')
+            return
+        replies = []
+        for track in tracks:
+            reply = 'cell %i: %i strikes at %.2f %.2f' % (track.id, track.count, track.lat, track.lon)
+            if track.speed() is not None:
+                reply += ' moving %s at %i km/h' % (bearing_to_str(track.heading()), track.speed())
+            replies.append(reply)
+        irc.replies(replies)
+    cells = wrap(cells)
+    
+    def strikehistory(self, irc, msg, args, lat, lon, radius, hours):
+        """<lat> <lon> <km> <hours>
+        
+        Summarizes the archived strikes within <km> of a point during the last <hours>."""
+        if self.archive is None:
+            irc.error(_('The strike archive is not enabled, it needs the strike feed and archiveDirectory'),
+                      Raise=True)
+        
+        strikes = self.archive.query(time.time() - hours * 3600, bbox=BoundingBox(lat, lon, radius))
+        near = StrikeIndex(strikes.lat, strikes.lon).near(lat, lon, radius)
+        if not near:
+            irc.reply('No archived strikes within %i km during last %i hours' % (radius, hours))
+            return
+        
+        stats = strike_statistics_many([(lat, lon)], strikes.lat, strikes.lon,
+            strikes.current, strikes.cloud, [near])[0]
+        first = utc_to_local(datetime.utcfromtimestamp(min(strikes.time[i] for i in near)))
+        last = utc_to_local(datetime.utcfromtimestamp(max(strikes.time[i] for i in near)))
+        irc.reply('%i strikes during last %i hours, first at %s, last at %s. %i ground strikes, '
+                  'closest %i km to %s, peak current %.1f kA' %
+                  (stats['count'], hours, first.strftime('%d.%m. %H:%M'), last.strftime('%d.%m. %H:%M'),
+                   stats['ground'], stats['distance_closest'], bearing_to_str(stats['bearing_closest']),
+                   stats['current_peak']))
+    strikehistory = wrap(strikehistory, ['float', 'float', 'positiveInt', 'positiveInt'])
+    
+    def strikesnear(self, irc, msg, args, lat, lon, radius, minutes):
+        """<lat> <lon> <km> [<minutes>]
+        
+        Summarizes the strikes fetched within <km> of a point during the last
+        <minutes>, 30 by default, without querying FMI. Strikes are known in
+        the strike feed region, or without the feed in the alarm areas."""
+        if self.tiles is None:
+            irc.error(_('Strike tiles are not enabled'), Raise=True)
+        minutes = minutes or 30
+        activity = self.tiles.activity(lat, lon, radius, time.time() - minutes * 60)
+        if not activity['count']:
+            irc.reply('No strikes within %i km during last %i minutes' % (radius, minutes))
+            return
+        since = utc_to_local(datetime.utcfromtimestamp(activity['since']))
+        irc.reply('%i strikes within %i km since %s, %i ground strikes, peak current %.1f kA' %
+                  (activity['count'], radius, since.strftime('%H:%M'), activity['ground'],
+                   activity['current_peak']))
+    strikesnear = wrap(strikesnear, ['float', 'float', 'positiveInt', optional('positiveInt')])
     
     def alarmlist(self, irc, msg, args):
         """takes no arguments
         
         Return a list of all alarms."""
-        alarms = self._getAlarms()
+        alarms = self.alarms.all()
         
         if len(alarms) == 0:
             irc.reply('Alarm list is empty')
@@ -348,19 +674,14 @@ class LightningDetector(callbacks.Plugin):
         """[<email>]
 
         Add email alert for your alarm. User without parameter to remove email."""
-        alarms = self._getAlarms()
-
-        if True not in (alarm['user'] == msg.nick for alarm in alarms):
+        if msg.nick not in self.alarms:
             irc.error(_('No alarms are found for you'), Raise=True)
 
-        for alarm in alarms:
-            if alarm['user'] == msg.nick:
-                if email is not None:
-                    alarm['email'] = email
-                else:
-                    alarm.pop('email', None)
+        if email is not None:
+            self.alarms.update(msg.nick, email=email)
+        else:
+            self.alarms.discard(msg.nick, 'email')
 
-        self._storeAlarms(alarms)
         irc.replySuccess()
     alarmemail = wrap(alarmemail, [optional('text')])
 
@@ -370,6 +691,23 @@ class LightningDetector(callbacks.Plugin):
             self.thread.stop()
             self.thread.join()
             self.thread = None
+        warm_state.update(strikeCache=self.strikeCache, weatherCache=self.weatherCache,
+                          deadlines=self.scheduler.all())
+        if self.feed is not None:
+            warm_state['feed'] = self.feed
+        self.output.stop()
+        self.output.join()
+        if self.feed is not None:
+            self.feed.stop()
+            self.feed.join()
+            self.feed = None
+        if self.mailer is not None:
+            self.mailer.stop()
+            self.mailer.join()
+            self.mailer = None
+        world.flushers.remove(self.alarms.flush)
+        self.alarms.flush()
+        self.fmi.close()
 
 Class = LightningDetector
 
@@ -0,0 +1,225 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+"""
+Replays a stored or synthetic strike dataset through the alarm evaluation
+of the plugin in simulated time, as fast as it can be evaluated. Run it from
+the directory holding the plugin:
+
+    python -m LightningDetector.replay --xml storm.xml --alarms alarms.json
+    python -m LightningDetector.replay --records storm.rec --alarms alarms.json
+    python -m LightningDetector.replay --synthetic 100000 --random-alarms 1000
+"""
+from __future__ import print_function
+import argparse
+import bisect
+import json
+import logging
+import math
+import random
+import time
+
+from .fmiapi import BoundingBox, CoverageParser, StrikeRecords
+from .alarmstore import AlarmStore
+from .scheduler import AlarmScheduler
+
+def load_coverage(path, chunk_size=65536):
+    """Strikes of a lightning multipointcoverage answer saved from FMI."""
+    strikes = StrikeRecords()
+    parser = CoverageParser(strikes)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    parser.close()
+    return strikes
+
+def synthetic_storm(count, start, hours=3.0, lat=62.0, lon=23.0, speed_kmh=40.0, heading=45.0,
+                    spread_km=15.0, seed=1):
+    """
+    count strikes of a storm cell which starts at (lat, lon) and moves
+    speed_kmh towards heading (degrees clockwise from north) for hours.
+    """
+    rnd = random.Random(seed)
+    strikes = StrikeRecords()
+    span = hours * 3600
+    for t in sorted(start + rnd.uniform(0, span) for i in range(count)):
+        travelled = speed_kmh * (t - start) / 3600
+        north = travelled * math.cos(math.radians(heading)) + rnd.gauss(0, spread_km)
+        east = travelled * math.sin(math.radians(heading)) + rnd.gauss(0, spread_km)
+        strikes.time.append(float(int(t)))
+        strikes.lat.append(lat + north / 110.5)
+        strikes.lon.append(lon + east / (110.5 * math.cos(math.radians(lat))))
+        strikes.multiplicity.append(float(rnd.randint(1, 5)))
+        strikes.current.append(rnd.uniform(-80.0, 80.0))
+        strikes.cloud.append(float(rnd.random() < 0.7))
+        strikes.ellipse.append(rnd.uniform(0.1, 10.0))
+    return strikes
+
+class ReplaySource(object):
+    """
+    Strike source for the alarm thread which answers from a dataset as of
+    the simulated time now instead of querying FMI.
+    """
+    def __init__(self, strikes):
+        order = sorted(range(len(strikes)), key=strikes.time.__getitem__)
+        self.strikes = strikes.take(order)
+        self.now = 0
+        self.queries = 0
+
+    def getStrikes(self, bbox, minutes=30):
+        self.queries += 1
+        times = self.strikes.time
+        lo = bisect.bisect_left(times, self.now - minutes * 60)
+        hi = bisect.bisect_right(times, self.now)
+        lats, lons = self.strikes.lat, self.strikes.lon
+        return self.strikes.take([i for i in range(lo, hi)
+            if bbox.bottom <= lats[i] <= bbox.top and bbox.left <= lons[i] <= bbox.right])
+
+class ReplayOutput(object):
+    """Counts the alerts the alarm thread would have sent, per nick."""
+    def __init__(self):
+        self.alerts = {}
+        self.last = {}
+
+    def add(self, channel, nick, text):
+        self.alerts[nick] = self.alerts.get(nick, 0) + 1
+        self.last[nick] = text
+
+    def flush(self):
+        pass
+
+class MemoryValue(object):
+    """Registry value stand-in which keeps the JSON of an AlarmStore in memory."""
+    def __init__(self, value='[]'):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+    def setValue(self, value):
+        self.value = value
+
+class Replay(object):
+    """
+    Drives AlarmThread.runRound() over the time span of strikes. Time jumps
+    from one alarm deadline to the next, so the replay runs as fast as the
+    alarms can be evaluated. The alarms are dicts like the ones in the
+    alarms registry value, their interval and block fields in minutes
+    override the configured periods.
+    """
+    def __init__(self, strikes, alarms, start=None, end=None):
+        from .plugin import LightningDetector
+
+        self.source = ReplaySource(strikes)
+        self.output = ReplayOutput()
+        self.scheduler = AlarmScheduler()
+        self.alarms = AlarmStore(MemoryValue())
+        times = self.source.strikes.time
+        self.start = int(start if start is not None else (times[0] if len(times) else 0))
+        self.end = int(end if end is not None else (times[-1] if len(times) else self.start))
+        for alarm in alarms:
+            # past the initial state, only strikes are reported
+            self.alarms.add(dict(alarm, next_alarm=1))
+            self.scheduler.schedule(alarm['user'], self.start)
+        self.thread = LightningDetector.AlarmThread(self.output, self.source, self.alarms,
+                                                    self.scheduler, None)
+        self.rounds = 0
+        self.evaluations = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        started = time.time()
+        try:
+            now = self.start
+            while now <= self.end:
+                self.source.now = now
+                self.evaluations += self.thread.runRound(now)
+                self.rounds += 1
+                now = self.scheduler.nextDeadline()
+                if now is None:
+                    break
+        finally:
+            self.thread.stop()
+        self.elapsed = time.time() - started
+        return self.report()
+
+    def report(self):
+        simulated = self.end - self.start
+        return {'strikes': len(self.source.strikes), 'alarms': len(self.alarms),
+                'simulated_seconds': simulated, 'wall_seconds': self.elapsed,
+                'speedup': simulated / self.elapsed if self.elapsed else float('inf'),
+                'rounds': self.rounds, 'evaluations': self.evaluations,
+                'evaluations_per_second': self.evaluations / self.elapsed if self.elapsed else float('inf'),
+                'queries': self.source.queries,
+                'alerts': dict((alarm['user'], self.output.alerts.get(alarm['user'], 0))
+                               for alarm in self.alarms.all())}
+
+def random_alarms(count, bbox, seed=1):
+    rnd = random.Random(seed)
+    return [{'user': 'user%i' % i, 'channel': '#replay',
+             'lat': rnd.uniform(bbox.bottom, bbox.top), 'lon': rnd.uniform(bbox.left, bbox.right),
+             'radius': rnd.choice([10, 30, 50, 100]), 'next_alarm': 0} for i in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays lightning strikes through the alarm evaluation')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--xml', metavar='FILE', help='lightning multipointcoverage answer saved from FMI')
+    source.add_argument('--records', metavar='FILE', help='strikes saved with StrikeRecords.save()')
+    source.add_argument('--synthetic', metavar='COUNT', type=int, help='strikes of a synthetic storm cell')
+    alarms = parser.add_mutually_exclusive_group(required=True)
+    alarms.add_argument('--alarms', metavar='FILE', help='JSON list of alarms like the alarms registry value')
+    alarms.add_argument('--random-alarms', metavar='COUNT', type=int, help='alarms spread over the strikes')
+    parser.add_argument('--interval', type=int, help='check interval of every alarm in minutes')
+    parser.add_argument('--block', type=int, help='blocking period of every alarm in minutes')
+    parser.add_argument('--json', metavar='FILE', help='write the report to FILE as JSON')
+    args = parser.parse_args()
+
+    if args.xml:
+        strikes = load_coverage(args.xml)
+    elif args.records:
+        with open(args.records, 'rb') as f:
+            strikes = StrikeRecords.load(f)
+    else:
+        strikes = synthetic_storm(args.synthetic, int(time.time()) - 3 * 3600)
+    if not len(strikes):
+        parser.error('no strikes to replay')
+
+    if args.alarms:
+        with open(args.alarms) as f:
+            alarms = json.load(f)
+    else:
+        bbox = BoundingBox.fromEdges(min(strikes.lon), min(strikes.lat), max(strikes.lon), max(strikes.lat))
+        alarms = random_alarms(args.random_alarms, bbox)
+    for alarm in alarms:
+        if args.interval:
+            alarm['interval'] = args.interval
+        if args.block:
+            alarm['block'] = args.block
+
+    # per query and per alert logging would dominate the run
+    logging.getLogger('supybot').setLevel(logging.WARNING)
+    report = Replay(strikes, alarms).run()
+
+    print('%i strikes, %i alarms, %.1f simulated hours in %.2f s (%.0fx real time)' % (
+        report['strikes'], report['alarms'], report['simulated_seconds'] / 3600.0,
+        report['wall_seconds'], report['speedup']))
+    print('%i rounds, %i evaluations (%.0f/s), %i strike queries' % (
+        report['rounds'], report['evaluations'], report['evaluations_per_second'], report['queries']))
+    alerted = sorted(report['alerts'].items(), key=lambda item: (-item[1], item[0]))
+    print('%i alarms alerted, %i alerts in total' % (
+        len([n for user, n in alerted if n]), sum(n for user, n in alerted)))
+    for user, n in alerted[:20]:
+        print('%-20s %5i' % (user, n))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
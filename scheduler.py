@@ -0,0 +1,68 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import heapq
+import itertools
+import threading
+
+class AlarmScheduler(object):
+    """
+    Min-heap of alarm deadlines keyed by nick. Rescheduling pushes a new entry
+    and leaves the old one behind; stale entries are skipped when they reach
+    the top and the heap is rebuilt once they outnumber the live ones.
+    """
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, user, deadline):
+        with self.lock:
+            self.deadlines[user] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), user))
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [(d, next(self.counter), u) for u, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+
+    def deadline(self, user):
+        with self.lock:
+            return self.deadlines.get(user)
+
+    def all(self):
+        """Deadlines by nick."""
+        with self.lock:
+            return dict(self.deadlines)
+
+    def cancel(self, user):
+        with self.lock:
+            self.deadlines.pop(user, None)
+
+    def _dropStale(self):
+        while self.heap:
+            deadline, _, user = self.heap[0]
+            if self.deadlines.get(user) == deadline:
+                break
+            heapq.heappop(self.heap)
+
+    def nextDeadline(self):
+        with self.lock:
+            self._dropStale()
+            return self.heap[0][0] if self.heap else None
+
+    def popDue(self, now):
+        due = []
+        with self.lock:
+            self._dropStale()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, user = heapq.heappop(self.heap)
+                del self.deadlines[user]
+                due.append(user)
+                self._dropStale()
+        return due
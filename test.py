@@ -5,11 +5,1353 @@
 #
 ###
 
+import calendar
+from array import array
+from datetime import datetime
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+try:
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urllib.parse import parse_qsl
+except ImportError:
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urlparse import parse_qsl
+
 from supybot.test import *
 
+from .fmiapi import FMIOpenData, FMIError, IncompleteRange, BoundingBox, ConnectionPool, StrikeRecords, WeatherRecords, parse_utc, \
+    coalesce_boxes, CoverageParser, decode_values, decode_block
+from .geo import StrikeIndex, haversine, strike_statistics_many
+from .cache import StrikeCache, WeatherCache
+from .feed import StrikeFeed
+from .scheduler import AlarmScheduler
+from .alarmstore import AlarmStore
+from .mailer import EmailQueue
+from .output import AlertOutput
+from .metrics import Registry, registry
+from .replay import Replay, MemoryValue, synthetic_storm
+from .archive import StrikeArchive, BLOCK, RECORD
+from .cells import CellTracker
+from .tiles import TilePyramid, BUCKET
+from .bench import coverage_xml, query_params, StandInWFS
+from .plugin import warm_state
+
+
+def coverage(rows):
+    """Builds a lightning multipointcoverage response of (lat, lon, time, current) rows."""
+    return coverage_xml([(lat, lon, t, (1, current, 0, 2.0)) for lat, lon, t, current in rows])
+
+
+class StandInWFSTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.rows = [(62.2 + i * 0.01, 25.7, 1463528267 + i, -10.0 - i) for i in range(50)]
+        self.server = StandInWFS(coverage(self.rows))
+        self.fmi = FMIOpenData('key', pool_size=2, timeout=5.0, url=self.server.url)
+        self.bbox = BoundingBox(62.2, 25.7, 50)
+
+    def tearDown(self):
+        self.fmi.close()
+        self.server.stop()
+        SupyTestCase.tearDown(self)
+
+
+class FMIOpenDataTestCase(StandInWFSTestCase):
+    def testConnectionIsReused(self):
+        for i in range(5):
+            strikes = self.fmi.getStrikeRecords(self.bbox)
+            self.assertEqual(len(strikes), len(self.rows))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.fmi.pool.connections, 1)
+
+    def testGzipResponse(self):
+        strikes = self.fmi.getStrikesInBox(self.bbox)
+        self.assertEqual([s['current'] for s in strikes], [row[3] for row in self.rows])
+        self.assertEqual(strikes[0]['gps'].lat, 62.2)
+
+    def testPoolSizeBoundsConnections(self):
+        results = []
+        def fetch():
+            results.append(len(self.fmi.getStrikeRecords(self.bbox)))
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [len(self.rows)] * 8)
+        self.assertTrue(self.server.connections <= 2)
+
+    def testHTTPErrorRaises(self):
+        self.server.status = 400
+        try:
+            self.fmi.getStrikeRecords(self.bbox)
+        except FMIError as e:
+            self.assertEqual(e.status, 400)
+        else:
+            self.fail('no FMIError')
+        self.server.status = 200
+        self.assertEqual(len(self.fmi.getStrikeRecords(self.bbox)), len(self.rows))
+        self.assertEqual(self.server.connections, 1)
+
+    def testBrokenAnswerRaises(self):
+        # a failure half way through the body must not look like no strikes
+        self.server.cut = 200
+        self.assertRaises(FMIError, self.fmi.getStrikeRecords, self.bbox)
+        self.server.cut = None
+        self.server.body = coverage(self.rows)[:-100]
+        self.assertRaises(FMIError, self.fmi.getStrikeRecords, self.bbox)
+        self.server.body = coverage(self.rows)
+        self.assertEqual(len(self.fmi.getStrikeRecords(self.bbox)), len(self.rows))
+
+    def testUnknownPlaceHasNoWeather(self):
+        self.server.status = 400
+        self.assertEqual(len(self.fmi.getWeatherRecords('nowhere')), 0)
+        self.server.status = 503
+        self.assertRaises(FMIError, self.fmi.getWeatherRecords, 'helsinki')
+
+
+class CountingSource(object):
+    """Strike source for the alarm thread which records the boxes asked for."""
+    def __init__(self, strikes=None):
+        self.strikes = strikes if strikes is not None else StrikeRecords()
+        self.boxes = []
+
+    def getStrikes(self, bbox, minutes=30):
+        self.boxes.append(bbox)
+        strikes = self.strikes
+        return strikes.take([i for i in range(len(strikes))
+                             if bbox.bottom <= strikes.lat[i] <= bbox.top and bbox.left <= strikes.lon[i] <= bbox.right])
+
+
+class CoalesceTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # three overlapping areas around Jyvaskyla and one in Oulu
+        self.alarms = [{'user': 'a', 'lat': 62.2, 'lon': 25.7, 'radius': 30},
+                       {'user': 'b', 'lat': 62.3, 'lon': 25.8, 'radius': 30},
+                       {'user': 'c', 'lat': 62.25, 'lon': 25.6, 'radius': 20},
+                       {'user': 'd', 'lat': 65.0, 'lon': 25.5, 'radius': 30}]
+        self.boxes = [BoundingBox(a['lat'], a['lon'], a['radius']) for a in self.alarms]
+
+    def testNearBoxesShareAnEnvelope(self):
+        groups = coalesce_boxes(self.boxes)
+        self.assertEqual(sorted(sorted(members) for envelope, members in groups), [[0, 1, 2], [3]])
+        for envelope, members in groups:
+            for i in members:
+                box = self.boxes[i]
+                self.assertTrue(envelope.left <= box.left and envelope.right >= box.right and
+                                envelope.bottom <= box.bottom and envelope.top >= box.top)
+
+    def testSlackLimitsEnvelopes(self):
+        # Jyvaskyla and Oulu only share an envelope if its empty space is allowed
+        apart = [self.boxes[0], self.boxes[3]]
+        self.assertEqual(len(coalesce_boxes(apart)), 2)
+        self.assertEqual(len(coalesce_boxes(apart, slack=100.0)), 1)
+        self.assertEqual(coalesce_boxes([]), [])
+
+    def testDueAlarmsShareQueries(self):
+        from .plugin import LightningDetector
+        strikes = strike_records([(62.21, 25.71, 1463528400, -10.0), (65.01, 25.51, 1463528400, -20.0)])
+        source = CountingSource(strikes)
+        thread = LightningDetector.AlarmThread(None, source, None, None, None)
+        try:
+            with conf.supybot.plugins.LightningDetector.batchQueries.context(True):
+                results = thread.evaluateAlarms(self.alarms)
+            self.assertEqual(len(source.boxes), 2)
+            self.assertEqual([stats['count'] for stats in results], [1, 1, 1, 1])
+            self.assertEqual(results[3]['current_peak'], -20.0)
+            source.boxes = []
+            with conf.supybot.plugins.LightningDetector.batchQueries.context(False):
+                thread.evaluateAlarms(self.alarms)
+            self.assertEqual(len(source.boxes), 4)
+        finally:
+            thread.stop()
+
+
+class StrikeIndexTestCase(SupyTestCase):
+    def testNearMatchesFullScan(self):
+        rnd = random.Random(1)
+        lats = [rnd.uniform(60.0, 66.0) for i in range(2000)]
+        lons = [rnd.uniform(21.0, 30.0) for i in range(2000)]
+        index = StrikeIndex(lats, lons)
+        self.assertEqual(len(index), 2000)
+        for lat, lon, radius in [(62.2, 25.7, 50), (65.9, 29.9, 120), (63.0, 24.0, 5), (70.0, 25.0, 50)]:
+            expected = [i for i in range(len(lats)) if haversine(lat, lon, lats[i], lons[i]) <= radius]
+            self.assertEqual(sorted(index.near(lat, lon, radius)), expected)
+
+    def testEmptyIndex(self):
+        self.assertEqual(StrikeIndex([], []).near(62.2, 25.7, 50), [])
+
+
+class StrikeStatisticsTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # 0.1 deg north of Jyvaskyla, then 0.2 deg east
+        self.lats = [62.3, 62.2]
+        self.lons = [25.7, 25.9]
+        self.currents = [-30.0, 10.0]
+        self.clouds = [0.0, 1.0]
+
+    def testSummary(self):
+        stats = strike_statistics_many([(62.2, 25.7)], self.lats, self.lons, self.currents, self.clouds)[0]
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['ground'], 1)
+        self.assertEqual(stats['current_peak'], -30.0)
+        self.assertEqual(stats['current_mean'], 20.0)
+        self.assertAlmostEqual(stats['distance_closest'], haversine(62.2, 25.7, 62.2, 25.9), places=6)
+        self.assertAlmostEqual(stats['distance_mean'], (haversine(62.2, 25.7, 62.3, 25.7) +
+                                                        haversine(62.2, 25.7, 62.2, 25.9)) / 2, places=6)
+
+    def testBearingsAreRadiansFromEast(self):
+        # the closest strike lies east, the mean direction north-east
+        stats = strike_statistics_many([(62.2, 25.7)], self.lats, self.lons, self.currents, self.clouds)[0]
+        self.assertAlmostEqual(stats['bearing_closest'], 0.0, delta=0.01)
+        self.assertAlmostEqual(stats['bearing_mean'], math.pi / 4, delta=0.01)
+        north = strike_statistics_many([(62.2, 25.7)], [62.3], [25.7], [1.0], [0.0])[0]
+        self.assertAlmostEqual(north['bearing_closest'], math.pi / 2, places=6)
+        south = strike_statistics_many([(62.3, 25.7)], [62.2], [25.7], [1.0], [0.0])[0]
+        self.assertAlmostEqual(south['bearing_closest'], -math.pi / 2, places=6)
+
+    def testMembersLimitCentres(self):
+        results = strike_statistics_many([(62.2, 25.7), (62.2, 25.7), (65.0, 25.5)], self.lats, self.lons,
+                                         self.currents, self.clouds, [[0], [0, 1], []])
+        self.assertEqual([stats['count'] for stats in results], [1, 2, 0])
+        self.assertEqual(results[0]['current_peak'], -30.0)
+        self.assertEqual(results[2], {'count': 0})
+
+
+class RecordsTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.strikes = StrikeRecords()
+        self.strikes.extendFlat(array('d', [62.2, 25.7, 1463528400, 62.3, 25.8, 1463528460]),
+                                array('d', [2, -12.5, 1, 0.5, 1, 30.0, 0, 1.5]), 4)
+
+    def testColumns(self):
+        self.assertEqual(len(self.strikes), 2)
+        self.assertEqual(list(self.strikes.current), [-12.5, 30.0])
+        record = self.strikes.record(0)
+        self.assertEqual(record['time'], datetime(2016, 5, 17, 23, 40))
+        self.assertEqual((record['gps'].lat, record['gps'].lon), (62.2, 25.7))
+        self.assertEqual(record['multiplicity'], 2)
+        self.assertTrue(record['cloud'] is True)
+        self.assertEqual([r['current'] for r in self.strikes.asDicts()], [-12.5, 30.0])
+
+    def testTakeAndMerge(self):
+        taken = self.strikes.take([1])
+        self.assertEqual(list(taken.time), [1463528460.0])
+        taken.merge(self.strikes)
+        self.assertEqual(list(taken.current), [30.0, -12.5, 30.0])
+        self.assertEqual(len(taken.ellipse), 3)
+
+    def testSaveAndLoad(self):
+        weather = WeatherRecords()
+        weather.extendFlat(array('d', [60.2, 24.9, 1463528400.0]),
+                           array('d', [15.5] + [float('nan')] * 12), 13)
+        f = io.BytesIO()
+        self.strikes.save(f)
+        self.strikes.take([1]).save(f)
+        f.seek(0)
+        loaded = StrikeRecords.load(f)
+        self.assertEqual(list(loaded.current), [-12.5, 30.0, 30.0])
+        self.assertEqual(list(loaded.lat), [62.2, 62.3, 62.3])
+
+        f = io.BytesIO()
+        weather.save(f)
+        f.seek(0)
+        loaded = WeatherRecords.load(f)
+        self.assertEqual(loaded.t2m[0], 15.5)
+        self.assertTrue(math.isnan(loaded.wawa[0]))
+
+    def testBrokenFilesAreRejected(self):
+        f = io.BytesIO()
+        self.strikes.save(f)
+        data = f.getvalue()
+        self.assertRaises(ValueError, StrikeRecords.load, io.BytesIO(data[:-4]))
+        self.assertRaises(ValueError, StrikeRecords.load, io.BytesIO(b'not records'))
+        self.assertRaises(ValueError, WeatherRecords.load, io.BytesIO(data))
+        self.assertEqual(len(StrikeRecords.load(io.BytesIO(b''))), 0)
+
+
+class CoverageParserTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # exact binary fractions survive the round trip through the text
+        self.rows = [(62.0 + i / 8.0, 25.0 - i / 16.0, 1463528267 + i, -10.5 - i) for i in range(20)]
+        self.body = coverage(self.rows)
+
+    def parse(self, size, records=None):
+        parser = CoverageParser(records)
+        rows = []
+        for start in range(0, len(self.body), size):
+            rows.extend(parser.feed(self.body[start:start + size]))
+        rows.extend(parser.close())
+        return rows
+
+    def testChunkBoundaries(self):
+        # one byte chunks split every tag and every value
+        for size in (1, 7, 64, len(self.body)):
+            rows = self.parse(size)
+            self.assertEqual([(tuple(pos), tuple(data)) for pos, data in rows],
+                             [((lat, lon, float(t)), (1.0, current, 0.0, 2.0)) for lat, lon, t, current in self.rows])
+
+    def testRowsGoStraightToRecords(self):
+        strikes = StrikeRecords()
+        self.assertEqual(self.parse(5, strikes), [])
+        self.assertEqual(list(strikes.current), [row[3] for row in self.rows])
+        self.assertEqual(list(strikes.time), [float(row[2]) for row in self.rows])
+
+    def testEmptyCoverage(self):
+        self.body = coverage([])
+        self.assertEqual(self.parse(3), [])
+
+
+class DecodeTestCase(SupyTestCase):
+    def testValues(self):
+        self.assertEqual(list(decode_values(' 1 -2.5\n\t3e2 ')), [1.0, -2.5, 300.0])
+        self.assertEqual(list(decode_values('')), [])
+
+    def testNilValuesAreNaN(self):
+        values = decode_values('1.0 NaN 2.0 nil -')
+        self.assertEqual(values[0], 1.0)
+        self.assertTrue(math.isnan(values[1]))
+        self.assertEqual(values[2], 2.0)
+        self.assertTrue(math.isnan(values[3]) and math.isnan(values[4]))
+
+    def testBlockColumns(self):
+        columns = decode_block('1 2 3\n4 5 6\n', 3)
+        self.assertEqual([list(column) for column in columns], [[1.0, 4.0], [2.0, 5.0], [3.0, 6.0]])
+
+    def testMissingColumnsArePadded(self):
+        weather = WeatherRecords()
+        weather.extendFlat(array('d', [60.2, 24.9, 1463528400.0, 60.3, 25.0, 1463528400.0]),
+                           array('d', [15.5, 2.0, 16.5, 3.0]), 2)
+        self.assertEqual(list(weather.ws_10min), [2.0, 3.0])
+        self.assertEqual([len(getattr(weather, name)) for name in WeatherRecords.fields], [2] * 13)
+        self.assertTrue(math.isnan(weather.wawa[1]))
+
+
+class FailingSource(CountingSource):
+    """Strike source which fails or stalls for the boxes north of 64 degrees."""
+    def __init__(self, strikes=None, stall=0.0):
+        CountingSource.__init__(self, strikes)
+        self.stall = stall
+
+    def getStrikes(self, bbox, minutes=30):
+        if bbox.bottom > 64.0:
+            if self.stall:
+                time.sleep(self.stall)
+            else:
+                raise socket.timeout('timed out')
+        return CountingSource.getStrikes(self, bbox, minutes)
+
+
+class AlarmThreadTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        from .plugin import LightningDetector
+        self.alarms = [{'user': 'south', 'channel': '#test', 'lat': 62.2, 'lon': 25.7, 'radius': 30, 'next_alarm': 1},
+                       {'user': 'north', 'channel': '#test', 'lat': 65.0, 'lon': 25.5, 'radius': 30, 'next_alarm': 1}]
+        self.strikes = strike_records([(62.21, 25.71, 1463528400, -10.0), (65.01, 25.51, 1463528400, -20.0)])
+        self.AlarmThread = LightningDetector.AlarmThread
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.thread.stop()
+        SupyTestCase.tearDown(self)
+
+    def evaluate(self, source, workers):
+        self.thread = self.AlarmThread(None, source, None, None, None)
+        with conf.supybot.plugins.LightningDetector.workers.context(workers):
+            return self.thread.evaluateAlarms(self.alarms)
+
+    def testFailedGroupIsSkippedInSerial(self):
+        failed = registry.counter('alarm_groups_failed_total', '').value
+        results = self.evaluate(FailingSource(self.strikes), 1)
+        self.assertEqual(results[0]['count'], 1)
+        self.assertEqual(results[1], None)
+        self.assertEqual(registry.counter('alarm_groups_failed_total', '').value, failed + 1)
+
+    def testFailedGroupIsSkippedConcurrently(self):
+        results = self.evaluate(FailingSource(self.strikes), 4)
+        self.assertEqual(results[0]['count'], 1)
+        self.assertEqual(results[1], None)
+
+    def testStalledGroupTimesOut(self):
+        timed_out = registry.counter('alarms_timed_out_total', '').value
+        with conf.supybot.plugins.LightningDetector.timeout.context(0.1):
+            started = time.time()
+            results = self.evaluate(FailingSource(self.strikes, stall=3.0), 4)
+        self.assertTrue(time.time() - started < 2.5)
+        self.assertEqual(results[0]['count'], 1)
+        self.assertEqual(results[1], None)
+        self.assertEqual(registry.counter('alarms_timed_out_total', '').value, timed_out + 1)
+
+    def testThreadSurvivesFailedRound(self):
+        alarms = AlarmStore(MemoryValue())
+        for alarm in self.alarms:
+            alarms.add(dict(alarm))
+        scheduler = AlarmScheduler()
+        self.thread = self.AlarmThread(AlertOutput(RecordingIrc()), FailingSource(self.strikes), alarms,
+                                       scheduler, None)
+        rounds = []
+        runRound = self.thread.runRound
+        def failFirst(now):
+            rounds.append(now)
+            if len(rounds) == 1:
+                scheduler.popDue(now)
+                raise ValueError('broken round')
+            return runRound(now)
+        self.thread.runRound = failFirst
+        with conf.supybot.plugins.LightningDetector.startupSpread.context(0):
+            self.thread.start()
+            deadline = time.time() + 5.0
+            while len(rounds) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+                self.thread.notify()
+        self.assertTrue(self.thread.is_alive())
+        self.assertTrue(len(rounds) >= 2)
+        # the alarms popped by the failed round were scheduled again
+        self.assertEqual(sorted(scheduler.all()), ['north', 'south'])
+
+
+class RangeQueryTestCase(StandInWFSTestCase):
+    def setUp(self):
+        StandInWFSTestCase.setUp(self)
+        # a strike every hour for three days from 2016-05-18T00:00:00
+        start = 1463529600
+        self.rows = [(62.2, 25.7, start + 3600 * i, float(i)) for i in range(72)]
+        self.broken = set()
+        def respond(params):
+            start = calendar.timegm(parse_utc(params['starttime']).utctimetuple())
+            end = calendar.timegm(parse_utc(params['endtime']).utctimetuple())
+            # newest first, the range must come back in time order anyway
+            body = coverage([row for row in reversed(self.rows) if start <= row[2] <= end])
+            if params['starttime'] in self.broken:
+                return body[:-100]
+            return body
+        self.server.respond = respond
+
+    def testRangeIsChunked(self):
+        strikes = self.fmi.getStrikeRange(self.bbox, '2016-05-18T00:00:00', '2016-05-21T00:00:00', chunk_hours=24)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(list(strikes.current), [row[3] for row in self.rows])
+
+    def testChunksStreamInTimeOrder(self):
+        chunks = list(self.fmi.iterStrikeRange(self.bbox, '2016-05-18T00:00:00', '2016-05-18T23:00:00', chunk_hours=5))
+        self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 5, 5, 4])
+        self.assertEqual([chunk.time[0] for chunk in chunks], [self.rows[i][2] for i in (0, 5, 10, 15, 20)])
+
+    def testFailedChunkIsReported(self):
+        self.broken.add('2016-05-19T00:00:00')
+        try:
+            self.fmi.getStrikeRange(self.bbox, '2016-05-18T00:00:00', '2016-05-21T00:00:00', chunk_hours=24)
+        except IncompleteRange as e:
+            self.assertEqual(e.missing, [(datetime(2016, 5, 19), datetime(2016, 5, 20))])
+            self.assertEqual(list(e.strikes.current), [row[3] for row in self.rows[:24] + self.rows[48:]])
+        else:
+            self.fail('no IncompleteRange')
+        # a failed chunk is not yielded as an empty one
+        chunks = self.fmi.iterStrikeRange(self.bbox, '2016-05-18T00:00:00', '2016-05-21T00:00:00', chunk_hours=24)
+        self.assertEqual(len(next(chunks)), 24)
+        self.assertRaises(FMIError, next, chunks)
+
+    def testChunkLengthIsLimited(self):
+        self.assertRaises(ValueError, self.fmi.getStrikeRange, self.bbox,
+                          '2016-05-18', '2016-05-21', chunk_hours=1000)
+
+    def testRecordsAreSavedAndLoaded(self):
+        f = io.BytesIO()
+        for chunk in self.fmi.iterStrikeRange(self.bbox, '2016-05-18', '2016-05-21'):
+            chunk.save(f)
+        f.seek(0)
+        strikes = StrikeRecords.load(f)
+        self.assertEqual(list(strikes.time), [row[2] for row in self.rows])
+        self.assertEqual(strikes.record(3)['current'], 3.0)
+        f.seek(0)
+        self.assertRaises(ValueError, WeatherRecords.load, f)
+
+
+class MetricsTestCase(StandInWFSTestCase):
+    def testHistogramBuckets(self):
+        histogram = Registry().histogram('test_seconds', 'test', [0.1, 1.0])
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.quantile(0.5), 1.0)
+        self.assertEqual(histogram.quantile(1.0), float('inf'))
+        text = '\n'.join(histogram.prometheus())
+        self.assertTrue('test_seconds_bucket{le="1.0"} 3' in text, text)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 4' in text, text)
+        self.assertTrue('test_seconds_count 4' in text, text)
+
+    def testRequestsAreMeasured(self):
+        requests = registry.counter('fmi_requests_total', '').value
+        errors = registry.counter('fmi_request_errors_total', '').value
+        parsed = registry.histogram('fmi_parse_seconds', '').count
+        self.fmi.getStrikeRecords(self.bbox)
+        self.server.status = 500
+        self.assertRaises(FMIError, self.fmi.getStrikeRecords, self.bbox)
+        self.assertEqual(registry.counter('fmi_requests_total', '').value, requests + 2)
+        self.assertEqual(registry.counter('fmi_request_errors_total', '').value, errors + 1)
+        self.assertEqual(registry.histogram('fmi_parse_seconds', '').count, parsed + 1)
+        self.assertTrue('# TYPE fmi_request_seconds histogram' in registry.prometheus())
+
+    def testFailedQueryIsLogged(self):
+        self.server.status = 500
+        with self.assertLogs('supybot.plugins.LightningDetector', 'WARNING') as logged:
+            self.assertRaises(FMIError, self.fmi.getStrikeRecords, self.bbox)
+        self.assertTrue('HTTP 500' in logged.output[0], logged.output)
+
+
+class RecentStrikesTestCase(StandInWFSTestCase):
+    def setUp(self):
+        StandInWFSTestCase.setUp(self)
+        now = int(time.time())
+        self.rows = [(62.2 + i * 0.01, 25.7, now - 60 * i - 30, -10.0 - i) for i in range(50)]
+        self.server.body = coverage(self.rows)
+
+
+class StrikeCacheTestCase(RecentStrikesTestCase):
+    def testOverlappingQueriesAreServedFromMemory(self):
+        cache = StrikeCache(self.fmi, max_age=60)
+        self.assertEqual(len(cache.getStrikes(self.bbox)), 30)
+        inner = BoundingBox(62.25, 25.7, 10)
+        strikes = cache.getStrikes(inner)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(0 < len(strikes) < 30)
+        self.assertTrue(all(inner.contains(strikes.gps(i)) for i in range(len(strikes))))
+
+    def testOnlyDeltaIsRequested(self):
+        cache = StrikeCache(self.fmi, max_age=0, overlap=300)
+        cache.getStrikes(self.bbox)
+        cache.getStrikes(self.bbox)
+        self.assertEqual(len(self.server.requests), 2)
+        first, second = [dict(parse_qsl(r.decode('utf8')))['starttime'] for r in self.server.requests]
+        self.assertTrue(second > first)
+        # the refetched overlap is deduplicated
+        self.assertEqual(len(cache.getStrikes(self.bbox)), 30)
+
+    def testFailedFetchKeepsRegion(self):
+        cache = StrikeCache(self.fmi, max_age=0, overlap=300)
+        cache.getStrikes(self.bbox)
+        region = list(cache.regions.values())[0]
+        fetched = region.fetched
+        self.server.status = 503
+        self.assertRaises(FMIError, cache.getStrikes, self.bbox)
+        self.assertEqual(region.fetched, fetched)
+        self.assertEqual(len(region.strikes), 30)
+        # the next delta still starts from the last successful fetch
+        self.server.status = 200
+        self.assertEqual(len(cache.getStrikes(self.bbox)), 30)
+        starttimes = [dict(parse_qsl(r.decode('utf8')))['starttime'] for r in self.server.requests]
+        expected = datetime.utcfromtimestamp(int(fetched - 300)).isoformat()
+        self.assertEqual(starttimes[1:], [expected, expected])
+
+    def testWiderWindowIsFetched(self):
+        cache = StrikeCache(self.fmi, max_age=60, overlap=300)
+        self.assertEqual(len(cache.getStrikes(self.bbox, minutes=30)), 30)
+        since = list(cache.regions.values())[0].since
+        inside = len([row for row in self.rows if self.bbox.bottom <= row[0] <= self.bbox.top])
+        # the older part is fetched although the region is fresh
+        self.assertEqual(len(cache.getStrikes(self.bbox, minutes=60)), inside)
+        self.assertEqual(len(self.server.requests), 2)
+        params = dict(parse_qsl(self.server.requests[1].decode('utf8')))
+        self.assertEqual(params['endtime'], datetime.utcfromtimestamp(int(since + 300)).isoformat())
+        self.assertEqual(len(cache.getStrikes(self.bbox, minutes=60)), inside)
+        self.assertEqual(len(cache.getStrikes(self.bbox, minutes=30)), 30)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testOldStrikesAreEvicted(self):
+        cache = StrikeCache(self.fmi, max_age=60)
+        cache.getStrikes(self.bbox, minutes=10)
+        region = list(cache.regions.values())[0]
+        self.assertEqual(len(region.strikes), 10)
+
+    def testFetchedStrikesAreAggregated(self):
+        tiles = TilePyramid()
+        cache = StrikeCache(self.fmi, max_age=0, tiles=tiles)
+        cache.getStrikes(self.bbox)
+        count = len(tiles)
+        self.assertTrue(count >= 30)
+        # the refetched overlap is not counted twice
+        cache.getStrikes(self.bbox)
+        self.assertEqual(len(tiles), count)
+
+
+class StrikeFeedTestCase(RecentStrikesTestCase):
+    def testOnlyNewStrikesAreBuffered(self):
+        feed = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), None, window=30)
+        self.assertEqual(len(feed.poll()), len(self.rows))
+        self.assertEqual(len(feed.poll()), 0)
+        self.assertEqual(len(feed.buffer), len(self.rows))
+        starttimes = [dict(parse_qsl(r.decode('utf8')))['starttime'] for r in self.server.requests]
+        self.assertTrue(starttimes[1] > starttimes[0])
+
+    def testRestartedFeedArchivesOnce(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for restart in range(3):
+                archive = StrikeArchive(directory)
+                feed = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), None, archive=archive)
+                self.assertEqual(len(feed.poll()), len(self.rows))
+                self.assertEqual(len(StrikeArchive(directory)), len(self.rows))
+        finally:
+            shutil.rmtree(directory)
+
+    def testWarmFeedPollsOnlyTheOverlap(self):
+        feed = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), None, overlap=300)
+        feed.poll()
+        warm = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), None, overlap=300)
+        warm.warmFrom(feed)
+        self.assertEqual(len(warm.buffer), len(self.rows))
+        self.assertEqual(len(warm.poll()), 0)
+        starttime = dict(parse_qsl(self.server.requests[1].decode('utf8')))['starttime']
+        self.assertEqual(starttime, datetime.utcfromtimestamp(int(feed.last - 300)).isoformat())
+        # a feed of another region starts afresh
+        other = StrikeFeed(self.fmi, BoundingBox(65.0, 25.7, 100), None)
+        other.warmFrom(feed)
+        self.assertEqual((len(other.buffer), other.last), (0, None))
+
+    def testRingBufferIsBounded(self):
+        feed = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), None, capacity=10)
+        feed.poll()
+        self.assertEqual(len(feed.buffer), 10)
+        self.assertEqual(len(feed.keys), 10)
+
+    def testQueriesAreServedFromBuffer(self):
+        cache = StrikeCache(self.fmi)
+        feed = StrikeFeed(self.fmi, BoundingBox(62.5, 25.7, 100), cache)
+        self.assertEqual(len(feed.getStrikes(self.bbox)), 30)
+        self.assertEqual(len(self.server.requests), 1)
+        feed.poll()
+        strikes = feed.getStrikes(BoundingBox(62.3, 25.7, 5), minutes=10)
+        self.assertEqual(len(self.server.requests), 2)
+        # rows 6..9 are both inside the box and the last ten minutes
+        self.assertEqual(sorted(strikes.current), [-19.0, -18.0, -17.0, -16.0])
+        self.assertEqual(list(strikes.time), sorted(strikes.time))
+
+
+class WeatherCacheTestCase(StandInWFSTestCase):
+    def testPlacesShareNormalizedEntry(self):
+        cache = WeatherCache(self.fmi, size=2, ttl=600)
+        weathers = cache.getWeather('Jyv\xe4skyl\xe4')
+        self.assertEqual(len(weathers), len(self.rows))
+        self.assertTrue(math.isnan(weathers[0]['p_sea']))
+        cache.getWeather(' JYVA\u0308SKYLA\u0308')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testLeastRecentlyUsedIsDropped(self):
+        cache = WeatherCache(self.fmi, size=2, ttl=600)
+        for place in ('oulu', 'tampere', 'oulu', 'turku'):
+            cache.getWeather(place)
+        self.assertEqual(list(cache.entries), ['oulu', 'turku'])
+
+    def testUnknownPlaceIsCachedBriefly(self):
+        self.server.status = 400
+        cache = WeatherCache(self.fmi, ttl=600, negative_ttl=0)
+        self.assertEqual(cache.getWeather('nowhere'), [])
+        self.server.status = 200
+        self.assertEqual(len(cache.getWeather('nowhere')), len(self.rows))
+        self.assertEqual(cache.misses, 2)
+
 
-class LightningDetectorTestCase(PluginTestCase):
+class LatestWeatherTestCase(StandInWFSTestCase):
+    def setUp(self):
+        StandInWFSTestCase.setUp(self)
+        self.stations = [('Helsinki Kaisaniemi', 'Helsinki', 60.17523, 24.94459),
+                         ('Tampere H\xe4rm\xe4l\xe4', 'Tampere', 61.46589, 23.74692),
+                         ('Oulu lentoasema', 'Oulu', 64.93503, 25.3392)]
+        self.server.respond = self.respond
+
+    def respond(self, params):
+        places = params['place'] if isinstance(params['place'], list) else [params['place']]
+        found = [station for station in self.stations if station[1].lower() in places]
+        rows = []
+        for i in range(3):
+            # the observations of a time step come station after station
+            for n, (name, region, lat, lon) in enumerate(reversed(found)):
+                rows.append((lat, lon, 1463528400 + 600 * i, [10.0 * n + i] * 13))
+        return coverage_xml(rows, found)
+
+    def rejectUnknown(self, params):
+        # FMI answers a bad request if it does not know one of the places
+        body = self.respond(params)
+        places = params['place'] if isinstance(params['place'], list) else [params['place']]
+        known = [station[1].lower() for station in self.stations]
+        self.server.status = 200 if all(place in known for place in places) else 400
+        return body
+
+    def testOneRequestForManyPlaces(self):
+        latest = self.fmi.getLatestWeather(['helsinki', 'oulu', 'tampere', 'nowhere'])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(query_params(self.server.requests[0])['place'], ['helsinki', 'oulu', 'tampere', 'nowhere'])
+        self.assertEqual(latest['helsinki']['station'], 'Helsinki Kaisaniemi')
+        self.assertEqual(latest['helsinki']['t2m'], 22.0)
+        self.assertEqual(latest['tampere']['t2m'], 12.0)
+        self.assertEqual(latest['oulu']['t2m'], 2.0)
+        self.assertEqual(calendar.timegm(latest['oulu']['time'].utctimetuple()), 1463528400 + 1200)
+        self.assertEqual(latest['nowhere'], None)
+
+    def testRejectedBatchIsAskedPerPlace(self):
+        self.server.respond = self.rejectUnknown
+        latest = self.fmi.getLatestWeather(['helsinki', 'nowhere', 'oulu'])
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(latest['helsinki']['station'], 'Helsinki Kaisaniemi')
+        self.assertEqual(latest['oulu']['station'], 'Oulu lentoasema')
+        self.assertEqual(latest['nowhere'], None)
+
+    def testOnlyMissingPlacesAreCachedBriefly(self):
+        self.server.respond = self.rejectUnknown
+        cache = WeatherCache(self.fmi, ttl=600, negative_ttl=60)
+        cache.getLatest(['helsinki', 'nowhere'])
+        self.assertEqual(cache.entries['helsinki'][0] - cache.entries['nowhere'][0], 540)
+        # a failure caches nothing
+        self.server.respond = None
+        self.server.status = 503
+        self.assertRaises(FMIError, cache.getLatest, ['oulu', 'tampere'])
+        self.assertEqual(sorted(cache.entries), ['helsinki', 'nowhere'])
+
+    def testStationsInBox(self):
+        self.server.respond = None
+        self.server.body = coverage_xml([(60.17523, 24.94459, 1463528400, [1.0] * 13),
+                                         (60.17523, 24.94459, 1463529000, [3.0] * 13),
+                                         (61.46589, 23.74692, 1463528400, [2.0] * 13)], self.stations[:2])
+        latest = self.fmi.getLatestWeatherInBox(BoundingBox(61.0, 24.0, 150))
+        self.assertEqual(sorted(latest), ['Helsinki Kaisaniemi', 'Tampere H\xe4rm\xe4l\xe4'])
+        self.assertEqual(latest['Helsinki Kaisaniemi']['t2m'], 3.0)
+
+    def testStationsWithoutMetadataFollowPlaces(self):
+        self.server.respond = None
+        self.server.body = coverage_xml([(60.1, 24.9, 1463528400, [1.0] * 13), (61.4, 23.7, 1463528400, [2.0] * 13)])
+        latest = self.fmi.getLatestWeather(['helsinki', 'tampere', 'oulu'])
+        self.assertEqual((latest['helsinki']['t2m'], latest['tampere']['t2m'], latest['oulu']), (1.0, 2.0, None))
+
+    def testCachedPlacesAreNotRequested(self):
+        cache = WeatherCache(self.fmi, ttl=600)
+        cache.getLatest(['helsinki'])
+        latest = cache.getLatest(['Helsinki', 'oulu'])
+        self.assertEqual(query_params(self.server.requests[1])['place'], 'oulu')
+        self.assertEqual(latest['Helsinki']['station'], 'Helsinki Kaisaniemi')
+        self.assertEqual(len(cache.getWeather('oulu')), 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+
+class AlarmSchedulerTestCase(SupyTestCase):
+    def testDueInDeadlineOrder(self):
+        scheduler = AlarmScheduler()
+        scheduler.schedule('a', 30)
+        scheduler.schedule('b', 10)
+        scheduler.schedule('c', 20)
+        scheduler.schedule('a', 5)
+        self.assertEqual(scheduler.nextDeadline(), 5)
+        self.assertEqual(scheduler.popDue(20), ['a', 'b', 'c'])
+        self.assertEqual(scheduler.nextDeadline(), None)
+
+    def testCancelledAlarmIsNotDue(self):
+        scheduler = AlarmScheduler()
+        scheduler.schedule('a', 10)
+        scheduler.schedule('b', 20)
+        scheduler.cancel('a')
+        self.assertEqual(scheduler.nextDeadline(), 20)
+        self.assertEqual(scheduler.popDue(100), ['b'])
+        self.assertEqual(len(scheduler), 0)
+
+
+class CountingValue(MemoryValue):
+    """MemoryValue which counts its writes."""
+    def __init__(self, value='[]'):
+        MemoryValue.__init__(self, value)
+        self.writes = 0
+
+    def setValue(self, value):
+        MemoryValue.setValue(self, value)
+        self.writes += 1
+
+
+class AlarmStoreTestCase(SupyTestCase):
+    # as the plugin wrote it before the store, next_alarm and email included
+    stored = ('[{"user": "tipi", "channel": "#test", "lat": 62.2321, "lon": 24.2455, "radius": 30, '
+              '"next_alarm": 1463528400, "email": "tipi@example.com"}, '
+              '{"user": "other", "channel": "#test", "lat": 65.0, "lon": 25.5, "radius": 50, "next_alarm": 0}]')
+
+    def testChangesAreWrittenBehind(self):
+        value = CountingValue()
+        alarms = AlarmStore(value)
+        alarms.add({'user': 'tipi', 'channel': '#test', 'lat': 62.2, 'lon': 25.7, 'radius': 30, 'next_alarm': 0})
+        alarms.update('tipi', next_alarm=1)
+        alarms.update('tipi', email='tipi@example.com')
+        self.assertTrue(alarms.dirty)
+        self.assertEqual((value.writes, value()), (0, '[]'))
+        alarms.flush()
+        self.assertFalse(alarms.dirty)
+        self.assertEqual(value.writes, 1)
+        self.assertEqual(json.loads(value())[0]['email'], 'tipi@example.com')
+        # nothing changed, nothing written
+        alarms.get('tipi')['radius'] = 100
+        self.assertFalse(alarms.update('nobody', next_alarm=1))
+        self.assertFalse(alarms.remove('nobody'))
+        alarms.flush()
+        self.assertEqual(value.writes, 1)
+        self.assertTrue(alarms.remove('tipi'))
+        alarms.flush()
+        self.assertEqual((value.writes, value()), (2, '[]'))
+
+    def testValueFromBeforeTheStoreIsLoaded(self):
+        value = CountingValue(self.stored)
+        alarms = AlarmStore(value)
+        self.assertEqual(len(alarms), 2)
+        self.assertEqual(alarms.get('tipi')['email'], 'tipi@example.com')
+        self.assertEqual(alarms.get('tipi')['next_alarm'], 1463528400)
+        self.assertEqual([alarm['user'] for alarm in alarms.all()], ['tipi', 'other'])
+        alarms.flush()
+        self.assertEqual(value.writes, 0)
+        # written back in the same format
+        alarms.discard('tipi', 'email')
+        alarms.flush()
+        written = json.loads(value())
+        old = json.loads(self.stored)
+        del old[0]['email']
+        self.assertEqual(written, old)
+
+
+def strike_records(rows):
+    """StrikeRecords of (lat, lon, time, current) rows."""
+    strikes = StrikeRecords()
+    strikes.extendFlat(array('d', [value for lat, lon, t, current in rows for value in (lat, lon, t)]),
+                       array('d', [value for lat, lon, t, current in rows for value in (1, current, 0, 2.0)]), 4)
+    return strikes
+
+
+class StrikeArchiveTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.archive = StrikeArchive(self.directory)
+        # 2016-05-18T00:00:00, a strike every 30 s for two days, later half to the east
+        self.start = 1463529600
+        self.rows = [(62.25, 25.75 + (i >= 2880), self.start + 30 * i, float(i % 100)) for i in range(5760)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def testPartitionedByDay(self):
+        self.archive.append(strike_records(self.rows))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['2016-05-18.index', '2016-05-18.strikes', '2016-05-19.index', '2016-05-19.strikes'])
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, '2016-05-18.strikes')), 2880 * RECORD.size)
+        self.assertEqual(len(self.archive), len(self.rows))
+
+    def testTimeRangeAndBoundingBox(self):
+        # late observations arrive out of order
+        self.archive.append(strike_records(self.rows[100:]))
+        self.archive.append(strike_records(self.rows[:100]))
+        strikes = self.archive.query(self.start + 30 * 50, self.start + 30 * 3000)
+        self.assertEqual(list(strikes.time), [row[2] for row in self.rows[50:3001]])
+        strikes = self.archive.query(self.start, self.start + 86400 * 2, BoundingBox(62.25, 25.75, 10))
+        self.assertEqual(len(strikes), 2880)
+        self.assertAlmostEqual(strikes.lat[0], 62.25, 5)
+        self.assertEqual(strikes.record(7)['current'], 7.0)
+
+    def testIndexSkipsBlocks(self):
+        self.archive.append(strike_records(self.rows[:2880]))
+        day = self.archive._day('2016-05-18')
+        self.assertEqual(len(day.spans), 2880 // BLOCK)
+        self.assertEqual(day.blocks(self.start + 30 * 2000, self.start + 30 * 2001), [(BLOCK, 2 * BLOCK)])
+
+    def testStrikesAreArchivedOnce(self):
+        self.assertEqual(self.archive.append(strike_records(self.rows[:2000])), 2000)
+        self.assertEqual(self.archive.append(strike_records(self.rows[1900:2100])), 100)
+        # the strikes of the last hour are read back from the file
+        archive = StrikeArchive(self.directory)
+        self.assertEqual(archive.append(strike_records(self.rows[2000:2200])), 100)
+        strikes = archive.query(self.start, self.start + 86400)
+        self.assertEqual(list(strikes.time), [row[2] for row in self.rows[:2200]])
+
+    def testPartialRecordIsDropped(self):
+        self.archive.append(strike_records(self.rows[:2000]))
+        with open(os.path.join(self.directory, '2016-05-18.strikes'), 'ab') as f:
+            f.write(b'torn')
+        os.remove(os.path.join(self.directory, '2016-05-18.index'))
+        archive = StrikeArchive(self.directory)
+        self.assertEqual(len(archive.query(self.start, self.start + 86400)), 2000)
+        archive.append(strike_records(self.rows[2000:2100]))
+        self.assertEqual(len(archive.query(self.start, self.start + 86400)), 2100)
+
+
+class TilePyramidTestCase(SupyTestCase):
+    now = 1463528400
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.tiles = TilePyramid(hours=1)
+        # ten strikes a minute apart near Jyvaskyla, one in Oulu
+        self.strikes = strike_records([(62.24, 25.75, self.now - 60 * i, -10.0 - i) for i in range(10)] +
+                                      [(65.01, 25.47, self.now, -50.0)])
+        self.strikes.cloud[0] = 1.0
+        self.tiles.add(self.strikes)
+
+    def testActivity(self):
+        activity = self.tiles.activity(62.24, 25.75, 20, self.now - 1800)
+        self.assertEqual(activity['count'], 10)
+        self.assertEqual(activity['ground'], 9)
+        self.assertEqual(activity['current_peak'], -19.0)
+        # every level answers the same for strikes at one spot
+        for radius in (5, 50, 200):
+            self.assertEqual(self.tiles.activity(62.24, 25.75, radius, self.now - 1800)['count'], 10)
+        self.assertEqual(self.tiles.activity(65.01, 25.47, 500, self.now - 1800)['count'], 11)
+        self.assertEqual(self.tiles.activity(60.17, 24.94, 50, self.now - 1800)['count'], 0)
+
+    def testActivityIsLimitedToBuckets(self):
+        activity = self.tiles.activity(62.24, 25.75, 20, self.now - 60)
+        self.assertEqual(activity['since'], (self.now - 60) // BUCKET * BUCKET)
+        self.assertTrue(0 < activity['count'] < 10)
+
+    def testStrikesAreDeduplicated(self):
+        self.tiles.add(self.strikes)
+        self.assertEqual(len(self.tiles), 11)
+        self.assertEqual(self.tiles.activity(62.24, 25.75, 20, self.now - 1800)['count'], 10)
+
+    def testOldBucketsExpire(self):
+        self.tiles.add(strike_records([(62.24, 25.75, self.now + 7200, -10.0)]))
+        self.assertEqual(len(self.tiles), 1)
+        self.assertEqual(self.tiles.activity(62.24, 25.75, 20, 0)['count'], 1)
+
+
+class ReplayTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # a strike a minute for two hours at one spot
+        self.strikes = strike_records([(62.2, 25.7, 1463528220 + 60 * i, -10.0) for i in range(120)])
+        self.alarms = [{'user': 'near', 'channel': '#test', 'lat': 62.2, 'lon': 25.7, 'radius': 20,
+                        'next_alarm': 0, 'interval': 20, 'block': 60},
+                       {'user': 'far', 'channel': '#test', 'lat': 65.0, 'lon': 25.7, 'radius': 20,
+                        'next_alarm': 0, 'interval': 20, 'block': 60}]
+
+    def testAlertsFollowBlockingPeriod(self):
+        report = Replay(self.strikes, self.alarms).run()
+        self.assertEqual(report['alerts'], {'near': 2, 'far': 0})
+        # near at 0 and 60 min, far every 20 min until the last strike
+        self.assertEqual(report['evaluations'], 2 + 6)
+        self.assertEqual(report['simulated_seconds'], 119 * 60)
+
+    def testSyntheticStormMoves(self):
+        storm = synthetic_storm(1000, 1463528220, hours=2.0, heading=0.0, spread_km=1.0)
+        self.assertEqual(len(storm), 1000)
+        self.assertEqual(list(storm.time), sorted(storm.time))
+        # 40 km/h to the north for two hours
+        self.assertTrue(storm.lat[-1] - storm.lat[0] > 70 / 110.5)
+
+
+class CellTrackerTestCase(SupyTestCase):
+    start = 1463528220
+
+    def feed(self, tracker, strikes):
+        # one batch a minute like the strike feed
+        i = 0
+        while i < len(strikes):
+            minute = strikes.time[i] // 60
+            j = i
+            while j < len(strikes) and strikes.time[j] // 60 == minute:
+                j += 1
+            tracker.add(strikes.take(range(i, j)))
+            i = j
+
+    def testStormIsTracked(self):
+        tracker = CellTracker()
+        self.feed(tracker, synthetic_storm(3000, self.start, hours=2.0, spread_km=5.0))
+        tracks = tracker.cells()
+        self.assertEqual(len(tracks), 1)
+        # 40 km/h to the north-east
+        self.assertAlmostEqual(tracks[0].speed(), 40, delta=5)
+        self.assertAlmostEqual(math.degrees(tracks[0].heading()), 45, delta=5)
+
+    def testSeparateStormsAreSeparateCells(self):
+        strikes = synthetic_storm(1000, self.start, hours=1.0, spread_km=5.0)
+        strikes.merge(synthetic_storm(1000, self.start, hours=1.0, lat=64.0, spread_km=5.0, seed=2))
+        strikes = strikes.take(sorted(range(len(strikes)), key=strikes.time.__getitem__))
+        tracker = CellTracker()
+        self.feed(tracker, strikes)
+        self.assertEqual(len(tracker.cells()), 2)
+
+    def testDistancesAreTrueInTheNorthAndSouth(self):
+        # in a line of strikes 4.5 km apart the strikes two apart are within
+        # 10 km and it is a cell, in a line 5.5 km apart they are not
+        for lat, spacing, cells in ((69.5, 4.5, 1), (60.2, 5.5, 0)):
+            tracker = CellTracker(eps_km=10.0)
+            step = spacing / (110.5 * math.cos(math.radians(lat)))
+            tracker.add(strike_records([(lat, 25.0 + i * step, self.start + i, -10.0) for i in range(20)]))
+            self.assertEqual(len(tracker.cells()), cells, lat)
+
+    def testApproaching(self):
+        tracker = CellTracker()
+        self.feed(tracker, synthetic_storm(3000, self.start, hours=2.0, spread_km=5.0))
+        track = tracker.cells()[0]
+        # 40 km ahead of and behind the storm
+        ahead_lat = track.lat + 40 / 110.5 * math.cos(math.radians(45))
+        ahead_lon = track.lon + 40 / (110.5 * math.cos(math.radians(track.lat))) * math.sin(math.radians(45))
+        found = tracker.approaching(ahead_lat, ahead_lon, 10)
+        self.assertEqual(len(found), 1)
+        found_track, distance, bearing, eta = found[0]
+        self.assertAlmostEqual(distance, 40, delta=1)
+        self.assertTrue(0 < eta < 3600)
+        # the storm lies to the south-west
+        self.assertAlmostEqual(math.degrees(bearing), -135, delta=1)
+        behind_lat = 2 * track.lat - ahead_lat
+        behind_lon = 2 * track.lon - ahead_lon
+        self.assertEqual(tracker.approaching(behind_lat, behind_lon, 10), [])
+        # out of reach within the horizon
+        self.assertEqual(tracker.approaching(ahead_lat, ahead_lon, 10, horizon=600), [])
+
+
+class StandInSMTP(ThreadingMixIn, TCPServer):
+    """Local stand-in SMTP server which counts connections and refuses the
+    first failures messages with a temporary error."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ('127.0.0.1', 0), StandInSMTPHandler)
+        self.connections = 0
+        self.failures = 0
+        self.messages = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInSMTPHandler(StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf8'))
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stand-in ready')
+        mail = None
+        for line in self.rfile:
+            command = line.decode('utf8').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO', 'NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                if self.server.failures:
+                    self.server.failures -= 1
+                    self.reply('451 try again later')
+                else:
+                    mail = {'to': [], 'data': []}
+                    self.reply('250 OK')
+            elif verb == 'RCPT':
+                mail['to'].append(command.split(':', 1)[1].strip('<> '))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 end with .')
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    mail['data'].append(data.decode('utf8'))
+                self.server.messages.append(mail)
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 not implemented')
+
+
+class EmailQueueTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = StandInSMTP()
+        self.mailer = EmailQueue('127.0.0.1', self.server.port, 'bot@example.com',
+                                 starttls=False, backoff=0.01, timeout=5.0)
+
+    def tearDown(self):
+        self.mailer.stop()
+        self.mailer.join()
+        self.server.stop()
+        SupyTestCase.tearDown(self)
+
+    def waitFor(self, condition):
+        deadline = time.time() + 5.0
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def testSessionIsReused(self):
+        self.mailer.start()
+        for i in range(3):
+            self.mailer.send('user%i@example.com' % i, 'alert %i' % i, 'body')
+            self.waitFor(lambda: self.mailer.sent == i + 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def testRecipientsOfSameAlertAreBatched(self):
+        self.mailer.send('a@example.com', 'alert', 'body')
+        self.mailer.send(['b@example.com', 'a@example.com'], 'alert', 'body')
+        self.mailer.send('c@example.com', 'other alert', 'body')
+        self.assertEqual(self.mailer.depth(), 3)
+        self.mailer.start()
+        self.waitFor(lambda: self.mailer.sent == 2)
+        recipients = sorted(message['to'] for message in self.server.messages)
+        self.assertEqual(recipients, [['a@example.com', 'b@example.com'], ['c@example.com']])
+        self.assertEqual(self.mailer.depth(), 0)
+
+    def testTemporaryFailureIsRetried(self):
+        self.server.failures = 2
+        self.mailer.start()
+        self.mailer.send('a@example.com', 'alert', 'body')
+        self.waitFor(lambda: self.mailer.sent == 1)
+        self.assertEqual(self.mailer.failed, 0)
+        self.assertEqual(self.server.connections, 3)
+
+    def testGivesUpAfterRetries(self):
+        self.server.failures = 10
+        self.mailer.start()
+        self.mailer.send('a@example.com', 'alert', 'body')
+        self.waitFor(lambda: self.mailer.failed == 1)
+        self.assertEqual(self.server.messages, [])
+
+
+class RecordingIrc(object):
+    def __init__(self):
+        self.msgs = []
+
+    def queueMsg(self, msg):
+        self.msgs.append((time.time(), msg.args[0], msg.args[1]))
+
+
+class AlertOutputTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.irc = RecordingIrc()
+
+    def run_output(self, output, count):
+        output.start()
+        deadline = time.time() + 5.0
+        while len(self.irc.msgs) < count and time.time() < deadline:
+            time.sleep(0.01)
+        output.stop()
+        output.join()
+        return [msg[1:] for msg in self.irc.msgs]
+
+    def testAlertsOfChannelAreCoalesced(self):
+        output = AlertOutput(self.irc)
+        output.add('#a', 'nick1', 'storm')
+        output.add('#b', 'nick2', 'storm')
+        output.add('#a', 'nick3', 'storm')
+        output.add('#a', 'nick4', 'no strikes')
+        output.flush()
+        self.assertEqual(self.run_output(output, 2),
+            [('#a', 'nick1, nick3: storm | nick4, no strikes'), ('#b', 'nick2, storm')])
+
+    def testNewerAlertReplacesQueuedOne(self):
+        output = AlertOutput(self.irc)
+        output.add('#a', 'nick1', 'old')
+        output.flush()
+        output.add('#a', 'nick1', 'new')
+        output.flush()
+        self.assertEqual(self.run_output(output, 1), [('#a', 'nick1, new')])
+
+    def testStaleAlertsAreDropped(self):
+        output = AlertOutput(self.irc, max_age=0)
+        output.add('#a', 'nick1', 'storm')
+        output.flush()
+        time.sleep(0.01)
+        self.assertEqual(self.run_output(output, 1), [])
+        self.assertEqual(output.dropped, 1)
+
+    def testRateIsLimited(self):
+        output = AlertOutput(self.irc, rate=20.0, burst=1)
+        for i in range(4):
+            output.add('#%i' % i, 'nick', 'storm')
+        output.flush()
+        self.run_output(output, 4)
+        times = [msg[0] for msg in self.irc.msgs]
+        self.assertEqual(len(times), 4)
+        self.assertTrue(times[-1] - times[0] >= 3 / 20.0 * 0.9)
+
+
+class LightningDetectorTestCase(ChannelPluginTestCase):
     plugins = ('LightningDetector',)
 
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        self.server = StandInWFS(coverage([]))
+        self.plugin = self.irc.getCallback('LightningDetector')
+        self.plugin.fmi.pool = ConnectionPool(self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+        ChannelPluginTestCase.tearDown(self)
+        # the next test starts cold
+        warm_state.clear()
+
+    def testWeatherCache(self):
+        self.assertRegexp('weathercache', '0 hits, 0 misses')
+
+    def testWeathers(self):
+        self.server.body = coverage_xml([(60.17523, 24.94459, 1463528400, [15.5] * 13)],
+                                        [('Helsinki Kaisaniemi', 'Helsinki', 60.17523, 24.94459)])
+        self.assertRegexp('weathers helsinki, nowhere',
+                          'Weather for Helsinki at .*temperature .*15.5.*Temperature not found for nowhere')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testStrikeHistory(self):
+        self.assertRegexp('strikehistory 62.2 25.7 50 2', 'needs the strike feed')
+        directory = tempfile.mkdtemp()
+        try:
+            self.plugin.archive = StrikeArchive(directory)
+            now = int(time.time())
+            self.plugin.archive.append(strike_records([(62.2, 25.7, now - 600, -5.0), (62.3, 25.7, now - 300, -20.0),
+                                                       (65.0, 25.7, now - 300, -5.0), (62.2, 25.7, now - 86400, -5.0)]))
+            self.assertRegexp('strikehistory 62.2 25.7 50 2', '^2 strikes during last 2 hours.*peak current -20.0 kA')
+            self.assertRegexp('strikehistory 60.2 25.7 50 2', 'No archived strikes')
+        finally:
+            shutil.rmtree(directory)
+
+    def testStartupIsSpread(self):
+        alarms = AlarmStore(MemoryValue())
+        for i in range(4):
+            alarms.add({'user': 'user%i' % i, 'channel': '#test', 'lat': 62.2, 'lon': 25.7,
+                        'radius': 20, 'next_alarm': 0})
+        alarms.add({'user': 'blocked', 'channel': '#test', 'lat': 62.2, 'lon': 25.7,
+                    'radius': 20, 'next_alarm': 2000})
+        scheduler = AlarmScheduler()
+        scheduler.schedule('user3', 1500)
+        thread = self.plugin.AlarmThread(None, None, alarms, scheduler, None)
+        with conf.supybot.plugins.LightningDetector.startupSpread.context(60):
+            thread.scheduleStartup(1000)
+        self.assertEqual(scheduler.all(), {'user0': 1000, 'user1': 1020, 'user2': 1040,
+                                           'user3': 1500, 'blocked': 2000})
+
+    def testReloadKeepsWarmState(self):
+        self.plugin.strikeCache.getStrikes(BoundingBox(62.2, 25.7, 50))
+        deadline = int(time.time()) + 3600
+        self.plugin.scheduler.schedule('someone', deadline)
+        package = __name__.rpartition('.')[0]
+        modules = dict((name, module) for name, module in sys.modules.items()
+                       if name == package or name.startswith(package + '.'))
+        saved = dict((name, dict(vars(module))) for name, module in modules.items())
+        try:
+            self.assertNotError('reload LightningDetector')
+            plugin = self.irc.getCallback('LightningDetector')
+            self.assertFalse(plugin is self.plugin)
+            # the plugin binds the classes of the reloaded modules
+            self.assertFalse(type(plugin.strikeCache) is StrikeCache)
+            self.assertTrue(type(plugin.strikeCache) is sys.modules[package + '.cache'].StrikeCache)
+            self.assertTrue(type(plugin.fmi) is sys.modules[package + '.fmiapi'].FMIOpenData)
+            self.assertTrue(type(plugin.tiles) is sys.modules[package + '.tiles'].TilePyramid)
+            self.assertEqual(len(plugin.strikeCache.regions), 1)
+            self.assertEqual(plugin.scheduler.deadline('someone'), deadline)
+        finally:
+            # the other tests keep the classes they imported
+            for name, module in modules.items():
+                sys.modules[name] = module
+                vars(module).clear()
+                vars(module).update(saved[name])
+
+    def testStrikesNear(self):
+        tiles = self.plugin.tiles
+        self.plugin.tiles = None
+        self.assertError('strikesnear 62.2 25.7 50')
+        self.plugin.tiles = tiles
+        self.assertRegexp('strikesnear 62.2 25.7 50', 'No strikes within 50 km during last 30 minutes')
+        now = int(time.time())
+        self.plugin.tiles.add(strike_records([(62.2, 25.7, now - 600, -5.0), (62.3, 25.7, now - 300, -20.0),
+                                              (65.0, 25.7, now - 300, -5.0), (62.2, 25.7, now - 3600, -5.0)]))
+        self.assertRegexp('strikesnear 62.2 25.7 50', '^2 strikes within 50 km since .*peak current -20.0 kA')
+        self.assertRegexp('strikesnear 62.2 25.7 50 120', '^3 strikes within 50 km')
+
+    def testCells(self):
+        self.assertError('cells')
+        self.plugin.tracker = CellTracker()
+        self.assertRegexp('cells', 'No storm cells')
+        self.plugin.tracker.add(synthetic_storm(3000, int(time.time()) - 7200, hours=2.0, spread_km=5.0))
+        self.assertRegexp('cells', r'^cell 1: \d+ strikes at 6\d\.\d\d 2\d\.\d\d')
+
+    def testWeatherWhenFMIIsDown(self):
+        self.server.status = 503
+        self.assertRegexp('weather oulu', 'FMI did not answer')
+        self.assertRegexp('weathers oulu, helsinki', 'FMI did not answer')
+        # the failure is not cached
+        self.server.status = 200
+        self.assertRegexp('weather oulu', 'Temperature not found')
+
+    def testAlarmWhenFMIIsDown(self):
+        failed = registry.counter('alarm_groups_failed_total', '').value
+        errors = registry.counter('alarm_query_errors_total', '').value
+        timed_out = registry.counter('alarms_timed_out_total', '').value
+        self.server.status = 503
+        self.assertNotError('alarmadd 62.2 25.7 50')
+        deadline = time.time() + 5.0
+        while registry.counter('alarm_groups_failed_total', '').value == failed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(registry.counter('alarm_groups_failed_total', '').value, failed + 1)
+        # a failed query is not counted as timed out
+        self.assertEqual(registry.counter('alarm_query_errors_total', '').value, errors + 1)
+        self.assertEqual(registry.counter('alarms_timed_out_total', '').value, timed_out)
+        # a failed query is not reported as no strikes
+        self.assertEqual(self.irc.takeMsg(), None)
+        self.server.status = 200
+        self.plugin.thread.notify('test')
+        m = self.getMsg(' ')
+        self.assertTrue('no strikes are currently found' in m.args[1], m)
+        self.assertNotError('alarmremove')
+
+    def testMetrics(self):
+        self.assertError('weather oulu')
+        self.assertRegexp('metrics fmi_', 'fmi_requests_total [1-9]')
+        self.assertError('metrics nosuchmetric')
+
+    def testAlarmsAreFlushedWithTheRegistry(self):
+        self.assertTrue(self.plugin.alarms.flush in world.flushers)
+        self.plugin.alarms.add({'user': 'tipi', 'channel': '#test', 'lat': 62.2, 'lon': 25.7, 'radius': 30,
+                                'next_alarm': 0})
+        world.flush()
+        self.assertFalse(self.plugin.alarms.dirty)
+        self.assertTrue('tipi' in [alarm['user'] for alarm in json.loads(self.plugin.registryValue('alarms'))])
+        self.plugin.alarms.remove('tipi')
+        self.plugin.alarms.flush()
+
+    def testAlarmCommands(self):
+        self.assertRegexp('alarmlist', 'empty')
+        self.assertNotError('alarmadd 62.2 25.7 50')
+        m = self.getMsg(' ')
+        self.assertTrue('no strikes are currently found' in m.args[1], m)
+        self.assertError('alarmadd 60.1 24.9 50')
+        self.assertNotError('alarmemail test@example.com')
+        self.assertRegexp('alarmlist', r'^test #test 62.2 25.7 50 1 test@example.com$')
+        self.assertNotError('alarmemail')
+        self.assertRegexp('alarmlist', r'^test #test 62.2 25.7 50 1$')
+        self.plugin.alarms.flush()
+        self.assertTrue('"user": "test"' in self.plugin.registryValue('alarms'))
+        self.assertNotError('alarmtiming 10 60')
+        self.assertEqual(self.plugin.alarms.get('test')['block'], 60)
+        self.assertNotError('alarmremove')
+        self.assertError('alarmremove')
+        self.assertError('alarmstatus')
+        self.assertRegexp('alarmlist', 'empty')
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,124 @@
+###
+# Copyright (c) 2016, Timo Pihlstrom
+# All rights reserved.
+#
+#
+###
+import math
+import threading
+
+KM_PER_DEG = 110.5
+BUCKET = 300
+# tile height in degrees of latitude per level, tiles are twice as wide in
+# longitude, which keeps them about square at Finnish latitudes
+LEVELS = (0.05, 0.2, 0.8, 3.2)
+# tiles of the radius, a query reads at most (2 * SPAN + 2) ** 2 tiles a bucket
+SPAN = 4
+
+class TilePyramid(object):
+    """
+    Strike counts, ground strike counts and peak current per tile and
+    BUCKET second time bucket, kept for hours hours at every level of LEVELS.
+    Strikes are added as they are fetched and deduplicated by time and
+    position, so overlapping fetches may add the same strikes again.
+
+    activity() answers from the level whose tiles are the smallest ones
+    with at most SPAN tiles across the radius, summing the tiles whose
+    centre lies within the radius. Its cost depends on the radius and time
+    span asked for only, not on the number of strikes.
+    """
+    def __init__(self, hours=6):
+        self.retention = hours * 3600
+        # bucket start -> level -> (row, col) -> [count, ground, peak current]
+        self.buckets = {}
+        self.keys = {}
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(keys) for keys in self.keys.values())
+
+    def add(self, strikes):
+        with self.lock:
+            for i in range(len(strikes)):
+                t = strikes.time[i]
+                bucket = int(t) // BUCKET * BUCKET
+                if self.latest is not None and bucket < self.latest - self.retention:
+                    continue
+                key = (t, strikes.lat[i], strikes.lon[i])
+                keys = self.keys.get(bucket)
+                if keys is None:
+                    keys = self.keys[bucket] = set()
+                    self.buckets[bucket] = [{} for size in LEVELS]
+                elif key in keys:
+                    continue
+                keys.add(key)
+                ground = strikes.cloud[i] == 0
+                current = strikes.current[i]
+                for size, tiles in zip(LEVELS, self.buckets[bucket]):
+                    tile = (int(math.floor(strikes.lat[i] / size)), int(math.floor(strikes.lon[i] / (2 * size))))
+                    values = tiles.get(tile)
+                    if values is None:
+                        tiles[tile] = [1, int(ground), current]
+                    else:
+                        values[0] += 1
+                        values[1] += ground
+                        if abs(current) > abs(values[2]):
+                            values[2] = current
+                if self.latest is None or bucket > self.latest:
+                    self.latest = bucket
+            self._expire()
+
+    def _expire(self):
+        if self.latest is None:
+            return
+        for bucket in [b for b in self.buckets if b < self.latest - self.retention]:
+            del self.buckets[bucket]
+            del self.keys[bucket]
+
+    def level(self, radius_km):
+        for level, size in enumerate(LEVELS):
+            if radius_km <= SPAN * size * KM_PER_DEG:
+                return level
+        return len(LEVELS) - 1
+
+    def activity(self, lat, lon, radius_km, since):
+        """
+        Dict of the count, ground count and peak current of the strikes within
+        radius_km of (lat, lon) in the buckets overlapping the time since
+        (unix seconds) and the start of the oldest of them in 'since'.
+        """
+        level = self.level(radius_km)
+        size = LEVELS[level]
+        coslat = math.cos(math.radians(lat))
+        dlat = radius_km / KM_PER_DEG
+        dlon = radius_km / (KM_PER_DEG * coslat)
+        rows = range(int(math.floor((lat - dlat) / size)), int(math.floor((lat + dlat) / size)) + 1)
+        cols = range(int(math.floor((lon - dlon) / (2 * size))), int(math.floor((lon + dlon) / (2 * size))) + 1)
+        near = []
+        for row in rows:
+            for col in cols:
+                dy = ((row + 0.5) * size - lat) * KM_PER_DEG
+                dx = ((col + 0.5) * 2 * size - lon) * KM_PER_DEG * coslat
+                if dx * dx + dy * dy <= radius_km * radius_km:
+                    near.append((row, col))
+        if not near:
+            # a radius smaller than the tiles, the tile of the point answers
+            near.append((int(math.floor(lat / size)), int(math.floor(lon / (2 * size)))))
+
+        start = int(since) // BUCKET * BUCKET
+        result = {'count': 0, 'ground': 0, 'current_peak': 0.0, 'since': start}
+        with self.lock:
+            for bucket, levels in self.buckets.items():
+                if bucket < start:
+                    continue
+                tiles = levels[level]
+                for tile in near:
+                    values = tiles.get(tile)
+                    if values is not None:
+                        result['count'] += values[0]
+                        result['ground'] += values[1]
+                        if abs(values[2]) > abs(result['current_peak']):
+                            result['current_peak'] = values[2]
+        return result